@@ -12,30 +12,92 @@ based on an exponential fit of indoor temperature drop.
 import pandas as pd
 import numpy as np
 import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import scipy as sp
+from caching import combined_hash, file_signature_hash
+from instrumentation import instrumented_run, step
+from pipeline import stage_parameters
 
-def break_into_intervals(df):
-    # Calculate time difference
-    time_diff = df.index.to_series().diff().dt.total_seconds().fillna(0)
-    mask = time_diff > 120  # Two minutes in seconds
-
-    # Grouping based on intervals
-    groups = mask.cumsum()
-    intervals = df.groupby(groups)
-
-    # Creating separate DataFrames for each interval
-    dfs = [interval for _, interval in intervals if len(interval)>=duration\
-           and interval['Internal_Air_Temperature'].isna().sum()==0\
-               and interval['External_Air_Temperature'].isna().sum()==0\
-                   # mean temperature difference of 5 C between indoor and outdoor temperature
-                    and interval['Internal_Air_Temperature'].mean()-interval['External_Air_Temperature'].mean()>5\
-                        # require an overall change in indoor air temperature
-                        and interval['Internal_Air_Temperature'].diff().sum()!=0.\
-                            # ensure that external temperature doesn't vary more than 2 C
-                            and (interval['External_Air_Temperature'].max()-interval['External_Air_Temperature'].min())<=2. 
-                            ]
+def segment_statistics(df):
+    '''
+    split a cooling record into segments at gaps of more than two minutes and
+    calculate the statistics used to select intervals for every segment at once
+    with segment reductions
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        internal and external air temperature indexed by timestamp.
+
+    Returns
+    -------
+    segments : pandas DataFrame
+        start and end (exclusive) row of each segment, its length, whether it
+        meets every interval criterion except length ('Usable'), and the mean
+        external air temperature.
+
+    '''
+    seconds = _elapsed_seconds(df.index)
+    internal = df['Internal_Air_Temperature'].to_numpy(dtype=float)
+    external = df['External_Air_Temperature'].to_numpy(dtype=float)
+    if len(df) == 0:
+        return pd.DataFrame({'Start': np.array([], dtype=np.int64), 'End': np.array([], dtype=np.int64),
+                             'Length': np.array([], dtype=np.int64), 'Usable': np.array([], dtype=bool),
+                             'Mean external temperature': np.array([], dtype=float)})
+    
+    # Two minutes in seconds
+    starts = np.r_[0, np.flatnonzero(np.diff(seconds) > 120) + 1]
+    ends = np.r_[starts[1:], len(df)]
+    lengths = ends - starts
     
-    return dfs
+    internal_nans = np.add.reduceat(np.isnan(internal), starts)
+    external_nans = np.add.reduceat(np.isnan(external), starts)
+    internal_mean = np.add.reduceat(internal, starts)/lengths
+    external_mean = np.add.reduceat(external, starts)/lengths
+    # change in indoor air temperature within each segment
+    internal_diff = np.diff(internal, prepend=np.nan)
+    internal_diff[starts] = 0.
+    internal_change = np.add.reduceat(internal_diff, starts)
+    external_range = np.maximum.reduceat(external, starts) - np.minimum.reduceat(external, starts)
+    
+    usable = ((internal_nans==0) & (external_nans==0)
+              # mean temperature difference of 5 C between indoor and outdoor temperature
+              & (internal_mean - external_mean > 5)
+              # require an overall change in indoor air temperature
+              & (internal_change != 0.)
+              # ensure that external temperature doesn't vary more than 2 C
+              & (external_range <= 2.))
+    return pd.DataFrame({'Start': starts, 'End': ends, 'Length': lengths, 'Usable': usable,
+                         'Mean external temperature': external_mean})
+
+def break_into_intervals(df, duration, segments=None):
+    '''
+    split a cooling record into usable intervals of at least duration minutes
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        internal and external air temperature indexed by timestamp.
+    duration : int
+        minimum number of rows (minutes) in an interval.
+    segments : pandas DataFrame, optional
+        precomputed output of segment_statistics. The default is None.
+
+    Returns
+    -------
+    dfs : list of pandas DataFrames
+        one DataFrame for each interval.
+
+    '''
+    if segments is None:
+        segments = segment_statistics(df)
+    selected = segments[segments['Usable'] & (segments['Length'] >= duration)]
+    return [df.iloc[start:end] for start, end in zip(selected['Start'], selected['End'])]
+
+def _elapsed_seconds(index):
+    return (index - index.min()).to_series().dt.total_seconds().to_numpy() if len(index) else np.array([])
 
 def exponential_decay(t, A, tau, C):
      return A * np.exp(-t/tau) + C
@@ -49,87 +111,331 @@ def fit_exponential_decay(df, C):
      A = np.exp(A_log)
      tau = -1/K
      return A, tau
-def fit_exp_nonlinear(df):
-     t = (df.index-df.index.min()).to_series().dt.total_seconds().values
-     y = df['Internal_Air_Temperature'].values
-
-     opt_parms, parm_cov = sp.optimize.curve_fit(exponential_decay, t, y, maxfev=1000)
-     A, tau, C = opt_parms
-     return A, tau, C
-
-
-# find all samples
-dataset_1 = glob.glob('Data/Electrification of Heat/Dataset 1/*.csv')
-dataset_2 = glob.glob('Data/Electrification of Heat/Dataset 2/*.csv')
-all_files = dataset_1 + dataset_2
-duration_list = [30,60,90,120,180,240]
-
-tau_df = pd.DataFrame(np.nan, index=np.array(all_files), columns=np.array(duration_list))
-tau_df.index = tau_df.index.str.removeprefix('Data/Electrification of Heat/Dataset 1\Property_ID=').str.removesuffix('.csv')
-tau_df.index = tau_df.index.str.removeprefix('Data/Electrification of Heat/Dataset 2\Property_ID=').str.removesuffix('.csv')
-
-for duration in duration_list:
-    house_tau_list = []
-    house_tau_variation_list = []
-    # import sample data
-    for file in all_files:
-        EOH_house = pd.read_csv(file, parse_dates=['Timestamp'],index_col='Timestamp')
-        print('Reading '+file)
-        
-        #%% identifying time periods when heat pump is off and temperature is decreasing
-        if 'Heat_Pump_Energy_Output' not in EOH_house.columns:
-            house_tau_list.append(np.nan)
-            house_tau_variation_list.append(np.nan)
-            continue
-        # filter to exclude summer months
-        heating_season = pd.concat([EOH_house['11-2020':'04-2021'],EOH_house['10-2021':'04-2022']])
-        heat_pump_installed = heating_season[~heating_season['Heat_Pump_Energy_Output'].isna()]
-        
-        #%% heat pump energy output not increasing (heat pump off)
-        heat_off = heat_pump_installed[(heat_pump_installed['Heat_Pump_Energy_Output'].diff()==0.)&(heat_pump_installed['Heat_Pump_Heating_Flow_Temperature'].diff()<=0.)]
+def fit_exponential_decay_segments(df, segments, weights=None):
+    '''
+    fit exponential decay to many intervals at once with a closed-form
+    weighted least-squares fit of log temperature difference against time
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        internal and external air temperature indexed by timestamp.
+    segments : pandas DataFrame
+        rows of segment_statistics to fit, using their mean external
+        temperature as C.
+    weights : numpy array, optional
+        weight of each row of df in the fits. The default is None, which gives
+        the same result as fit_exponential_decay.
+
+    Returns
+    -------
+    A : numpy array
+        fitted initial temperature difference for each segment.
+    tau : numpy array
+        fitted time constant in seconds for each segment.
+
+    '''
+    starts = segments['Start'].to_numpy()
+    lengths = segments['Length'].to_numpy()
+    segment = np.repeat(np.arange(len(starts)), lengths)
+    rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
     
-        # check if boiler or backup heater is on if installed
-        if 'Boiler_Energy_Output' in heat_off.columns:
-            heat_off = heat_off[heat_off['Boiler_Energy_Output'].diff()==0.]
-        
-        if 'Back-up_Heater_Energy_Consumed' in heat_off.columns:
-            heat_off = heat_off[heat_off['Back-up_Heater_Energy_Consumed'].diff()==0.]
-        
-        if 'Immersion_Heater_Energy_Consumed' in heat_off.columns:
-            heat_off = heat_off[heat_off['Immersion_Heater_Energy_Consumed'].diff()==0.]
-            
-        # colder outside than inside-- only get winter!!!
-        colder_outside = heat_off[heat_off['External_Air_Temperature']<heat_off['Internal_Air_Temperature']]
-        # ensure outside of house is below 15.5 C
-        colder_outside = colder_outside[colder_outside['External_Air_Temperature']<15.5]
-        # when temperature is decreasing
-        decreasing_temperature = colder_outside[colder_outside['Internal_Air_Temperature'].diff()<=0.]
-        # exclude rapid decreases in temperature -- assume door/window was opened
-        decreasing_temperature = decreasing_temperature[decreasing_temperature['Internal_Air_Temperature'].diff()>-5.]
-
-        #%% section off consecutive time periods     
-        separate_dataframes = break_into_intervals(decreasing_temperature)
+    seconds = _elapsed_seconds(df.index)
+    t = seconds[rows] - seconds[starts][segment]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y = np.log(df['Internal_Air_Temperature'].to_numpy(dtype=float)[rows]
+                   - segments['Mean external temperature'].to_numpy()[segment])
+    w = np.ones(len(rows)) if weights is None else np.asarray(weights, dtype=float)[rows]
+    
+    # centred sums keep the normal equations well conditioned
+    total_weight = np.bincount(segment, w, minlength=len(starts))
+    t_mean = np.bincount(segment, w*t, minlength=len(starts))/total_weight
+    y_mean = np.bincount(segment, w*y, minlength=len(starts))/total_weight
+    t_centred = t - t_mean[segment]
+    K = np.bincount(segment, w*t_centred*(y - y_mean[segment]), minlength=len(starts))/\
+        np.bincount(segment, w*t_centred**2, minlength=len(starts))
+    A = np.exp(y_mean - K*t_mean)
+    tau = -1/K
+    return A, tau
+
+def exponential_decay_jacobian(t, A, tau, C):
+    decay = np.exp(-t/tau)
+    return np.column_stack([decay, A*t*decay/tau**2, np.ones_like(t)])
+
+def fit_exp_nonlinear(df, p0=None, tau_bounds=(60., 1000*3600.), maxfev=1000, full_output=False):
+    '''
+    fit exponential decay with a free asymptote C by nonlinear least squares,
+    seeded from the log-linear fit and bounded so tau stays physical and C
+    stays below the indoor temperature
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        internal and external air temperature for one interval indexed by timestamp.
+    p0 : tuple, optional
+        initial (A, tau, C). The default is None, which uses fit_exponential_decay
+        with C as the mean external air temperature.
+    tau_bounds : tuple, optional
+        lower and upper bound on tau in seconds. The default is 1 minute to 1000 hours.
+    maxfev : int, optional
+        maximum number of function evaluations. The default is 1000.
+    full_output : bool, optional
+        also return whether the fit converged and the number of function
+        evaluations. The default is False.
+
+    Returns
+    -------
+    A, tau, C : float
+        fitted parameters, with tau in seconds.
+    converged, nfev : bool, int
+        only if full_output is True.
+
+    '''
+    t = _elapsed_seconds(df.index)
+    y = df['Internal_Air_Temperature'].to_numpy(dtype=float)
+    if p0 is None:
+        C = df['External_Air_Temperature'].mean()
+        p0 = fit_exponential_decay(df, C) + (C,)
+    lower = [0., tau_bounds[0], -50.]
+    upper = [np.inf, tau_bounds[1], y.min()]
+    # start strictly inside the bounds
+    p0 = np.clip(np.nan_to_num(np.asarray(p0, dtype=float), nan=1.), np.nextafter(lower, upper), np.nextafter(upper, lower))
+    try:
+        opt_parms, parm_cov, infodict, message, ier = sp.optimize.curve_fit(
+            exponential_decay, t, y, p0=p0, bounds=(lower, upper), jac=exponential_decay_jacobian,
+            max_nfev=maxfev, full_output=True)
+        converged, nfev = ier > 0, infodict['nfev']
+    except (RuntimeError, ValueError):
+        opt_parms, converged, nfev = np.full(3, np.nan), False, maxfev
+    A, tau, C = opt_parms
+    if full_output:
+        return A, tau, C, converged, nfev
+    return A, tau, C
+
+def fit_segments_nonlinear(df, segments, A, tau, **kwargs):
+    '''
+    nonlinear fits of many intervals, each seeded from its log-linear fit
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        internal and external air temperature indexed by timestamp.
+    segments : pandas DataFrame
+        rows of segment_statistics to fit.
+    A, tau : numpy array
+        log-linear estimates from fit_exponential_decay_segments.
+    **kwargs
+        passed to fit_exp_nonlinear.
+
+    Returns
+    -------
+    fits : pandas DataFrame
+        A, tau [s], C, convergence, function evaluations and fit time [s] of each interval.
+
+    '''
+    results = []
+    for start, end, C, A_seed, tau_seed in zip(segments['Start'], segments['End'],
+                                               segments['Mean external temperature'], A, tau):
+        fit_start = time.perf_counter()
+        fit = fit_exp_nonlinear(df.iloc[start:end], p0=(A_seed, tau_seed, C), full_output=True, **kwargs)
+        results.append(fit + (time.perf_counter() - fit_start,))
+    return pd.DataFrame(results, index=segments.index,
+                        columns=['A', 'tau', 'C', 'Converged', 'Function evaluations', 'Fit time [s]'])
+
+# version of the heat-off filter, which keys the cached cooling periods, so bump
+# it whenever filter_heat_off_periods or its thresholds change
+HEAT_OFF_FILTER_VERSION = 1
+
+def filter_heat_off_periods(EOH_house):
+    '''
+    identify time periods when the heat pump and any other heating is off,
+    it is colder outside than inside and indoor temperature is decreasing
+
+    Parameters
+    ----------
+    EOH_house : pandas DataFrame
+        Electrification of Heat trial data for one property indexed by timestamp.
+
+    Returns
+    -------
+    decreasing_temperature : pandas DataFrame or None
+        internal and external air temperature while cooling, or None if the
+        property has no heat pump output data.
+
+    '''
+    if 'Heat_Pump_Energy_Output' not in EOH_house.columns:
+        return None
+    # filter to exclude summer months
+    heating_season = pd.concat([EOH_house['11-2020':'04-2021'],EOH_house['10-2021':'04-2022']])
+    heat_pump_installed = heating_season[~heating_season['Heat_Pump_Energy_Output'].isna()]
+    
+    #%% heat pump energy output not increasing (heat pump off)
+    heat_off = heat_pump_installed[(heat_pump_installed['Heat_Pump_Energy_Output'].diff()==0.)&(heat_pump_installed['Heat_Pump_Heating_Flow_Temperature'].diff()<=0.)]
+
+    # check if boiler or backup heater is on if installed
+    if 'Boiler_Energy_Output' in heat_off.columns:
+        heat_off = heat_off[heat_off['Boiler_Energy_Output'].diff()==0.]
+    
+    if 'Back-up_Heater_Energy_Consumed' in heat_off.columns:
+        heat_off = heat_off[heat_off['Back-up_Heater_Energy_Consumed'].diff()==0.]
+    
+    if 'Immersion_Heater_Energy_Consumed' in heat_off.columns:
+        heat_off = heat_off[heat_off['Immersion_Heater_Energy_Consumed'].diff()==0.]
         
-        #%% fit exponential decay
-        tau_list = []
-        A_list = []
-        C_list = []
-        for df_interval in separate_dataframes:
-            
-            C = df_interval['External_Air_Temperature'].mean()
-            C_list.append(C)
-            A, tau = fit_exponential_decay(df_interval, C)
-                        
-            tau_list.append(tau/3600) # convert tau to hours
-            A_list.append(A)
-            x_fit = np.linspace(0, (df_interval.index - df_interval.index.min()).to_series().dt.total_seconds().max(), 100)
-            y_fit = exponential_decay(x_fit, A, tau, C)
-            
-        tau_series = pd.Series(tau_list)
+    # colder outside than inside-- only get winter!!!
+    colder_outside = heat_off[heat_off['External_Air_Temperature']<heat_off['Internal_Air_Temperature']]
+    # ensure outside of house is below 15.5 C
+    colder_outside = colder_outside[colder_outside['External_Air_Temperature']<15.5]
+    # when temperature is decreasing
+    decreasing_temperature = colder_outside[colder_outside['Internal_Air_Temperature'].diff()<=0.]
+    # exclude rapid decreases in temperature -- assume door/window was opened
+    decreasing_temperature = decreasing_temperature[decreasing_temperature['Internal_Air_Temperature'].diff()>-5.]
+    return decreasing_temperature[['Internal_Air_Temperature','External_Air_Temperature']]
+
+def property_id(file):
+    return os.path.basename(file.replace('\\', '/')).removeprefix('Property_ID=').removesuffix('.csv')
+
+def load_decreasing_temperature(file, cache_dir='Resources/EoH cache'):
+    '''
+    read and filter one trial property, caching the filtered cooling periods as
+    Parquet keyed on the name, size and modification time of the CSV file and
+    the version of the heat-off filter
+
+    Parameters
+    ----------
+    file : str
+        Electrification of Heat trial CSV file.
+    cache_dir : str, optional
+        folder for cached cooling periods. The default is 'Resources/EoH cache'.
+
+    Returns
+    -------
+    decreasing_temperature : pandas DataFrame or None
+        output of filter_heat_off_periods.
+
+    '''
+    key = combined_hash(file_signature_hash([file]), HEAT_OFF_FILTER_VERSION)
+    cache_file = os.path.join(cache_dir, f'{property_id(file)}_{key}')
+    if os.path.exists(cache_file + '.parquet'):
+        return pd.read_parquet(cache_file + '.parquet')
+    if os.path.exists(cache_file + '.no_heat_pump'):
+        return None
+    
+    print('Reading '+file)
+    EOH_house = pd.read_csv(file, parse_dates=['Timestamp'],index_col='Timestamp')
+    decreasing_temperature = filter_heat_off_periods(EOH_house)
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    if decreasing_temperature is None:
+        open(cache_file + '.no_heat_pump', 'w').close()
+    else:
+        decreasing_temperature.to_parquet(cache_file + '.parquet')
+    return decreasing_temperature
+
+def property_time_constants(file, duration_list, cache_dir='Resources/EoH cache', fit_method='log-linear'):
+    '''
+    mean thermal time constant of one trial property for each minimum interval
+    duration, reading the property's data only once
+
+    Parameters
+    ----------
+    file : str
+        Electrification of Heat trial CSV file.
+    duration_list : list of int
+        minimum number of minutes in a cooling interval.
+    cache_dir : str, optional
+        folder for cached cooling periods. The default is 'Resources/EoH cache'.
+    fit_method : str, optional
+        'log-linear' to fit with C fixed at the mean external air temperature or
+        'nonlinear' to also fit C, seeded from the log-linear fit. The default
+        is 'log-linear'.
+
+    Returns
+    -------
+    house_taus : pandas Series
+        mean time constant in hours for each duration, excluding intervals more
+        than 3 standard deviations from the mean.
+    fits : pandas DataFrame
+        fit results and statistics for each interval.
+
+    '''
+    decreasing_temperature = load_decreasing_temperature(file, cache_dir)
+    house_taus = pd.Series(np.nan, index=duration_list, name=property_id(file))
+    if decreasing_temperature is None:
+        return house_taus, pd.DataFrame()
+    
+    #%% section off consecutive time periods and fit each usable one once
+    segments = segment_statistics(decreasing_temperature)
+    segments = segments[segments['Usable']]
+    fit_start = time.perf_counter()
+    A, tau = fit_exponential_decay_segments(decreasing_temperature, segments)
+    if fit_method == 'nonlinear':
+        fits = fit_segments_nonlinear(decreasing_temperature, segments, A, tau)
+    elif fit_method == 'log-linear':
+        fits = pd.DataFrame({'A': A, 'tau': tau, 'C': segments['Mean external temperature'],
+                             'Converged': np.isfinite(tau), 'Function evaluations': 0,
+                             'Fit time [s]': (time.perf_counter() - fit_start)/max(len(segments), 1)},
+                            index=segments.index)
+    else:
+        raise ValueError(f'Unknown fit method {fit_method}')
+    fits.insert(0, 'Property', house_taus.name)
+    fits.insert(1, 'Length', segments['Length'])
+    segment_taus = fits['tau'].to_numpy()/3600 # convert tau to hours
+    
+    for duration in duration_list:
+        tau_series = pd.Series(segment_taus[segments['Length'].to_numpy() >= duration], dtype=float)
         tau_series = tau_series.mask(tau_series.sub(tau_series.mean()).div(tau_series.std()).abs().gt(3))
-        house_tau_list.append(tau_series.mean())
-        house_tau_variation_list.append(tau_series.std())
-        
-    tau_df[duration] = house_tau_list
+        house_taus[duration] = tau_series.mean()
+    return house_taus, fits
+
+
+def main(parameters=None):
+    '''
+    fit thermal time constants of every Electrification of Heat trial property
+    and save them with fit statistics
+
+    Parameters
+    ----------
+    parameters : dict, optional
+        EoH_time_constants stage parameters. The default is None, which uses
+        stage_parameters('EoH_time_constants').
+
+    Returns
+    -------
+    None.
+
+    '''
+    if parameters is None:
+        parameters = stage_parameters('EoH_time_constants')
+
+    # find all samples
+    dataset_1 = glob.glob('Data/Electrification of Heat/Dataset 1/*.csv')
+    dataset_2 = glob.glob('Data/Electrification of Heat/Dataset 2/*.csv')
+    all_files = dataset_1 + dataset_2
+    duration_list = parameters['durations']
+    # 'log-linear' or 'nonlinear'
+    fit_method = parameters['fit_method']
+    
+    # each property is read and filtered once, in parallel, and all durations
+    # are evaluated from its cached cooling periods
+    with step('fit properties'), ProcessPoolExecutor() as executor:
+        results = list(executor.map(property_time_constants, all_files,
+                                    [duration_list]*len(all_files),
+                                    ['Resources/EoH cache']*len(all_files),
+                                    [fit_method]*len(all_files)))
+    
+    with step('write results'):
+        tau_df = pd.DataFrame([house_taus for house_taus, _ in results])
+        tau_df.to_csv('Resources/EoH time constants.csv')
+    
+        fit_stats = pd.concat([fits for _, fits in results], ignore_index=True)
+        fit_stats.to_csv(f'Resources/EoH {fit_method} fit statistics.csv')
+    print(f'{fit_method} fits: {fit_stats["Converged"].sum()} of {len(fit_stats)} intervals converged, '
+          f'median {fit_stats["Function evaluations"].median()} function evaluations, '
+          f'{fit_stats["Fit time [s]"].sum():.1f} s total fit time')
+
+
+if __name__ == "__main__":
 
-tau_df.to_csv('Resources/EoH time constants.csv')
\ No newline at end of file
+    with instrumented_run('EoH_time_constants'):
+        main()
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the hot paths of GeoHeatFlex on synthetic inputs at the scale of the
+real ones, which are licensed downloads: a 1 km grid over a 700 x 1250 km
+domain with daily time steps, about 42,000 Voronoi regions, and minute
+resolution heat pump trial records. Each benchmark runs in a fresh process so
+its peak resident memory can be measured, and the best time, throughput and
+peak memory of every run are appended to a JSON history. A benchmark that is
+slower than the median of earlier comparable runs by more than a tolerance is
+reported as a regression.
+
+Usage: python benchmarks.py [benchmark ...] [--scale S] [--days N] [--repeat N]
+                            [--history FILE] [--tolerance T]
+
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+HISTORY_FILE = 'Resources/benchmark history.json'
+FIXTURE_DIR = 'Resources/benchmark fixtures'
+
+# full-scale fixture sizes; --scale shrinks the grid and number of regions together
+GRID_SHAPE = (1250, 700) # y, x in 1 km cells
+N_REGIONS = 42000
+N_PROPERTIES = 4
+PROPERTY_DAYS = 90
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where peak memory is not recorded
+    resource = None
+
+def peak_rss():
+    '''
+    peak resident memory of this process in MB, or None where it cannot be
+    measured
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+
+#%% synthetic fixtures
+
+def synthetic_temperature(n_days=30, shape=GRID_SHAPE, start='2017-12-01', seed=0):
+    '''
+    daily mean temperature on a 1 km grid in British National Grid coordinates,
+    with a north-south gradient, a seasonal cycle, spatially smooth daily
+    weather and NaN sea cells outside an irregular land mask, as in HadUK-Grid
+
+    Parameters
+    ----------
+    n_days : int, optional
+        number of days. The default is 30.
+    shape : tuple, optional
+        number of cells in y and x. The default is GRID_SHAPE.
+    start : str, optional
+        first day. The default is '2017-12-01'.
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    mean_temperature : XArray DataArray
+        (time, projection_y_coordinate, projection_x_coordinate) temperature in C.
+
+    '''
+    import xarray as xr
+    rng = np.random.default_rng(seed)
+    n_y, n_x = shape
+    y = np.arange(n_y)*1000. + 500.
+    x = np.arange(n_x)*1000. + 500.
+    time_index = pd.date_range(start, periods=n_days, freq='D')
+    north = (y/y[-1])[:, None]
+    # cooler to the north and inland, milder in the west
+    climate = 9. - 4.*north - 1.5*(x/x[-1])[None, :]
+    season = -5.*np.cos(2*np.pi*(time_index.dayofyear.to_numpy() - 15)/365.25)
+    # smooth daily weather from a few large-scale waves
+    weather = np.zeros((n_days, n_y, n_x), dtype=float)
+    for _ in range(4):
+        k_y, k_x = rng.uniform(1, 4, 2)/np.array([y[-1], x[-1]])
+        phase = rng.uniform(0, 2*np.pi, (n_days, 1, 1))
+        amplitude = rng.normal(0, 1.5, (n_days, 1, 1))
+        weather += amplitude*np.sin(2*np.pi*(k_y*y[None, :, None] + k_x*x[None, None, :]) + phase)
+    temperature = climate[None] + season[:, None, None] + weather
+    # irregular island so some regions fall outside the grid's land cells
+    radius = 0.45 + 0.05*np.sin(6*np.arctan2(north - 0.5, (x/x[-1])[None, :] - 0.5))
+    land = (north - 0.5)**2/0.25 + ((x/x[-1])[None, :] - 0.5)**2/0.25 < 4*radius**2
+    temperature[:, ~land] = np.nan
+    return xr.DataArray(temperature, dims=('time', 'projection_y_coordinate', 'projection_x_coordinate'),
+                        coords={'time': time_index, 'projection_y_coordinate': y,
+                                'projection_x_coordinate': x},
+                        name='mean_temperature')
+
+def synthetic_regions(n_regions=N_REGIONS, shape=GRID_SHAPE, seed=0, cache_dir=FIXTURE_DIR):
+    '''
+    Voronoi regions over the grid domain, denser around a few urban centres as
+    LSOAs and DZs are, indexed by code. Cached as GeoParquet.
+
+    Parameters
+    ----------
+    n_regions : int, optional
+        number of regions. The default is N_REGIONS.
+    shape : tuple, optional
+        number of 1 km cells in y and x covered by the regions. The default is GRID_SHAPE.
+    seed : int, optional
+        random seed. The default is 0.
+    cache_dir : str, optional
+        folder for cached fixtures. The default is FIXTURE_DIR.
+
+    Returns
+    -------
+    regions : geodataframe
+        regions in EPSG:27700.
+
+    '''
+    import geopandas as gpd
+    import shapely
+    filename = os.path.join(cache_dir, f'regions_{n_regions}_{shape[0]}x{shape[1]}_{seed}.parquet')
+    if os.path.exists(filename):
+        return gpd.read_parquet(filename)
+    rng = np.random.default_rng(seed)
+    height, width = shape[0]*1000., shape[1]*1000.
+    centres = rng.uniform((0, 0), (width, height), (20, 2))
+    urban = rng.integers(0, len(centres), n_regions//2)
+    points = np.concatenate([centres[urban] + rng.normal(0, 0.02*width, (len(urban), 2)),
+                             rng.uniform((0, 0), (width, height), (n_regions - len(urban), 2))])
+    # regions slightly beyond the grid, as coastal regions beyond HadUK-Grid land cells are
+    domain = shapely.box(-0.01*width, -0.01*height, 1.01*width, 1.01*height)
+    points = np.clip(points, domain.bounds[:2], domain.bounds[2:])
+    polygons = shapely.voronoi_polygons(shapely.multipoints(points), extend_to=domain)
+    polygons = shapely.intersection(np.asarray(polygons.geoms), domain)
+    regions = gpd.GeoDataFrame(geometry=polygons, crs='EPSG:27700',
+                               index=pd.Index([f'R{i:08d}' for i in range(len(polygons))], name='code'))
+    os.makedirs(cache_dir, exist_ok=True)
+    regions.to_parquet(filename)
+    return regions
+
+def synthetic_heat_pump_data(n_days=PROPERTY_DAYS, start='2020-11-01', seed=0):
+    '''
+    minute resolution record of one heat pump trial property, with heating
+    cycles followed by off periods in which indoor temperature decays
+    exponentially towards a slowly varying outdoor temperature
+
+    Parameters
+    ----------
+    n_days : int, optional
+        number of days. The default is PROPERTY_DAYS.
+    start : str, optional
+        first timestamp, within the trial heating seasons. The default is '2020-11-01'.
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    record : pandas DataFrame
+        columns of the Electrification of Heat trial data indexed by 'Timestamp'.
+
+    '''
+    rng = np.random.default_rng(seed)
+    n_minutes = n_days*1440
+    minutes = np.arange(n_minutes)
+    external = 5. + 1.5*np.sin(2*np.pi*minutes/1440) + np.cumsum(rng.normal(0, 0.01, n_minutes))
+    # alternating heating and off periods
+    durations = rng.integers(20, 120, n_minutes//20)
+    durations[1::2] = rng.integers(30, 480, len(durations[1::2]))
+    heating = np.repeat(np.arange(len(durations)) % 2 == 0, durations)[:n_minutes]
+    time_constant = rng.uniform(20, 60)*60 # minutes
+
+    internal = np.empty(n_minutes)
+    flow = np.empty(n_minutes)
+    temperature, flow_temperature = 20., 40.
+    for i in range(n_minutes):
+        if heating[i]:
+            temperature += 0.05*(21.5 - temperature)
+            flow_temperature = 45.
+        else:
+            temperature = external[i] + (temperature - external[i])*np.exp(-1/time_constant)
+            flow_temperature = temperature + 0.9*(flow_temperature - temperature)
+        internal[i] = temperature
+        flow[i] = flow_temperature
+    output = np.cumsum(heating*rng.uniform(0.02, 0.05, n_minutes))
+    record = pd.DataFrame({'Internal_Air_Temperature': np.floor(internal*100)/100,
+                           'External_Air_Temperature': np.round(external, 2),
+                           'Heat_Pump_Energy_Output': output,
+                           'Heat_Pump_Heating_Flow_Temperature': np.round(flow, 2)},
+                          index=pd.date_range(start, periods=n_minutes, freq='min', name='Timestamp'))
+    # occasional missing minutes split cooling periods, as in the trial data
+    return record.drop(record.index[rng.random(n_minutes) < 0.002])
+
+def write_synthetic_heat_pump_csvs(n_properties=N_PROPERTIES, n_days=PROPERTY_DAYS, seed=0,
+                                   cache_dir=FIXTURE_DIR):
+    '''
+    write synthetic trial property records as CSV files named like the trial data
+
+    Parameters
+    ----------
+    n_properties : int, optional
+        number of properties. The default is N_PROPERTIES.
+    n_days : int, optional
+        number of days for each property. The default is PROPERTY_DAYS.
+    seed : int, optional
+        random seed of the first property. The default is 0.
+    cache_dir : str, optional
+        folder for cached fixtures. The default is FIXTURE_DIR.
+
+    Returns
+    -------
+    files : list of str
+        CSV files, one for each property.
+
+    '''
+    folder = os.path.join(cache_dir, f'heat_pumps_{n_days}_days')
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    for i in range(n_properties):
+        file = os.path.join(folder, f'Property_ID=SYN{seed + i:05d}.csv')
+        if not os.path.exists(file):
+            synthetic_heat_pump_data(n_days, seed=seed + i).to_csv(file)
+        files.append(file)
+    return files
+
+#%% benchmarks
+
+def _scaled(settings):
+    scale = settings['scale']
+    shape = tuple(max(2, int(round(n*scale**0.5))) for n in GRID_SHAPE)
+    return shape, max(10, int(round(N_REGIONS*scale)))
+
+def _regions(settings):
+    shape, n_regions = _scaled(settings)
+    return synthetic_regions(n_regions, shape)
+
+def _cooling_records(settings):
+    from EoH_time_constants import filter_heat_off_periods
+    n_properties = max(1, int(round(N_PROPERTIES*settings['scale'])))
+    files = write_synthetic_heat_pump_csvs(n_properties)
+    return [filter_heat_off_periods(pd.read_csv(file, parse_dates=['Timestamp'], index_col='Timestamp'))
+            for file in files]
+
+def setup_HDDs(settings):
+    from calculate_regional_HDDs import HDDs
+    shape, _ = _scaled(settings)
+    temperature = synthetic_temperature(settings['days'], shape)
+    return (lambda: HDDs(temperature, 15.5)), temperature.size, 'cell-days'
+
+def setup_assign_gridded_values_to_regions(settings, method='representative_point'):
+    from calculate_regional_HDDs import HDDs, assign_gridded_values_to_regions
+    shape, _ = _scaled(settings)
+    gridded_HDDs = HDDs(synthetic_temperature(settings['days'], shape), 15.5)
+    regions = _regions(settings)
+    # the grid index and adjacency are built in each call, as on a first run
+    run = lambda: assign_gridded_values_to_regions(gridded_HDDs, 'HDDs', regions[['geometry']].copy(),
+                                                   method=method)
+    return run, len(regions), 'regions'
+
+def setup_assign_gridded_values_to_regions_area_weighted(settings):
+    return setup_assign_gridded_values_to_regions(settings, 'area_weighted')
+
+def setup_fill_na_with_neighboring_mean(settings):
+    from calculate_regional_HDDs import fill_na_with_neighboring_mean
+    regions = _regions(settings)
+    rng = np.random.default_rng(0)
+    values = rng.normal(3000, 300, len(regions))
+    values[rng.random(len(regions)) < 0.05] = np.nan
+    run = lambda: fill_na_with_neighboring_mean(regions.assign(HDDs=values), 'HDDs')
+    return run, len(regions), 'regions'
+
+def setup_calculate_heat_free_hours(settings):
+    from calculate_flexibility_duration import calculate_heat_free_hours
+    _, n_regions = _scaled(settings)
+    rng = np.random.default_rng(0)
+    columns = [f'Temperature {i}' for i in range(6)]
+    regions = pd.DataFrame(rng.normal(2., 3., (n_regions, len(columns))), columns=columns)
+    regions['Thermal time constant [h]'] = rng.lognormal(np.log(40.), 0.3, n_regions)
+    return (lambda: calculate_heat_free_hours(regions.copy(), columns)), n_regions*len(columns), 'region-scenarios'
+
+def setup_break_into_intervals(settings):
+    from EoH_time_constants import break_into_intervals
+    records = _cooling_records(settings)
+    run = lambda: [break_into_intervals(record, 60) for record in records]
+    return run, sum(len(record) for record in records), 'minutes'
+
+def setup_fit_exponential_decay(settings):
+    from EoH_time_constants import break_into_intervals, fit_exponential_decay
+    intervals = [interval for record in _cooling_records(settings)
+                 for interval in break_into_intervals(record, 60)]
+    # outdoor temperature is taken as the asymptote, as in property_time_constants
+    run = lambda: [fit_exponential_decay(interval, interval['External_Air_Temperature'].mean())
+                   for interval in intervals]
+    return run, len(intervals), 'intervals'
+
+# each setup builds its fixtures and returns a function to time, the number of
+# items it processes and their unit
+BENCHMARKS = {
+    'HDDs': setup_HDDs,
+    'assign_gridded_values_to_regions': setup_assign_gridded_values_to_regions,
+    'assign_gridded_values_to_regions area_weighted': setup_assign_gridded_values_to_regions_area_weighted,
+    'fill_na_with_neighboring_mean': setup_fill_na_with_neighboring_mean,
+    'calculate_heat_free_hours': setup_calculate_heat_free_hours,
+    'break_into_intervals': setup_break_into_intervals,
+    'fit_exponential_decay': setup_fit_exponential_decay,
+    }
+
+def run_benchmark(name, settings, repeat=3):
+    '''
+    time one benchmark in the current process
+
+    Parameters
+    ----------
+    name : str
+        name of benchmark in BENCHMARKS.
+    settings : dict
+        fixture 'scale' and number of 'days'.
+    repeat : int, optional
+        number of timed runs; the fastest is kept. The default is 3.
+
+    Returns
+    -------
+    result : dict
+        best and median time in seconds, throughput in items per second, and
+        peak resident memory in MB before and after the timed runs.
+
+    '''
+    run, n_items, unit = BENCHMARKS[name](settings)
+    fixture_rss = peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {'items': n_items, 'unit': unit, 'best [s]': best, 'median [s]': float(np.median(times)),
+            'throughput [items/s]': n_items/best, 'fixture peak RSS [MB]': fixture_rss,
+            'peak RSS [MB]': peak_rss()}
+
+def _isolated(name, settings, repeat):
+    # a fresh process for each benchmark so peak memory is its own
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_benchmark, name, settings, repeat).result()
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def regressions(record, history, tolerance=0.2, window=5):
+    '''
+    benchmarks in a run slower than the median of earlier comparable runs
+
+    Parameters
+    ----------
+    record : dict
+        run from run_benchmarks.
+    history : list of dict
+        earlier runs.
+    tolerance : float, optional
+        allowed fractional slowdown. The default is 0.2.
+    window : int, optional
+        number of most recent comparable runs compared against. The default is 5.
+
+    Returns
+    -------
+    slower : dict
+        ratio of best time to the earlier median for each regressed benchmark.
+
+    '''
+    slower = {}
+    for name, result in record['results'].items():
+        earlier = [run['results'][name]['best [s]'] for run in history
+                   if run['settings'] == record['settings'] and run['machine'] == record['machine']
+                   and name in run['results']][-window:]
+        if earlier:
+            ratio = float(result['best [s]']/np.median(earlier))
+            if ratio > 1 + tolerance:
+                slower[name] = ratio
+    return slower
+
+def run_benchmarks(names=None, scale=1., days=30, repeat=3, history_file=HISTORY_FILE, tolerance=0.2):
+    '''
+    run benchmarks, append the results to the history and report regressions
+
+    Parameters
+    ----------
+    names : list of str, optional
+        benchmarks to run. The default is None, which runs all of BENCHMARKS.
+    scale : float, optional
+        fraction of the full number of grid cells, regions and properties. The
+        default is 1.
+    days : int, optional
+        number of days of gridded temperature. The default is 30.
+    repeat : int, optional
+        number of timed runs of each benchmark. The default is 3.
+    history_file : str, optional
+        JSON file of earlier runs. The default is HISTORY_FILE.
+    tolerance : float, optional
+        allowed fractional slowdown before a regression is reported. The default is 0.2.
+
+    Returns
+    -------
+    record : dict
+        settings, environment and results of this run.
+    slower : dict
+        ratio of best time to the earlier median for each regressed benchmark.
+
+    '''
+    names = names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise KeyError(f'unknown benchmark {name}; benchmarks are {", ".join(BENCHMARKS)}')
+    settings = {'scale': scale, 'days': days}
+    record = {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+              'commit': _git_commit(),
+              'machine': f'{platform.node()} {platform.machine()}',
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'settings': settings,
+              'results': {}}
+    for name in names:
+        result = _isolated(name, settings, repeat)
+        record['results'][name] = result
+        print(f'{name}: {result["best [s]"]:.3f} s, {result["throughput [items/s]"]:.4g} '
+              f'{result["unit"]}/s, peak RSS {result["peak RSS [MB]"] or float("nan"):.0f} MB')
+
+    history = []
+    if os.path.exists(history_file):
+        with open(history_file) as f:
+            history = json.load(f)
+    slower = regressions(record, history, tolerance)
+    for name, ratio in slower.items():
+        print(f'regression: {name} is {ratio:.2f} times slower than recent runs')
+    os.makedirs(os.path.dirname(history_file) or '.', exist_ok=True)
+    with open(history_file, 'w') as f:
+        json.dump(history + [record], f, indent=1)
+    return record, slower
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark GeoHeatFlex hot paths on synthetic inputs.')
+    parser.add_argument('benchmarks', nargs='*', help=f'benchmarks to run: {", ".join(BENCHMARKS)}. Default is all.')
+    parser.add_argument('--scale', type=float, default=1., help='fraction of full-scale grid cells, regions and properties')
+    parser.add_argument('--days', type=int, default=30, help='days of gridded temperature')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each benchmark')
+    parser.add_argument('--history', default=HISTORY_FILE, help='JSON file of earlier runs')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fractional slowdown')
+    arguments = parser.parse_args()
+
+    _, slower = run_benchmarks(arguments.benchmarks or None, arguments.scale, arguments.days,
+                               arguments.repeat, arguments.history, arguments.tolerance)
+    sys.exit(1 if slower else 0)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Content hashing helpers used to key cached intermediate results on the inputs
+they were derived from.
+
+"""
+
+import glob
+import hashlib
+import os
+import numpy as np
+
+def file_hash(path, chunk_size=2**20):
+    '''
+    hash the contents of a file. Shapefiles are hashed together with their
+    sidecar files (.dbf, .shx, .prj, ...), which share the same stem.
+
+    Parameters
+    ----------
+    path : str
+        path to file.
+    chunk_size : int, optional
+        number of bytes read at a time. The default is 2**20.
+
+    Returns
+    -------
+    digest : str
+        hexadecimal content hash.
+
+    '''
+    if path.lower().endswith('.shp'):
+        paths = sorted(glob.glob(os.path.splitext(path)[0] + '.*'))
+    else:
+        paths = [path]
+    hasher = hashlib.blake2b(digest_size=16)
+    for component in paths:
+        hasher.update(os.path.basename(component).encode())
+        with open(component, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+def array_hash(*arrays):
+    '''
+    hash the values, shapes and dtypes of one or more arrays.
+
+    Parameters
+    ----------
+    *arrays : array-like
+        arrays to hash.
+
+    Returns
+    -------
+    digest : str
+        hexadecimal content hash.
+
+    '''
+    hasher = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        if array.dtype == object:
+            array = array.astype(str)
+        hasher.update(str((array.shape, array.dtype.str)).encode())
+        hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+def combined_hash(*digests):
+    '''
+    combine several hashes or other strings into one key.
+
+    Parameters
+    ----------
+    *digests : str
+        hashes or strings to combine.
+
+    Returns
+    -------
+    digest : str
+        hexadecimal content hash.
+
+    '''
+    hasher = hashlib.blake2b(digest_size=16)
+    for digest in digests:
+        hasher.update(str(digest).encode())
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+def file_signature_hash(paths):
+    '''
+    hash the names, sizes and modification times of files. This is much cheaper
+    than hashing their contents for large raw datasets that are not edited in
+    place.
+
+    Parameters
+    ----------
+    paths : list of str
+        paths to files.
+
+    Returns
+    -------
+    digest : str
+        hexadecimal hash.
+
+    '''
+    signatures = []
+    for path in sorted(paths):
+        stat = os.stat(path)
+        signatures.append(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return combined_hash(*signatures)
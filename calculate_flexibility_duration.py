@@ -10,13 +10,181 @@ time constant for each region.
 
 """
 
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import math
+import numpy as np
 import xarray as xr
-from calculate_regional_HDDs import assign_gridded_values_to_regions
+from calculate_regional_HDDs import (assign_gridded_fields_to_regions, fill_na_with_neighboring_mean,
+                                     neighbour_adjacency, region_grid_index)
+from instrumentation import dask_report, instrumented_run, step
+from pipeline import plots_enabled, stage_parameters
+from pipeline_io import REGISTRY_FILE, attach_geometry, read_table
+from temperature_store import load_mean_temperature
+from tiling import run_tiled, tiled_quantiles
+
+def _quantiles_along_last_axis(values, quantiles):
+    return np.moveaxis(np.quantile(values, quantiles, axis=-1), 0, -1)
+
+def _histogram_quantiles(blocks, n_cells, quantiles, bin_edges):
+    '''
+    approximate quantiles of each column of a (time, cell) array streamed in
+    time blocks, from per-cell histograms plus exact minima and maxima
+    '''
+    n_bins = len(bin_edges) - 1
+    counts = np.zeros((n_cells, n_bins), dtype=np.int64)
+    minimum = np.full(n_cells, np.inf)
+    maximum = np.full(n_cells, -np.inf)
+    has_nan = np.zeros(n_cells, dtype=bool)
+    for block in blocks:
+        has_nan |= np.isnan(block).any(axis=0)
+        minimum = np.fmin(minimum, np.nanmin(block, axis=0, initial=np.inf))
+        maximum = np.fmax(maximum, np.nanmax(block, axis=0, initial=-np.inf))
+        valid = ~np.isnan(block)
+        bin_index = np.clip(np.searchsorted(bin_edges, block[valid], side='right') - 1, 0, n_bins - 1)
+        cell_index = np.broadcast_to(np.arange(n_cells), block.shape)[valid]
+        counts += np.bincount(cell_index*n_bins + bin_index, minlength=n_cells*n_bins).reshape(n_cells, n_bins)
+    # cells with no values, such as sea cells, have infinite minima and maxima
+    # and are left as NaN
+    cells = np.flatnonzero(counts.sum(axis=1) > 0)
+    counts, minimum, maximum = counts[cells], minimum[cells], maximum[cells]
+    cumulative = np.cumsum(counts, axis=1)
+    n_values = cumulative[:, -1]
+    rows = np.arange(len(cells))
+    
+    def order_statistic(rank):
+        # place the values in a bin evenly through it
+        bin_index = np.minimum((cumulative <= rank[:, None]).sum(axis=1), n_bins - 1)
+        in_bin = counts[rows, bin_index]
+        below = cumulative[rows, bin_index] - in_bin
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = (rank - below + 0.5)/in_bin
+        estimate = bin_edges[bin_index] + fraction*(bin_edges[bin_index + 1] - bin_edges[bin_index])
+        return np.clip(estimate, minimum, maximum)
+    
+    # interpolate between order statistics in the same way as numpy's default quantile
+    result = np.full((n_cells, len(quantiles)), np.nan)
+    for i, q in enumerate(quantiles):
+        rank = q*(n_values - 1)
+        lower = np.floor(rank)
+        lower_value = order_statistic(lower)
+        upper_value = order_statistic(np.minimum(lower + 1, n_values - 1))
+        result[cells, i] = lower_value + (rank - lower)*(upper_value - lower_value)
+    result[cells[:, None], np.flatnonzero(np.asarray(quantiles) == 0.)] = minimum[:, None]
+    result[cells[:, None], np.flatnonzero(np.asarray(quantiles) == 1.)] = maximum[:, None]
+    result[has_nan] = np.nan
+    return result
+
+def temperature_quantiles(temperature, quantiles, method='exact', tile_size=125,
+                          bin_edges=np.arange(-40., 40.05, 0.1), block_size=366,
+                          x_dim='projection_x_coordinate', y_dim='projection_y_coordinate'):
+    '''
+    calculate several quantiles of temperature over time for each grid cell in
+    one pass over each spatial tile. As with DataArray.quantile with
+    skipna=False, cells with any NaN give NaN, and quantiles 0 and 1 are the
+    minimum and maximum.
+
+    Parameters
+    ----------
+    temperature : XArray DataArray
+        gridded temperature with a time dimension.
+    quantiles : list of float
+        quantiles to calculate, between 0 and 1.
+    method : str, optional
+        'exact' for numpy's linear quantiles of the full record per tile, or
+        'histogram' for bounded-memory approximate quantiles from per-cell
+        histograms accumulated over blocks of time. The default is 'exact'.
+    tile_size : int, optional
+        number of grid cells along each side of a spatial tile. The default is 125.
+    bin_edges : numpy array, optional
+        histogram bin edges for the 'histogram' method, which sets its accuracy.
+        The default is 0.1 C bins from -40 C to 40 C.
+    block_size : int, optional
+        number of time steps read at once by the 'histogram' method. The default is 366.
+    x_dim : string, optional
+        name of the x dimension. The default is 'projection_x_coordinate'.
+    y_dim : string, optional
+        name of the y dimension. The default is 'projection_y_coordinate'.
+
+    Returns
+    -------
+    temperature_quantiles : XArray DataArray
+        temperature with a leading quantile dimension in place of time.
+
+    '''
+    quantiles = np.asarray(quantiles, dtype=float)
+    temperature = temperature.transpose('time', y_dim, x_dim)
+    if method == 'exact':
+        # the whole record of one tile at a time, with all quantiles from one sort
+        tiled = temperature.chunk({'time': -1, y_dim: tile_size, x_dim: tile_size})
+        result = xr.apply_ufunc(_quantiles_along_last_axis, tiled,
+                                kwargs={'quantiles': quantiles},
+                                input_core_dims=[['time']], output_core_dims=[['quantile']],
+                                dask='parallelized', output_dtypes=[float],
+                                dask_gufunc_kwargs={'output_sizes': {'quantile': len(quantiles)}})
+        return result.assign_coords(quantile=quantiles).transpose('quantile', y_dim, x_dim).compute()
+    elif method == 'histogram':
+        ny, nx = temperature.sizes[y_dim], temperature.sizes[x_dim]
+        result = np.empty((len(quantiles), ny, nx))
+        for y0 in range(0, ny, tile_size):
+            for x0 in range(0, nx, tile_size):
+                tile = temperature.isel({y_dim: slice(y0, y0 + tile_size), x_dim: slice(x0, x0 + tile_size)})
+                tile_shape = tile.shape[1:]
+                blocks = (tile.isel(time=slice(t0, t0 + block_size)).values.reshape(-1, np.prod(tile_shape))
+                          for t0 in range(0, tile.sizes['time'], block_size))
+                tile_quantiles = _histogram_quantiles(blocks, np.prod(tile_shape), quantiles, bin_edges)
+                result[:, y0:y0 + tile_shape[0], x0:x0 + tile_shape[1]] = tile_quantiles.T.reshape((-1,) + tile_shape)
+        return xr.DataArray(result, dims=('quantile', y_dim, x_dim),
+                            coords={'quantile': quantiles, y_dim: temperature[y_dim], x_dim: temperature[x_dim]})
+    raise ValueError(f'Unknown quantile method {method}')
+
+def heat_free_hours(time_constants, outdoor_temperature, initial_temp=21., final_temp=18.):
+    '''
+    calculate comfortable heat-free hours based on Newton's law of cooling for
+    many regions and outdoor temperature scenarios in one broadcast.
+
+    Where the outdoor temperature is at or above the final temperature, indoor
+    temperature never falls to the final temperature and heat-free hours are
+    infinite. Where the final temperature is at or above the initial
+    temperature, heat-free hours are zero.
+
+    Parameters
+    ----------
+    time_constants : array-like
+        (region,) thermal time constants in hours.
+    outdoor_temperature : float or array-like
+        outdoor temperature: a scalar, a (scenario,) array shared by all
+        regions or a (region, scenario) array.
+    initial_temp : float or array-like, optional
+        initial indoor temperature, or a grid of them that broadcasts against
+        the result, e.g. with shape (setpoint, 1, 1). The default is 21..
+    final_temp : float or array-like, optional
+        final indoor temperature, or a grid of them. The default is 18..
+
+    Returns
+    -------
+    hours : numpy array
+        heat-free hours with shape (..., region) for a scalar outdoor
+        temperature or (..., region, scenario) otherwise.
 
-def calculate_heat_free_hours(gdf,temperature_column,initial_temp=21.,final_temp=18.):
+    '''
+    time_constants = np.asarray(time_constants, dtype=float)
+    outdoor_temperature = np.asarray(outdoor_temperature, dtype=float)
+    if outdoor_temperature.ndim == 1:
+        outdoor_temperature = outdoor_temperature[np.newaxis, :]
+    if outdoor_temperature.ndim == 2:
+        time_constants = time_constants[:, np.newaxis]
+    initial_temp = np.asarray(initial_temp, dtype=float)
+    final_temp = np.asarray(final_temp, dtype=float)
+    # work in place on one full-size array to keep memory down for many scenarios
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log_ratio = np.log((final_temp - outdoor_temperature)/(initial_temp - outdoor_temperature))
+        hours = np.multiply(-time_constants, log_ratio)
+    np.copyto(hours, np.inf, where=outdoor_temperature >= final_temp)
+    np.copyto(hours, 0., where=final_temp >= initial_temp)
+    # NaN time constants or temperatures stay NaN
+    np.copyto(hours, np.nan, where=np.isnan(time_constants))
+    np.copyto(hours, np.nan, where=np.isnan(outdoor_temperature))
+    return hours
+
+def calculate_heat_free_hours(gdf,temperature_columns,initial_temp=21.,final_temp=18.):
     '''
     calculate comfortable heat-free hours based on Newton's law of cooling.
 
@@ -24,38 +192,66 @@ def calculate_heat_free_hours(gdf,temperature_column,initial_temp=21.,final_temp
     ----------
     gdf : geodataframe
         geodataframe including 'Thermal time constant [h]' column.
-    temperature_column : str
-        name of column in gdf with outdoor temperature.
+    temperature_columns : str or list of str
+        name(s) of column(s) in gdf with outdoor temperature.
     initial_temp : float, optional
         initial indoor temperature. The default is 21..
-    final_temp : TYPE, optional
+    final_temp : float, optional
         final indoor temperature. The default is 18..
 
     Returns
     -------
     gdf : geodataframe
-        geodataframe with heat-free hours column added.
+        geodataframe with heat-free hours column(s) added.
 
     '''
-    gdf[temperature_column + ' heat-free hours']=[-gdf.at[region,'Thermal time constant [h]']*\
-        math.log((final_temp-gdf.at[region, temperature_column]
-                  )/(initial_temp-gdf.at[region, temperature_column])) for region in gdf.index]
+    if isinstance(temperature_columns, str):
+        temperature_columns = [temperature_columns]
+    hours = heat_free_hours(gdf['Thermal time constant [h]'], gdf[temperature_columns],
+                            initial_temp, final_temp)
+    for i, temperature_column in enumerate(temperature_columns):
+        gdf[temperature_column + ' heat-free hours'] = hours[:, i]
     return gdf
     
-def map_heat_free_hours(gdf, heat_free_hours_column, vmin, vmax, cmap='inferno'):
-    fig, ax = plt.subplots()
-    regions.plot(column = heat_free_hours_column,
-             ax = ax,
-             legend= True,
-             legend_kwds = {'label':'Heat-free hours'},
-             cmap = cmap,
-             vmin=vmin,
-             vmax=vmax,
-             missing_kwds={'color': 'lightgrey'})
-    plt.axis("off")
-    plt.savefig(f'Plots/{heat_free_hours_column}.jpg', dpi=1000)
-
-def colormap_histogram(series, vmin, vmax, ax, cmap = plt.cm.inferno):
+def map_heat_free_hours(gdf, heat_free_hours_columns, vmin, vmax, cmap='inferno'):
+    '''
+    map heat-free hours in each region, rendering maps of several columns in
+    parallel
+
+    Parameters
+    ----------
+    gdf : pandas DataFrame
+        regions indexed by code with heat-free hours column(s).
+    heat_free_hours_columns : str or list of str
+        column(s) to map, each saved to Plots/<column>.jpg.
+    vmin : float
+        lower limit of colour scale.
+    vmax : float
+        upper limit of colour scale.
+    cmap : str, optional
+        colormap. The default is 'inferno'.
+
+    Returns
+    -------
+    None.
+
+    '''
+    from maps import render_maps
+    if isinstance(heat_free_hours_columns, str):
+        heat_free_hours_columns = [heat_free_hours_columns]
+    render_maps(gdf, [{'column': column,
+                       'filename': f'Plots/{column}.jpg',
+                       'cmap': cmap,
+                       'vmin': vmin,
+                       'vmax': vmax,
+                       'label': 'Heat-free hours',
+                       'dpi': 1000,
+                       'missing_color': 'lightgrey'} for column in heat_free_hours_columns])
+
+def colormap_histogram(series, vmin, vmax, ax, cmap = 'inferno'):
+    import matplotlib
+    if isinstance(cmap, str):
+        cmap = matplotlib.colormaps[cmap]
     n, bins, patches = ax.hist(
         series,
         bins= 50,
@@ -67,117 +263,162 @@ def colormap_histogram(series, vmin, vmax, ax, cmap = plt.cm.inferno):
     col /= max(col)
     
     for c, p in zip(col, patches):
-        plt.setp(p, 'facecolor', cmap(c))
-
-# import regions with thermal time constants
-regions = gpd.read_file('Resources/regional_thermal_time_constants.geojson',driver='GeoJSON')
-regions.set_index('index', inplace=True)
-
-# import temperature data
-min_temperature = xr.open_mfdataset('Data/tasmin/*.nc')
-max_temperature = xr.open_mfdataset('Data/tasmax/*.nc')
-mean_temperature = (max_temperature['tasmax'] + min_temperature['tasmin'])/2
-
-#%% identify heating season quantiles and how flexibility varies with each
-
-# only include winter months (December to January)
-heating_season_temperature = mean_temperature[(mean_temperature.time.dt.month>=12) | (mean_temperature.time.dt.month<=2)]
-heating_season_temperature = heating_season_temperature.chunk(dict(time=-1))
-
-coldest_temperature = heating_season_temperature.min(dim='time',skipna=False)
-fifth_percentile = heating_season_temperature.quantile(0.05,dim='time',skipna=False,keep_attrs=True)
-first_quartile = heating_season_temperature.quantile(0.2,dim='time',skipna=False,keep_attrs=True)
-second_quartile = heating_season_temperature.quantile(0.4,dim='time',skipna=False,keep_attrs=True)
-third_quartile = heating_season_temperature.quantile(0.6,dim='time',skipna=False,keep_attrs=True)
-fourth_quartile = heating_season_temperature.quantile(0.8,dim='time',skipna=False,keep_attrs=True)
-warmest_temperature = heating_season_temperature.max(dim='time',skipna=False)
-
-
-#%% assign mean temperature on coldest and typical winter days to regions
-
-regions = assign_gridded_values_to_regions(coldest_temperature, 'Coldest temperature', regions)
-regions = assign_gridded_values_to_regions(fifth_percentile, 'Fifth percentile temperature', regions)
-regions = assign_gridded_values_to_regions(first_quartile, 'First quartile temperature', regions)
-regions = assign_gridded_values_to_regions(second_quartile, 'Second quartile temperature', regions)
-regions = assign_gridded_values_to_regions(third_quartile, 'Third quartile temperature', regions)
-regions = assign_gridded_values_to_regions(fourth_quartile, 'Fourth quartile temperature', regions)
-regions = assign_gridded_values_to_regions(warmest_temperature, 'Warmest temperature', regions)
-
-
-#%% calculate comfortable heat-free hours
-regions = calculate_heat_free_hours(regions,'Coldest temperature')
-regions = calculate_heat_free_hours(regions,'Fifth percentile temperature')
-regions = calculate_heat_free_hours(regions,'First quartile temperature')
-regions = calculate_heat_free_hours(regions,'Second quartile temperature')
-regions = calculate_heat_free_hours(regions,'Third quartile temperature')
-regions = calculate_heat_free_hours(regions,'Fourth quartile temperature')
-
-# uniform 0 C outdoor temperature
-regions['Comfortable heat-free hours']=-regions['Thermal time constant [h]']*math.log((18-5)/(21-5))
-
-
-#%% map comfortable heat-free hours
-vmin = min(regions['Coldest temperature heat-free hours'].quantile(0.01),
-           regions['Fifth percentile temperature heat-free hours'].quantile(0.01),
-           regions['First quartile temperature heat-free hours'].quantile(0.01),
-           regions['Second quartile temperature heat-free hours'].quantile(0.01),
-           regions['Third quartile temperature heat-free hours'].quantile(0.01),
-           regions['Fourth quartile temperature heat-free hours'].quantile(0.01),
-           regions['Comfortable heat-free hours'].quantile(0.01))
-
-vmax = max(regions['Coldest temperature heat-free hours'].quantile(0.99),
-           regions['Fifth percentile temperature heat-free hours'].quantile(0.99),
-           regions['First quartile temperature heat-free hours'].quantile(0.99),
-           regions['Second quartile temperature heat-free hours'].quantile(0.99),
-           regions['Third quartile temperature heat-free hours'].quantile(0.99),
-           regions['Fourth quartile temperature heat-free hours'].quantile(0.99),
-           regions['Comfortable heat-free hours'].quantile(0.99))
-
-map_heat_free_hours(regions, 'Comfortable heat-free hours', vmin, vmax)
-map_heat_free_hours(regions, 'Coldest temperature heat-free hours', vmin, vmax)
-map_heat_free_hours(regions, 'Fifth percentile temperature heat-free hours', vmin, vmax)
-map_heat_free_hours(regions, 'First quartile temperature heat-free hours', vmin, vmax)
-map_heat_free_hours(regions, 'Second quartile temperature heat-free hours', vmin, vmax)
-map_heat_free_hours(regions, 'Third quartile temperature heat-free hours', vmin, vmax)
-map_heat_free_hours(regions, 'Fourth quartile temperature heat-free hours', vmin, vmax)
-
-#%% plot histogram of comfortable heat-free hours
-
-mean_coldest_temperature = round(regions['Coldest temperature'].mean(),1) 
-mean_fifth_percentile_temperature = round(regions['Fifth percentile temperature'].mean(),1)
-mean_first_quartile_temperature = round(regions['First quartile temperature'].mean(),1)
-mean_second_quartile_temperature = round(regions['Second quartile temperature'].mean(),1)
-mean_third_quartile_temperature = round(regions['Third quartile temperature'].mean(),1)
-mean_fourth_quartile_temperature = round(regions['Fourth quartile temperature'].mean(),1)
-
-
-fig, ax = plt.subplots(6, figsize=[4,7], sharex=True, sharey = True,constrained_layout = True)
-
-colormap_histogram(regions['Coldest temperature heat-free hours'], vmin, vmax, ax[0])
-colormap_histogram(regions['Fifth percentile temperature heat-free hours'], vmin, vmax, ax[1])
-colormap_histogram(regions['First quartile temperature heat-free hours'], vmin, vmax, ax[2])
-colormap_histogram(regions['Second quartile temperature heat-free hours'], vmin, vmax, ax[3])
-colormap_histogram(regions['Third quartile temperature heat-free hours'], vmin, vmax, ax[4])
-colormap_histogram(regions['Fourth quartile temperature heat-free hours'], vmin, vmax, ax[5])
-
-
-ax[5].set_xlabel('Heat-free hours')
-ax[3].set_ylabel('Count of regions')
-
-ax[0].set_title(f'Lowest temperature (mean = {mean_coldest_temperature}°C)',fontsize='medium')
-ax[1].set_title(f'5th percentile temperature (mean = {mean_fifth_percentile_temperature}°C)',fontsize='medium')
-ax[2].set_title(f'20th percentile temperature (mean = {mean_first_quartile_temperature}°C)',fontsize='medium')
-ax[3].set_title(f'40th percentile temperature (mean = {mean_second_quartile_temperature}°C)',fontsize='medium')
-ax[4].set_title(f'60th percentile temperature (mean = {mean_third_quartile_temperature}°C)',fontsize='medium')
-ax[5].set_title(f'80th percentile temperature (mean = {mean_fourth_quartile_temperature}°C)',fontsize='medium')
-
-
-ax[0].grid(True)
-ax[1].grid(True)
-ax[2].grid(True)
-ax[3].grid(True)
-ax[4].grid(True)
-ax[5].grid(True)
-
-
-plt.savefig('Plots/all heat-free hours histogram.jpg', dpi=300)
\ No newline at end of file
+        p.set_facecolor(cmap(c))
+
+def main(parameters=None, plots=True):
+    '''
+    calculate comfortable heat-free hours in every region at winter temperature
+    quantiles, save them, and map and plot them
+
+    Parameters
+    ----------
+    parameters : dict, optional
+        flexibility_duration stage parameters. The default is None, which uses
+        stage_parameters('flexibility_duration').
+    plots : bool, optional
+        map and plot heat-free hours. The default is True.
+
+    Returns
+    -------
+    None.
+
+    '''
+    if parameters is None:
+        parameters = stage_parameters('flexibility_duration')
+
+    # import regions with thermal time constants
+    with step('read time constants'):
+        regions = attach_geometry(read_table('Resources/regional_thermal_time_constants.parquet'))
+
+    # import temperature data
+    with step('load temperature'):
+        mean_temperature = load_mean_temperature()
+
+    #%% identify heating season quantiles and how flexibility varies with each
+
+    winter_months = [12, 1, 2]
+    quantile_labels = {'Coldest temperature': 0.,
+                       'Fifth percentile temperature': 0.05,
+                       'First quartile temperature': 0.2,
+                       'Second quartile temperature': 0.4,
+                       'Third quartile temperature': 0.6,
+                       'Fourth quartile temperature': 0.8,
+                       'Warmest temperature': 1.}
+
+    grid_index = region_grid_index(regions, mean_temperature, boundary_file=REGISTRY_FILE)
+    adjacency = neighbour_adjacency(regions, boundary_file=REGISTRY_FILE)
+
+    if parameters['tile_size'] is None:
+        # only include winter months (December to February)
+        heating_season_temperature = mean_temperature[mean_temperature.time.dt.month.isin(winter_months)]
+
+        # all winter quantiles from a single pass over each spatial tile
+        with step('winter quantiles'), dask_report('winter quantiles'):
+            winter_quantiles = temperature_quantiles(heating_season_temperature, list(quantile_labels.values()),
+                                                     method=parameters['quantile_method'])
+
+        #%% assign mean temperature on coldest and typical winter days to regions
+
+        with step('assign winter temperatures'):
+            regions = assign_gridded_fields_to_regions({label: winter_quantiles.sel(quantile=quantile)
+                                                        for label, quantile in quantile_labels.items()},
+                                                       regions, grid_index=grid_index, adjacency=adjacency)
+    else:
+        # quantiles at the cells under regions only, one spatial tile at a time, for
+        # grids and records too large to hold quantiles for every cell in memory
+        with step('tiled winter quantiles'):
+            winter_quantiles = run_tiled(tiled_quantiles, grid_index, tile_size=parameters['tile_size'],
+                                         quantiles=list(quantile_labels.values()), months=winter_months,
+                                         method=parameters['quantile_method'])['temperature quantiles']
+            for label, quantile in quantile_labels.items():
+                regions[label] = winter_quantiles.sel(quantile=quantile).values
+            regions = fill_na_with_neighboring_mean(regions, list(quantile_labels), adjacency)
+
+
+    #%% calculate comfortable heat-free hours
+    with step('heat-free hours'):
+        regions = calculate_heat_free_hours(regions,['Coldest temperature',
+                                                     'Fifth percentile temperature',
+                                                     'First quartile temperature',
+                                                     'Second quartile temperature',
+                                                     'Third quartile temperature',
+                                                     'Fourth quartile temperature'],
+                                            parameters['initial_temp'], parameters['final_temp'])
+
+        # uniform outdoor temperature, 5 C by default
+        regions['Comfortable heat-free hours']=heat_free_hours(regions['Thermal time constant [h]'], parameters['outdoor_temp'],
+                                                               parameters['initial_temp'], parameters['final_temp'])
+
+        # 'inf' where the outdoor temperature is at or above the final temperature,
+        # so indoor temperature never falls to it
+        regions.drop(columns='geometry').to_csv('Results/heat-free hours at winter temperatures.csv')
+
+    if not plots:
+        return
+
+
+    #%% map comfortable heat-free hours
+    hour_columns = ['Comfortable heat-free hours',
+                    'Coldest temperature heat-free hours',
+                    'Fifth percentile temperature heat-free hours',
+                    'First quartile temperature heat-free hours',
+                    'Second quartile temperature heat-free hours',
+                    'Third quartile temperature heat-free hours',
+                    'Fourth quartile temperature heat-free hours']
+    # regions that never cool to the final temperature have infinite heat-free
+    # hours, so the shared colour scale is set from finite values only
+    finite_hours = regions[hour_columns].replace([np.inf, -np.inf], np.nan)
+    vmin = finite_hours.quantile(0.01).min()
+    vmax = finite_hours.quantile(0.99).max()
+
+    with step('render maps'):
+        map_heat_free_hours(regions, hour_columns, vmin, vmax)
+
+    #%% plot histogram of comfortable heat-free hours
+    with step('histogram'):
+        import matplotlib.pyplot as plt
+
+        mean_coldest_temperature = round(regions['Coldest temperature'].mean(),1) 
+        mean_fifth_percentile_temperature = round(regions['Fifth percentile temperature'].mean(),1)
+        mean_first_quartile_temperature = round(regions['First quartile temperature'].mean(),1)
+        mean_second_quartile_temperature = round(regions['Second quartile temperature'].mean(),1)
+        mean_third_quartile_temperature = round(regions['Third quartile temperature'].mean(),1)
+        mean_fourth_quartile_temperature = round(regions['Fourth quartile temperature'].mean(),1)
+
+
+        fig, ax = plt.subplots(6, figsize=[4,7], sharex=True, sharey = True,constrained_layout = True)
+
+        colormap_histogram(regions['Coldest temperature heat-free hours'], vmin, vmax, ax[0])
+        colormap_histogram(regions['Fifth percentile temperature heat-free hours'], vmin, vmax, ax[1])
+        colormap_histogram(regions['First quartile temperature heat-free hours'], vmin, vmax, ax[2])
+        colormap_histogram(regions['Second quartile temperature heat-free hours'], vmin, vmax, ax[3])
+        colormap_histogram(regions['Third quartile temperature heat-free hours'], vmin, vmax, ax[4])
+        colormap_histogram(regions['Fourth quartile temperature heat-free hours'], vmin, vmax, ax[5])
+
+
+        ax[5].set_xlabel('Heat-free hours')
+        ax[3].set_ylabel('Count of regions')
+
+        ax[0].set_title(f'Lowest temperature (mean = {mean_coldest_temperature}°C)',fontsize='medium')
+        ax[1].set_title(f'5th percentile temperature (mean = {mean_fifth_percentile_temperature}°C)',fontsize='medium')
+        ax[2].set_title(f'20th percentile temperature (mean = {mean_first_quartile_temperature}°C)',fontsize='medium')
+        ax[3].set_title(f'40th percentile temperature (mean = {mean_second_quartile_temperature}°C)',fontsize='medium')
+        ax[4].set_title(f'60th percentile temperature (mean = {mean_third_quartile_temperature}°C)',fontsize='medium')
+        ax[5].set_title(f'80th percentile temperature (mean = {mean_fourth_quartile_temperature}°C)',fontsize='medium')
+
+
+        ax[0].grid(True)
+        ax[1].grid(True)
+        ax[2].grid(True)
+        ax[3].grid(True)
+        ax[4].grid(True)
+        ax[5].grid(True)
+
+
+        plt.savefig('Plots/all heat-free hours histogram.jpg', dpi=300)
+
+
+if __name__ == "__main__":
+
+    with instrumented_run('flexibility_duration'):
+        main(plots=plots_enabled())
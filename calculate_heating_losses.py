@@ -5,126 +5,305 @@ Created on Fri Oct 13 19:40:02 2023
 @author: Claire Halloran, University of Oxford
 
 Calculates residential heating losses based on HDDs and historical gas demand.
+Heat losses for all regions and years are estimated from (region, year) arrays
+of space heating demand and HDDs in one pass, with a choice of estimator.
 
 """
 
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import geopandas as gpd
-
-#%% import regions with HDDs calculated
-
-LSOAs = gpd.read_file('Resources/LSOA_HDDs_2010-2022.geojson',
-                      index_col = 'LSOA11CD')
-DZs = gpd.read_file('Resources/DZ_HDDs_2010-2022.geojson',
-                    index_col = 'DataZone')
-DZs.set_index('DataZone', inplace=True)
-LSOAs.set_index('LSOA11CD', inplace=True)
-#%% import annual heating demand
-gas_demand = pd.read_excel('Data/LSOA_domestic_gas_2010-21.xlsx', 
-                           sheet_name = ['2017','2018','2019','2020','2021'],
+from instrumentation import instrumented_run, step
+from pipeline import plots_enabled, stage_parameters
+from pipeline_io import cached_table, read_table, write_table
+
+def space_heating_shares(ECUK, years, fuel='Natural gas', sector='Domestic'):
+    '''
+    share of a fuel used for space heating in each year, from the ECUK end use
+    table
+
+    Parameters
+    ----------
+    ECUK : pandas DataFrame
+        ECUK end use table U2.
+    years : list of int
+        years to return.
+    fuel : str, optional
+        fuel column. The default is 'Natural gas'.
+    sector : str, optional
+        sector. The default is 'Domestic'.
+
+    Returns
+    -------
+    shares : numpy array
+        space heating share of fuel use in each year.
+
+    '''
+    end_uses = ECUK[ECUK['Sector']==sector].pivot_table(index='Year', columns='End use',
+                                                        values=fuel, aggfunc='sum')
+    shares = end_uses['Space heating']/end_uses['Overall total']
+    return shares.reindex(years).to_numpy()
+
+def read_gas_demand(years, file='Data/LSOA_domestic_gas_2010-21.xlsx'):
+    '''
+    mean domestic gas consumption per meter in every gas year as one wide table
+
+    Parameters
+    ----------
+    years : list of int
+        gas years to read, one sheet each.
+    file : str, optional
+        subnational gas consumption workbook. The default is
+        'Data/LSOA_domestic_gas_2010-21.xlsx'.
+
+    Returns
+    -------
+    gas_demand : pandas DataFrame
+        mean consumption in each year, for regions with gas demand in every year.
+
+    '''
+    sheets = pd.read_excel(file, 
+                           sheet_name = [f'{year}' for year in years],
                            header=4,
                            index_col='LSOA code')
-#%% import Energy Consumption in the UK consumption by fuel and end use
+    mean_consumption = []
+    for year, sheet in sheets.items():
+        sheet.columns = sheet.columns.str.replace('\n', ' ')
+        mean_consumption.append(sheet['Mean  consumption (kWh per meter)'].rename(
+            f'{year} Mean  consumption (kWh per meter) gas demand'))
+    # only regions with gas demand in every year, as for successive inner joins
+    return pd.concat(mean_consumption, axis=1, join='inner')
 
-ECUK = pd.read_excel('Data/ECUK_2022_End_Use_tables_27102022.xlsx',sheet_name='Table U2', header = 4)
+def read_ECUK(file='Data/ECUK_2022_End_Use_tables_27102022.xlsx', sheet_name='Table U2'):
+    '''
+    natural gas use by sector and end use in each year from the ECUK end use
+    table, with footnote rows dropped and typed columns so it can be cached
 
-#%% attach annual heating demand to each region
+    Parameters
+    ----------
+    file : str, optional
+        ECUK end use workbook. The default is
+        'Data/ECUK_2022_End_Use_tables_27102022.xlsx'.
+    sheet_name : str, optional
+        end use table. The default is 'Table U2'.
 
-# maybe add a for loop to do this for each year, and save the heating loss constant?
-gas_years = [2017,2018,2019,2020,2021]
+    Returns
+    -------
+    ECUK : pandas DataFrame
+        year, sector, end use and natural gas use. Suppressed values such as
+        '[x]' are NaN.
 
-for year in gas_years:
-    gas_demand[f'{year}'].columns = gas_demand[f'{year}'].columns.str.replace('\n', ' ')
-    gas_demand[f'{year}'] = gas_demand[f'{year}'].add_suffix(' gas demand')
-    gas_demand[f'{year}'] = gas_demand[f'{year}'].add_prefix(f'{year} ')
+    '''
+    ECUK = pd.read_excel(file, sheet_name=sheet_name, header=4,
+                         usecols=['Year', 'Sector', 'End use', 'Natural gas'])
+    # footnotes below the table have no year
+    ECUK = ECUK[pd.to_numeric(ECUK['Year'], errors='coerce').notna()]
+    return pd.DataFrame({'Year': ECUK['Year'].astype(float).astype(int),
+                         'Sector': ECUK['Sector'].astype(str),
+                         'End use': ECUK['End use'].astype(str),
+                         'Natural gas': pd.to_numeric(ECUK['Natural gas'], errors='coerce')}).reset_index(drop=True)
 
-    # join gas demand and LSOAs/DZs
-    DZs = DZs.join(gas_demand[f'{year}'][f'{year} Mean  consumption (kWh per meter) gas demand'], how='inner')
-    LSOAs = LSOAs.join(gas_demand[f'{year}'][f'{year} Mean  consumption (kWh per meter) gas demand'], how='inner')
-    
-    # scale gas demand by share of domestic natural gas used for space heating
-    space_heating_share = ECUK[(ECUK['Sector']=='Domestic')&(ECUK['Year']==year)&(ECUK['End use']== 'Space heating')]['Natural gas'].to_numpy()/\
-        ECUK[(ECUK['Sector']=='Domestic')&(ECUK['Year']==year)&(ECUK['End use']== 'Overall total')]['Natural gas'].to_numpy()
-    
-    DZs[f'{year} Mean space heating gas demand (kWh per meter)'] = DZs[f'{year} Mean  consumption (kWh per meter) gas demand']*space_heating_share
-    LSOAs[f'{year} Mean space heating gas demand (kWh per meter)'] = LSOAs[f'{year} Mean  consumption (kWh per meter) gas demand']*space_heating_share
+def heat_loss_rates(demand, HDDs, method='pooled', min_years=None):
+    '''
+    estimate heat loss rates of all regions from annual space heating demand and
+    HDDs. Years where either is missing are left out of the estimate for that
+    region.
+
+    Parameters
+    ----------
+    demand : numpy array
+        (region, year) annual space heating demand in kWh.
+    HDDs : numpy array
+        (region, year) heating degree days over the same periods.
+    method : str, optional
+        'pooled' divides total demand by total heating degree hours over all
+        years, 'per_year_mean' averages the ratio of demand to heating degree
+        hours in each year and 'least_squares' fits demand against heating
+        degree hours with an intercept for base load. The default is 'pooled'.
+    min_years : int, optional
+        fewest years with data for a region to get an estimate. The default is
+        None, which requires every year (two for 'least_squares' if fewer).
+
+    Returns
+    -------
+    losses : numpy array
+        heat loss rate of each region in kW/C.
+    base_load : numpy array
+        annual demand not explained by HDDs in kWh, zero except for 'least_squares'.
+    n_years : numpy array
+        number of years used for each region.
+
+    '''
+    demand = np.asarray(demand, dtype=float)
+    # convert to heating degree hours to get kW
+    degree_hours = np.asarray(HDDs, dtype=float)*24
+    available = np.isfinite(demand) & np.isfinite(degree_hours)
+    n_years = available.sum(axis=1)
+    if min_years is None:
+        min_years = demand.shape[1]
+    if method == 'least_squares':
+        min_years = max(min_years, 2)
+    demand = np.where(available, demand, 0.)
+    degree_hours = np.where(available, degree_hours, 0.)
+    base_load = np.zeros(len(demand))
     
-    # plot mean space heating gas consumption per gas meter
-    vmin = min(LSOAs[f'{year} Mean space heating gas demand (kWh per meter)'].quantile(0.005),
-               DZs[f'{year} Mean space heating gas demand (kWh per meter)'].quantile(0.005))
-    vmax=max(LSOAs[f'{year} Mean space heating gas demand (kWh per meter)'].quantile(0.995),
-             DZs[f'{year} Mean space heating gas demand (kWh per meter)'].quantile(0.995))
-    fig, ax = plt.subplots()
-    DZs.plot(column = f'{year} Mean space heating gas demand (kWh per meter)',
-             ax = ax,
-             cmap = 'magma',
-             vmin=vmin,
-             vmax=vmax,
-             missing_kwds={'color': 'lightgrey'})
-    LSOAs.plot(column = f'{year} Mean space heating gas demand (kWh per meter)',
-               ax = ax,
-               legend = True,
-               legend_kwds = {'label':'kWh per meter'},
-               cmap = 'magma',
-               vmin=vmin,
-               vmax=vmax,
-               missing_kwds={'color': 'lightgrey'})
-    plt.title(f'Mean household gas demand {year}')
-    plt.axis("off")
-    plt.savefig(f'Plots/Gas space heating demand {year}.jpg', dpi=300)
-
-#%% calculate heating losses based on heating demand and HDDs
-# note that years don't align for annual gas and electricity demand-- calculate separately
-
-# since gas data at LSOA level is weather-corrected, sum HDDs and gas demand
-# sum propegates NaNs-- some areas only have gas consumption for a few years
-DZs['Mean household gas space heating demand 2017-2021'] = sum(DZs[f'{year} Mean space heating gas demand (kWh per meter)'] for year in gas_years)
-LSOAs['Mean household gas space heating demand 2017-2021'] = sum(LSOAs[f'{year} Mean space heating gas demand (kWh per meter)'] for year in gas_years)
-
-DZs['Total gas HDDs 2017-2021'] = sum(DZs[f'{year} gas HDDs'] for year in gas_years)
-LSOAs['Total gas HDDs 2017-2021'] = sum(LSOAs[f'{year} gas HDDs'] for year in gas_years)
- 
-# from 2017 onward to get long-run average heating losses
-DZs['Mean gas heating losses 2017-2021 (kW/C)'] = DZs['Mean household gas space heating demand 2017-2021']/\
-    (DZs['Total gas HDDs 2017-2021']*24) # convert to heating degree hours to get kW
-LSOAs['Mean gas heating losses 2017-2021 (kW/C)'] = LSOAs['Mean household gas space heating demand 2017-2021']/\
-    (LSOAs['Total gas HDDs 2017-2021']*24) # convert to heating degree hours to get kW
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'pooled':
+            losses = demand.sum(axis=1)/degree_hours.sum(axis=1)
+        elif method == 'per_year_mean':
+            losses = np.where(available, demand/np.where(available, degree_hours, 1.), 0.).sum(axis=1)/n_years
+        elif method == 'least_squares':
+            # closed-form simple regression in every region at once
+            sum_x = degree_hours.sum(axis=1)
+            sum_y = demand.sum(axis=1)
+            variance = n_years*(degree_hours**2).sum(axis=1) - sum_x**2
+            losses = (n_years*(degree_hours*demand).sum(axis=1) - sum_x*sum_y)/variance
+            losses[variance <= 0] = np.nan
+            base_load = (sum_y - losses*sum_x)/n_years
+        else:
+            raise ValueError("method must be 'pooled', 'per_year_mean' or 'least_squares'")
     
+    losses[n_years < min_years] = np.nan
+    base_load = np.where(np.isfinite(losses), base_load, np.nan)
+    return losses, base_load, n_years
+
+
+def main(parameters=None, plots=True):
+    '''
+    calculate heating losses of every LSOA and DZ from gas demand and HDDs,
+    save them and map them
+
+    Parameters
+    ----------
+    parameters : dict, optional
+        heating_losses stage parameters. The default is None, which uses
+        stage_parameters('heating_losses').
+    plots : bool, optional
+        map gas demand and heating losses. The default is True.
+
+    Returns
+    -------
+    None.
+
+    '''
+
+    # parameters are set in pipeline.py so changing them reruns this and later stages
+    if parameters is None:
+        parameters = stage_parameters('heating_losses')
+
+    #%% import HDDs calculated for each region
+
+    # regions are indexed by LSOA11CD/DataZone code
+    with step('read HDDs'):
+        LSOAs = read_table('Resources/LSOA_HDDs_2010-2022.parquet')
+        DZs = read_table('Resources/DZ_HDDs_2010-2022.parquet')
+    #%% import annual heating demand
+
+    gas_years = [2017,2018,2019,2020,2021]
+
+    # the workbook is only parsed again if it changes
+    with step('read gas demand'):
+        gas_demand = cached_table(lambda: read_gas_demand(gas_years), ['Data/LSOA_domestic_gas_2010-21.xlsx'],
+                                  'Resources/Excel cache/LSOA_domestic_gas.parquet', key=str(gas_years))
+
+    #%% import Energy Consumption in the UK consumption by fuel and end use
+
+    with step('read ECUK'):
+        # keyed on the columns read, so caches of the whole sheet are rebuilt
+        ECUK = cached_table(read_ECUK, ['Data/ECUK_2022_End_Use_tables_27102022.xlsx'],
+                            'Resources/Excel cache/ECUK_2022_table_U2.parquet',
+                            key='Year, Sector, End use, Natural gas')
+
+    #%% attach annual heating demand to each region
+
+    # join gas demand for all years to LSOAs/DZs at once
+    DZs = DZs.join(gas_demand, how='inner')
+    LSOAs = LSOAs.join(gas_demand, how='inner')
+
+    # scale gas demand by share of domestic natural gas used for space heating in each year
+    space_heating_share = space_heating_shares(ECUK, gas_years)
+    consumption_columns = [f'{year} Mean  consumption (kWh per meter) gas demand' for year in gas_years]
+    demand_columns = [f'{year} Mean space heating gas demand (kWh per meter)' for year in gas_years]
+    HDD_columns = [f'{year} gas HDDs' for year in gas_years]
+    DZs[demand_columns] = DZs[consumption_columns].to_numpy()*space_heating_share
+    LSOAs[demand_columns] = LSOAs[consumption_columns].to_numpy()*space_heating_share
+
+    if plots:
+        with step('demand maps'):
+            from maps import render_maps
+            demand_maps = pd.concat([LSOAs[demand_columns], DZs[demand_columns]])
+            maps = []
+            for year in gas_years:
+                # plot mean space heating gas consumption per gas meter
+                vmin = min(LSOAs[f'{year} Mean space heating gas demand (kWh per meter)'].quantile(0.005),
+                           DZs[f'{year} Mean space heating gas demand (kWh per meter)'].quantile(0.005))
+                vmax=max(LSOAs[f'{year} Mean space heating gas demand (kWh per meter)'].quantile(0.995),
+                         DZs[f'{year} Mean space heating gas demand (kWh per meter)'].quantile(0.995))
+                maps.append({'column': f'{year} Mean space heating gas demand (kWh per meter)',
+                             'filename': f'Plots/Gas space heating demand {year}.jpg',
+                             'cmap': 'magma',
+                             'vmin': vmin,
+                             'vmax': vmax,
+                             'label': 'kWh per meter',
+                             'title': f'Mean household gas demand {year}',
+                             'dpi': 300,
+                             'missing_color': 'lightgrey'})
+            render_maps(demand_maps, maps)
+
+    #%% calculate heating losses based on heating demand and HDDs
+    # note that years don't align for annual gas and electricity demand-- calculate separately
+
+    # since gas data at LSOA level is weather-corrected, the default pools HDDs and gas demand
+    # some areas only have gas consumption for a few years-- by default these are left out
+    # from 2017 onward to get long-run average heating losses
+    with step('heat loss rates'):
+        for regions in (DZs, LSOAs):
+            demand = regions[demand_columns].to_numpy()
+            HDDs = regions[HDD_columns].to_numpy()
+            losses, base_load, n_years = heat_loss_rates(demand, HDDs, parameters['heat_loss_method'],
+                                                         parameters['min_years'])
+            available = np.isfinite(demand) & np.isfinite(HDDs) & np.isfinite(losses)[:, None]
+            regions['Mean household gas space heating demand 2017-2021'] = np.where(available, demand, 0.).sum(axis=1)
+            regions['Total gas HDDs 2017-2021'] = np.where(available, HDDs, 0.).sum(axis=1)
+            regions.loc[~np.isfinite(losses), ['Mean household gas space heating demand 2017-2021',
+                                               'Total gas HDDs 2017-2021']] = np.nan
+            regions['Mean gas heating losses 2017-2021 (kW/C)'] = losses
+            regions['Gas base load 2017-2021 (kWh)'] = base_load
+            regions['Gas years used 2017-2021'] = n_years
+
+
+    #%% plot mean gas heating losses
+    if plots:
+        with step('heat loss map'):
+            from maps import render_maps
+            degree_sign = u'\N{DEGREE SIGN}'
+
+            vmin = min(LSOAs['Mean gas heating losses 2017-2021 (kW/C)'].quantile(0.005),
+                       DZs['Mean gas heating losses 2017-2021 (kW/C)'].quantile(0.005))
+            vmax=max(LSOAs['Mean gas heating losses 2017-2021 (kW/C)'].quantile(0.995),
+                     DZs['Mean gas heating losses 2017-2021 (kW/C)'].quantile(0.995))
+            render_maps(pd.concat([LSOAs[['Mean gas heating losses 2017-2021 (kW/C)']],
+                                   DZs[['Mean gas heating losses 2017-2021 (kW/C)']]]),
+                        [{'column': 'Mean gas heating losses 2017-2021 (kW/C)',
+                          'filename': 'Plots/Gas heating losses.jpg',
+                          'cmap': 'inferno_r',
+                          'vmin': vmin,
+                          'vmax': vmax,
+                          'label': 'kW/'+degree_sign+'C',
+                          'dpi': 2000,
+                          'missing_color': 'lightgrey'}])
+
+    #%% save files
+
+    with step('write tables'):
+        # remove duplicate columns
+        LSOAs_no_duplicates = LSOAs.loc[:,~LSOAs.columns.duplicated()].copy()
+        DZs_no_duplicates = DZs.loc[:,~DZs.columns.duplicated()].copy()
+
+        write_table(LSOAs_no_duplicates, 'Resources/LSOA_gas_heat_loss_2017-2021.parquet', parameters['geojson'])
+        write_table(DZs_no_duplicates, 'Resources/DZ_gas_heat_loss_2017-2021.parquet', parameters['geojson'])
+
+
+if __name__ == "__main__":
 
-#%% plot mean gas heating losses
-degree_sign = u'\N{DEGREE SIGN}'
-
-vmin = min(LSOAs['Mean gas heating losses 2017-2021 (kW/C)'].quantile(0.005),
-           DZs['Mean gas heating losses 2017-2021 (kW/C)'].quantile(0.005))
-vmax=max(LSOAs['Mean gas heating losses 2017-2021 (kW/C)'].quantile(0.995),
-         DZs['Mean gas heating losses 2017-2021 (kW/C)'].quantile(0.995))
-fig, ax = plt.subplots()
-DZs.plot(column = 'Mean gas heating losses 2017-2021 (kW/C)',
-         ax = ax,
-         cmap = 'inferno_r',
-         vmin=vmin,
-         vmax=vmax,
-         missing_kwds={'color': 'lightgrey'})
-LSOAs.plot(column ='Mean gas heating losses 2017-2021 (kW/C)',
-           ax = ax,
-           legend = True,
-           legend_kwds = {'label':'kW/'+degree_sign+'C'},
-           cmap = 'inferno_r',
-           vmin=vmin,
-           vmax=vmax,
-           missing_kwds={'color': 'lightgrey'})
-# plt.title('Mean gas heating losses')
-plt.axis("off")
-plt.savefig('Plots/Gas heating losses.jpg', dpi=2000)
-
-#%% save files
-
-# remove duplicate columns
-LSOAs_no_duplicates = LSOAs.loc[:,~LSOAs.columns.duplicated()].copy()
-DZs_no_duplicates = DZs.loc[:,~DZs.columns.duplicated()].copy()
-
-LSOAs_no_duplicates.to_file('Resources/LSOA_gas_heat_loss_2017-2021.geojson',driver='GeoJSON',
-                            index=True)
-DZs_no_duplicates.to_file('Resources/DZ_gas_heat_loss_2017-2021.geojson',driver='GeoJSON',
-                          index=True)
+    with instrumented_run('heating_losses'):
+        main(plots=plots_enabled())
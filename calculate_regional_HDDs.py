@@ -10,12 +10,20 @@ statistics and assigns them to regions.
 
 """
 
-import pandas as pd
-import matplotlib.pyplot as plt
-import rasterio
 import os
+import warnings
+import numpy as np
+import pandas as pd
+import scipy as sp
+import shapely
 import geopandas as gpd
 import xarray as xr
+from caching import array_hash, combined_hash, file_hash
+from instrumentation import dask_report, instrumented_run, step
+from pipeline import plots_enabled, stage_parameters
+from pipeline_io import write_region_registry, write_table
+from temperature_store import load_mean_temperature, time_blocks
+from tiling import run_tiled, stack_region_indices, tiled_HDDs
 
 def HDDs(T, threshold):
     '''
@@ -39,15 +47,513 @@ def HDDs(T, threshold):
     HDD = difference.sum(dim = 'time', skipna = False)
     return HDD
 
-def fill_na_with_neighboring_mean(gdf, value_col):
-    for region in gdf[gdf[value_col].isna()].index:
-        neighbors = gdf[gdf.geometry.touches(gdf.loc[region,:].geometry)]
-        neighboring_mean = neighbors[value_col].mean()
-        gdf.at[region,value_col] = neighboring_mean
+def windowed_HDDs(temperature_blocks, windows, threshold):
+    '''
+    calculate gridded HDDs for several, possibly overlapping, time windows in a
+    single pass over the temperature record. Each block of days is read once
+    and added to every window it falls in, so peak memory is one block plus
+    one accumulator grid per window and threshold. As with HDDs, a NaN on any
+    day in a window gives a NaN total.
+
+    Parameters
+    ----------
+    temperature_blocks : iterable of XArray DataArrays
+        consecutive blocks of daily mean temperature with a time dimension.
+    windows : dict
+        time slices keyed by label, e.g. gas year.
+    threshold : float or list of float
+        threshold temperature for HDD calculation. A list gives HDDs for every
+        threshold from the same pass.
+
+    Returns
+    -------
+    HDD : XArray DataArray
+        total HDDs with dimensions (year, ...) for the label of each window, or
+        (threshold, year, ...) if a list of thresholds is given.
+
+    '''
+    labels = list(windows)
+    thresholds = np.atleast_1d(np.asarray(threshold, dtype=float))
+    totals = None
+    for block in temperature_blocks:
+        block = block.transpose('time', ...)
+        if totals is None:
+            template = block.isel(time=0, drop=True)
+            totals = np.zeros((len(thresholds), len(labels)) + template.shape)
+        times = block.indexes['time']
+        for j, value in enumerate(thresholds):
+            difference = np.clip(value - block.values, 0.0, None)
+            for i, label in enumerate(labels):
+                days = times.slice_indexer(windows[label].start, windows[label].stop)
+                if days.stop > days.start:
+                    totals[j, i] += difference[days].sum(axis=0)
+    HDD = xr.DataArray(totals, coords={'threshold': thresholds, 'year': labels, **template.coords},
+                       dims=('threshold', 'year') + template.dims)
+    if np.ndim(threshold) == 0:
+        return HDD.isel(threshold=0, drop=True)
+    return HDD
+
+def _cached_index_file(kind, cache_dir, *key_parts):
+    return os.path.join(cache_dir, f'{kind}_{combined_hash(kind, *key_parts)}.npz')
+
+def _load_cached_index(filename, region_labels):
+    if not os.path.exists(filename):
+        return None
+    cached = np.load(filename)
+    # regions may have been filtered or reordered since the index was cached
+    if not np.array_equal(cached['regions'], region_labels.astype(str)):
+        return None
+    return cached
+
+def _save_cached_index(filename, **arrays):
+    # stages running at the same time may build the same index, so it is written
+    # to a temporary file and moved into place for readers never to see a partial file
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    temporary_file = f'{filename}.{os.getpid()}.tmp'
+    with open(temporary_file, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temporary_file, filename)
+
+def _region_points(regions_gdf, crs):
+    regions_points = regions_gdf['geometry'].representative_point()
+    if regions_gdf.crs is not None and not regions_gdf.crs.equals(crs):
+        regions_points = regions_points.to_crs(crs)
+    return regions_points
+
+def neighbour_adjacency(regions_gdf, boundary_file=None, cache_dir='Resources'):
+    '''
+    sparse adjacency matrix of regions that touch each other, found with the
+    spatial index. Cached in cache_dir if the boundary file is given.
+
+    Parameters
+    ----------
+    regions_gdf : geodataframe
+        geodataframe including geometry for regions.
+    boundary_file : str, optional
+        file regions_gdf was read from. The default is None, which disables caching.
+    cache_dir : str, optional
+        folder for cached indices. The default is 'Resources'.
+
+    Returns
+    -------
+    adjacency : scipy sparse csr matrix
+        (region, region) matrix with ones where regions touch.
+
+    '''
+    region_labels = regions_gdf.index.to_numpy()
+    n_regions = len(region_labels)
+    if boundary_file is not None:
+        filename = _cached_index_file('neighbours', cache_dir, file_hash(boundary_file), array_hash(region_labels))
+        cached = _load_cached_index(filename, region_labels)
+        if cached is not None:
+            return sp.sparse.csr_matrix((np.ones(len(cached['indices'])), cached['indices'], cached['indptr']),
+                                        shape=(n_regions, n_regions))
+    
+    regions, neighbours = regions_gdf.sindex.query(regions_gdf.geometry, predicate='touches')
+    adjacency = sp.sparse.csr_matrix((np.ones(len(regions)), (regions, neighbours)),
+                                     shape=(n_regions, n_regions))
+    
+    if boundary_file is not None:
+        _save_cached_index(filename, indices=adjacency.indices, indptr=adjacency.indptr,
+                           regions=region_labels.astype(str))
+    return adjacency
+
+def fill_na_from_neighbours(values, adjacency, max_iterations=100):
+    '''
+    fill NaNs with the mean of neighbouring non-NaN values, propagating inwards
+    until no NaNs are left, no more can be filled or max_iterations is reached.
+
+    Parameters
+    ----------
+    values : numpy array
+        (region,) or (region, field) array of values.
+    adjacency : scipy sparse matrix
+        region adjacency from neighbour_adjacency.
+    max_iterations : int, optional
+        maximum number of propagation steps. The default is 100.
+
+    Returns
+    -------
+    values : numpy array
+        copy of values with NaNs filled where possible.
+    iterations : int
+        number of propagation steps taken.
+
+    '''
+    values = np.array(values, dtype=float)
+    iterations = 0
+    while iterations < max_iterations:
+        missing = np.isnan(values)
+        if not missing.any():
+            break
+        valid = (~missing).astype(float)
+        neighbour_sums = adjacency @ np.where(missing, 0., values)
+        neighbour_counts = adjacency @ valid
+        fillable = missing & (neighbour_counts > 0)
+        if not fillable.any():
+            break
+        values[fillable] = neighbour_sums[fillable]/neighbour_counts[fillable]
+        iterations += 1
+    return values, iterations
+
+def fill_na_with_neighboring_mean(gdf, value_col, adjacency=None, max_iterations=100):
+    '''
+    fill NaNs in a column with the mean of touching regions
+
+    Parameters
+    ----------
+    gdf : geodataframe
+        geodataframe including geometry for regions.
+    value_col : str or list of str
+        column(s) to fill.
+    adjacency : scipy sparse matrix, optional
+        region adjacency from neighbour_adjacency. The default is None, which
+        builds it from gdf.
+    max_iterations : int, optional
+        maximum number of propagation steps. The default is 100.
+
+    Returns
+    -------
+    gdf : geodataframe
+        geodataframe with NaNs filled.
+
+    '''
+    if adjacency is None:
+        adjacency = neighbour_adjacency(gdf)
+    filled, iterations = fill_na_from_neighbours(gdf[value_col].to_numpy(), adjacency, max_iterations)
+    n_filled = int(gdf[value_col].isna().to_numpy().sum() - np.isnan(filled).sum())
+    gdf[value_col] = filled
+    if n_filled:
+        print(f'Filled {n_filled} NaNs in {value_col} from neighbouring regions in {iterations} iterations')
+    if np.isnan(filled).any():
+        warnings.warn(f'{np.isnan(filled).sum()} NaNs in {value_col} have no valid neighbours '
+                      f'within {iterations} iterations')
     return gdf
 
+def grid_cell_indices(points, x_coords, y_coords):
+    '''
+    find the row and column of the grid cell containing each point
+
+    Parameters
+    ----------
+    points : GeoSeries
+        points in the same coordinate reference system as the grid.
+    x_coords : array-like
+        regularly spaced cell-centre x coordinates of the grid.
+    y_coords : array-like
+        regularly spaced cell-centre y coordinates of the grid.
+
+    Returns
+    -------
+    rows : numpy array
+        row (y) index of the cell containing each point.
+    cols : numpy array
+        column (x) index of the cell containing each point.
+    inside : numpy array
+        boolean mask of points that fall within the grid extent.
+
+    '''
+    x_coords = np.asarray(x_coords, dtype=float)
+    y_coords = np.asarray(y_coords, dtype=float)
+    # cell size and outer edge follow the geotransform rioxarray writes to GeoTIFF
+    x_res = (x_coords[-1] - x_coords[0])/(len(x_coords) - 1)
+    y_res = (y_coords[-1] - y_coords[0])/(len(y_coords) - 1)
+    cols = np.floor((points.x.to_numpy() - (x_coords[0] - x_res/2))/x_res).astype(np.int64)
+    rows = np.floor((points.y.to_numpy() - (y_coords[0] - y_res/2))/y_res).astype(np.int64)
+    inside = (rows >= 0) & (rows < len(y_coords)) & (cols >= 0) & (cols < len(x_coords))
+    return rows, cols, inside
+
+def region_grid_index(regions_gdf, grid_DataArray, crs='EPSG:27700', boundary_file=None,
+                      cache_dir='Resources', x_dim='projection_x_coordinate',
+                      y_dim='projection_y_coordinate'):
+    '''
+    locate the grid cell under the representative point of each region. If the
+    file the region boundaries were read from is given, the index is cached in
+    cache_dir keyed on a hash of that file and the grid coordinates, so the
+    geometry work is only done once per boundary vintage.
+
+    Parameters
+    ----------
+    regions_gdf : geodataframe
+        geodataframe including geometry for regions.
+    grid_DataArray : Xarray DataArray
+        gridded data with the target grid coordinates.
+    crs : string, optional
+        Coordinate reference system string for gridded data. The default is 'EPSG:27700'.
+    boundary_file : str, optional
+        file regions_gdf was read from. The default is None, which disables caching.
+    cache_dir : str, optional
+        folder for cached indices. The default is 'Resources'.
+    x_dim : string, optional
+        name of the x dimension. The default is 'projection_x_coordinate'.
+    y_dim : string, optional
+        name of the y dimension. The default is 'projection_y_coordinate'.
+
+    Returns
+    -------
+    grid_index : tuple
+        rows, cols and inside arrays from grid_cell_indices.
+
+    '''
+    x_coords = grid_DataArray[x_dim].values
+    y_coords = grid_DataArray[y_dim].values
+    region_labels = regions_gdf.index.to_numpy()
+    if boundary_file is not None:
+        filename = _cached_index_file('grid_index', cache_dir, file_hash(boundary_file), array_hash(region_labels),
+                                      array_hash(x_coords, y_coords), crs)
+        cached = _load_cached_index(filename, region_labels)
+        if cached is not None:
+            return cached['rows'], cached['cols'], cached['inside']
+            
+    rows, cols, inside = grid_cell_indices(_region_points(regions_gdf, crs), x_coords, y_coords)
+    
+    if boundary_file is not None:
+        _save_cached_index(filename, rows=rows, cols=cols, inside=inside,
+                           regions=region_labels.astype(str))
+    return rows, cols, inside
+
+def area_weight_matrix(regions_gdf, grid_DataArray, crs='EPSG:27700', boundary_file=None,
+                       cache_dir='Resources', x_dim='projection_x_coordinate',
+                       y_dim='projection_y_coordinate', chunk_size=500000):
+    '''
+    calculate the area of overlap between each region and each grid cell as a
+    sparse (region, cell) matrix, with cells numbered in row-major (y, x) order.
+    Cached in the same way as region_grid_index if boundary_file is given.
+
+    Parameters
+    ----------
+    regions_gdf : geodataframe
+        geodataframe including geometry for regions.
+    grid_DataArray : Xarray DataArray
+        gridded data with the target grid coordinates.
+    crs : string, optional
+        Coordinate reference system string for gridded data. The default is 'EPSG:27700'.
+    boundary_file : str, optional
+        file regions_gdf was read from. The default is None, which disables caching.
+    cache_dir : str, optional
+        folder for cached indices. The default is 'Resources'.
+    x_dim : string, optional
+        name of the x dimension. The default is 'projection_x_coordinate'.
+    y_dim : string, optional
+        name of the y dimension. The default is 'projection_y_coordinate'.
+    chunk_size : int, optional
+        number of candidate region-cell pairs intersected at a time. The default is 500000.
+
+    Returns
+    -------
+    weights : scipy sparse csr matrix
+        overlap area of each region (rows) with each grid cell (columns).
+
+    '''
+    x_coords = np.asarray(grid_DataArray[x_dim].values, dtype=float)
+    y_coords = np.asarray(grid_DataArray[y_dim].values, dtype=float)
+    region_labels = regions_gdf.index.to_numpy()
+    n_cells = len(y_coords)*len(x_coords)
+    if boundary_file is not None:
+        filename = _cached_index_file('area_weights', cache_dir, file_hash(boundary_file), array_hash(region_labels),
+                                      array_hash(x_coords, y_coords), crs)
+        cached = _load_cached_index(filename, region_labels)
+        if cached is not None:
+            return sp.sparse.csr_matrix((cached['data'], cached['indices'], cached['indptr']),
+                                        shape=(len(region_labels), n_cells))
+    
+    geometry = regions_gdf.geometry
+    if regions_gdf.crs is not None and not regions_gdf.crs.equals(crs):
+        geometry = geometry.to_crs(crs)
+    geometry = geometry.to_numpy()
+    shapely.prepare(geometry)
+    
+    # candidate cells are those overlapping each region's bounding box
+    x_res = (x_coords[-1] - x_coords[0])/(len(x_coords) - 1)
+    y_res = (y_coords[-1] - y_coords[0])/(len(y_coords) - 1)
+    x_edge = x_coords[0] - x_res/2
+    y_edge = y_coords[0] - y_res/2
+    bounds = shapely.bounds(geometry)
+    col_bounds = np.sort(np.floor((bounds[:, [0, 2]] - x_edge)/x_res), axis=1)
+    row_bounds = np.sort(np.floor((bounds[:, [1, 3]] - y_edge)/y_res), axis=1)
+    col_bounds = np.clip(col_bounds, 0, len(x_coords) - 1).astype(np.int64)
+    row_bounds = np.clip(row_bounds, 0, len(y_coords) - 1).astype(np.int64)
+    n_cols = col_bounds[:, 1] - col_bounds[:, 0] + 1
+    n_rows = row_bounds[:, 1] - row_bounds[:, 0] + 1
+    n_candidates = np.where(np.isnan(bounds).any(axis=1), 0, n_rows*n_cols)
+    
+    region_ids = np.repeat(np.arange(len(geometry)), n_candidates)
+    offsets = np.arange(n_candidates.sum()) - np.repeat(np.cumsum(n_candidates) - n_candidates, n_candidates)
+    rows = row_bounds[region_ids, 0] + offsets//n_cols[region_ids]
+    cols = col_bounds[region_ids, 0] + offsets%n_cols[region_ids]
+    
+    areas = np.empty(len(region_ids))
+    cell_area = abs(x_res*y_res)
+    for start in range(0, len(region_ids), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        cell_x = x_edge + cols[chunk]*x_res
+        cell_y = y_edge + rows[chunk]*y_res
+        cells = shapely.box(np.minimum(cell_x, cell_x + x_res), np.minimum(cell_y, cell_y + y_res),
+                            np.maximum(cell_x, cell_x + x_res), np.maximum(cell_y, cell_y + y_res))
+        chunk_geometry = geometry[region_ids[chunk]]
+        # only cells crossing a region boundary need an explicit intersection
+        inside = shapely.contains_properly(chunk_geometry, cells)
+        touching = ~inside & shapely.intersects(chunk_geometry, cells)
+        chunk_areas = np.where(inside, cell_area, 0.)
+        chunk_areas[touching] = shapely.area(shapely.intersection(chunk_geometry[touching], cells[touching]))
+        areas[chunk] = chunk_areas
+    
+    overlapping = areas > 0
+    weights = sp.sparse.csr_matrix((areas[overlapping],
+                                    (region_ids[overlapping], rows[overlapping]*len(x_coords) + cols[overlapping])),
+                                   shape=(len(geometry), n_cells))
+    
+    if boundary_file is not None:
+        _save_cached_index(filename, data=weights.data, indices=weights.indices, indptr=weights.indptr,
+                           regions=region_labels.astype(str))
+    return weights
+
+def build_region_index(regions_gdf, grid_DataArray, method='representative_point', crs='EPSG:27700',
+                       boundary_file=None, cache_dir='Resources'):
+    '''
+    build the region index used by a gridded value assignment method
+
+    Parameters
+    ----------
+    regions_gdf : geodataframe
+        geodataframe including geometry for regions.
+    grid_DataArray : Xarray DataArray
+        gridded data with the target grid coordinates.
+    method : str, optional
+        'representative_point' to take the cell under each region's representative
+        point or 'area_weighted' for the area-weighted mean of all overlapping cells.
+        The default is 'representative_point'.
+    crs : string, optional
+        Coordinate reference system string for gridded data. The default is 'EPSG:27700'.
+    boundary_file : str, optional
+        file regions_gdf was read from. The default is None, which disables caching.
+    cache_dir : str, optional
+        folder for cached indices. The default is 'Resources'.
+
+    Returns
+    -------
+    grid_index : tuple or scipy sparse matrix
+        output of region_grid_index or area_weight_matrix.
+
+    '''
+    if method == 'representative_point':
+        return region_grid_index(regions_gdf, grid_DataArray, crs, boundary_file, cache_dir)
+    elif method == 'area_weighted':
+        return area_weight_matrix(regions_gdf, grid_DataArray, crs, boundary_file, cache_dir)
+    raise ValueError(f'Unknown gridded value assignment method {method}')
+
+def _stack_fields(grid_DataArrays, x_dim, y_dim):
+    # concatenating keeps lazy fields in one dask graph so they are computed together
+    return xr.concat([grid.transpose(..., y_dim, x_dim) for grid in grid_DataArrays],
+                     dim='field', coords='minimal', compat='override').values.astype(float)
 
-def assign_gridded_values_to_regions(HDD_DataArray, HDD_label, regions_gdf, crs='EPSG:27700'):
+def sample_gridded_values(grid_DataArrays, grid_index,
+                          x_dim='projection_x_coordinate', y_dim='projection_y_coordinate'):
+    '''
+    sample any number of 2D grids at precomputed region grid cells
+
+    Parameters
+    ----------
+    grid_DataArrays : list of Xarray DataArrays
+        2D grids of data sharing the same coordinates.
+    grid_index : tuple
+        rows, cols and inside arrays from region_grid_index.
+    x_dim : string, optional
+        name of the x dimension. The default is 'projection_x_coordinate'.
+    y_dim : string, optional
+        name of the y dimension. The default is 'projection_y_coordinate'.
+
+    Returns
+    -------
+    values : numpy array
+        (field, region) array of sampled values, NaN where regions fall outside the grid.
+
+    '''
+    rows, cols, inside = grid_index
+    fields = _stack_fields(grid_DataArrays, x_dim, y_dim)
+    values = np.full((len(fields), len(rows)), np.nan)
+    values[:, inside] = fields[:, rows[inside], cols[inside]]
+    return values
+
+def area_weighted_values(grid_DataArrays, weights,
+                         x_dim='projection_x_coordinate', y_dim='projection_y_coordinate'):
+    '''
+    area-weighted mean of gridded values in each region, ignoring NaN cells.
+    Grids may have leading dimensions such as time, so a whole stack of grids
+    is projected onto regions with one sparse matrix multiply.
+
+    Parameters
+    ----------
+    grid_DataArrays : list of Xarray DataArrays
+        grids of data sharing the same coordinates.
+    weights : scipy sparse matrix
+        region-cell overlap areas from area_weight_matrix.
+    x_dim : string, optional
+        name of the x dimension. The default is 'projection_x_coordinate'.
+    y_dim : string, optional
+        name of the y dimension. The default is 'projection_y_coordinate'.
+
+    Returns
+    -------
+    values : numpy array
+        (field, ..., region) array of regional means, NaN where regions have no
+        valid overlapping cells.
+
+    '''
+    fields = _stack_fields(grid_DataArrays, x_dim, y_dim)
+    leading_shape = fields.shape[:-2]
+    fields = fields.reshape(-1, weights.shape[1]).T
+    valid = ~np.isnan(fields)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = (weights @ np.where(valid, fields, 0.))/(weights @ valid.astype(float))
+    return values.T.reshape(leading_shape + (weights.shape[0],))
+
+def assign_gridded_fields_to_regions(grid_DataArrays, regions_gdf, grid_index=None, crs='EPSG:27700',
+                                     method='representative_point', adjacency=None):
+    '''
+    assigns several gridded 2D dataarrays to polygon regions in a single pass
+
+    Parameters
+    ----------
+    grid_DataArrays : dict
+        2D grids of data keyed by their label in the regional geodataframe.
+    regions_gdf : geodataframe
+        geodataframe including geometry for regions.
+    grid_index : tuple or scipy sparse matrix, optional
+        precomputed output of build_region_index for the chosen method. The
+        default is None, which computes it from the first grid.
+    crs : string, optional
+        Coordinate reference system string for gridded data. The default is 'EPSG:27700'.
+    method : str, optional
+        'representative_point' or 'area_weighted'. The default is 'representative_point'.
+    adjacency : scipy sparse matrix, optional
+        region adjacency from neighbour_adjacency used to fill regions outside
+        the grid. The default is None, which builds it only if needed.
+
+    Returns
+    -------
+    regions_gdf : geodataframe
+        geodataframe with gridded values assigned to each region.
+
+    '''
+    labels = list(grid_DataArrays)
+    if grid_index is None:
+        grid_index = build_region_index(regions_gdf, grid_DataArrays[labels[0]], method, crs)
+    if method == 'representative_point':
+        values = sample_gridded_values([grid_DataArrays[label] for label in labels], grid_index)
+    else:
+        values = area_weighted_values([grid_DataArrays[label] for label in labels], grid_index)
+    for label, label_values in zip(labels, values):
+        regions_gdf[label] = label_values
+    
+    # check if any regions fall outside of HadUK-Grid
+    # and use means from neighboring LSOAs/DZs if so
+    if np.isnan(values).any():
+        regions_gdf = fill_na_with_neighboring_mean(regions_gdf, labels, adjacency)
+    return regions_gdf
+
+def assign_gridded_values_to_regions(HDD_DataArray, HDD_label, regions_gdf, crs='EPSG:27700', grid_index=None,
+                                     method='representative_point', adjacency=None):
     '''
     assigns gridded values from a 2D dataarray to polygon regions
 
@@ -61,6 +567,15 @@ def assign_gridded_values_to_regions(HDD_DataArray, HDD_label, regions_gdf, crs=
         geodataframe including geometry for regions.
     crs : string, optional
         Coordinate reference system string for gridded data. The default is 'EPSG:27700'.
+    grid_index : tuple or scipy sparse matrix, optional
+        precomputed output of build_region_index. The default is None.
+    method : str, optional
+        'representative_point' to take the cell under each region's representative
+        point or 'area_weighted' for the area-weighted mean of all overlapping cells.
+        The default is 'representative_point'.
+    adjacency : scipy sparse matrix, optional
+        region adjacency from neighbour_adjacency used to fill regions outside
+        the grid. The default is None, which builds it only if needed.
 
     Returns
     -------
@@ -68,52 +583,54 @@ def assign_gridded_values_to_regions(HDD_DataArray, HDD_label, regions_gdf, crs=
         geodataframe with temperature assigned to each region.
 
     '''
-        
-    # create a raster of temperature
-    HDD_DataArray.rio.write_crs(crs, inplace = True)
-    HDD_DataArray.rio.set_spatial_dims(x_dim='projection_x_coordinate',
-                                          y_dim='projection_y_coordinate', inplace = True)
-    filename = 'Resources/'+HDD_label+'.tif'
-    try:
-        os.remove(filename)
-    except OSError:
-        pass
-
-    HDD_DataArray.rio.to_raster(filename)
-    old_tif = rasterio.open(filename)
-    
-    regions_points = regions_gdf['geometry'].representative_point()
-    regions_coord_list = [(x, y) for x, y in zip(regions_points.x, regions_points.y)]
-    regions_gdf[HDD_label] = [x for x in old_tif.sample(regions_coord_list)]
-    regions_gdf = regions_gdf.explode(HDD_label)
-    regions_gdf[HDD_label]=pd.to_numeric(regions_gdf[HDD_label])
-    
-    # check if any representative points are outside of HadUK-Grid
-    # and use means from neighboring LSOAs/DZs if so
-    while regions_gdf[HDD_label].isna().sum()>0:
-        regions_gdf = fill_na_with_neighboring_mean(regions_gdf, HDD_label)
-        print('Replacing NaNs')
-    return regions_gdf
+    return assign_gridded_fields_to_regions({HDD_label: HDD_DataArray}, regions_gdf,
+                                            grid_index=grid_index, crs=crs, method=method,
+                                            adjacency=adjacency)
 
 
-if __name__ == "__main__":
+def main(parameters=None, plots=True):
+    '''
+    calculate HDDs in each gas year for every LSOA and DZ, save the region
+    registry and HDD tables, and map HDDs
+
+    Parameters
+    ----------
+    parameters : dict, optional
+        regional_HDDs stage parameters. The default is None, which uses
+        stage_parameters('regional_HDDs').
+    plots : bool, optional
+        map HDDs in each year. The default is True.
+
+    Returns
+    -------
+    None.
+
+    '''
     
     #%% try using HadUK-Grid 1 x 1 km observations
     # note these are in OSGB coordinates
     
-    min_temperature = xr.open_mfdataset('Data/tasmin/*.nc')
-    max_temperature = xr.open_mfdataset('Data/tasmax/*.nc')
-
-    mean_temperature = (max_temperature['tasmax'] + min_temperature['tasmin'])/2
+    # read from the mean temperature store, ingesting Data/tasmin and Data/tasmax on first use
+    with step('load temperature'):
+        mean_temperature = load_mean_temperature()
     
     #%% importing boundaries
-    DZs = gpd.read_file('Data/SG_DataZoneBdry_2011/SG_DataZone_Bdry_2011.shp')
-    LSOAs = gpd.read_file('Data/Lower_Layer_Super_Output_Areas_Dec_2011_Boundaries_Full_Extent_BFE_EW_V3_2022_-4926191891001926707.geojson')
-    DZs.set_index('Name', inplace = True)
-    LSOAs.set_index('LSOA11NM', inplace = True)
+    with step('read boundaries'):
+        DZ_boundary_file = 'Data/SG_DataZoneBdry_2011/SG_DataZone_Bdry_2011.shp'
+        LSOA_boundary_file = 'Data/Lower_Layer_Super_Output_Areas_Dec_2011_Boundaries_Full_Extent_BFE_EW_V3_2022_-4926191891001926707.geojson'
+        DZs = gpd.read_file(DZ_boundary_file)
+        LSOAs = gpd.read_file(LSOA_boundary_file)
+        DZs.set_index('DataZone', inplace = True)
+        LSOAs.set_index('LSOA11CD', inplace = True)
+        # boundaries are kept once in the region registry; later stages only pass tables keyed by code
+        write_region_registry([LSOAs, DZs])
     
     #%% calculating HDDs
     
+    # parameters are set in pipeline.py so changing them reruns this and later stages
+    if parameters is None:
+        parameters = stage_parameters('regional_HDDs')
+    
     gas_years = [2017,2018,2019,2020,2021]
     
     gas_year_ranges = {
@@ -124,37 +641,103 @@ if __name__ == "__main__":
         '2021':slice('2021-05-15','2022-05-15'),
         }
     
-    for year in gas_years:
-        fuel_cutout = mean_temperature.sel(time = gas_year_ranges[f'{year}'])
-        fuel_HDDs = HDDs(fuel_cutout, threshold = 15.5)       
-        LSOAs = assign_gridded_values_to_regions(fuel_HDDs, f'{year} gas HDDs', LSOAs)
-        DZs = assign_gridded_values_to_regions(fuel_HDDs, f'{year} gas HDDs', DZs)
-
-        #%% plot sum of HDDs in each LSOA
+    thresholds = sorted(set([parameters['threshold']] + list(parameters['threshold_grid'])))
+    
+    with step('grid index and adjacency'):
+        # 'representative_point' or 'area_weighted'
+        sampling_method = parameters['sampling_method']
+        # grid cells under each region only need to be found once for all years
+        LSOA_grid_index = build_region_index(LSOAs, mean_temperature, sampling_method,
+                                             boundary_file=LSOA_boundary_file)
+        DZ_grid_index = build_region_index(DZs, mean_temperature, sampling_method,
+                                           boundary_file=DZ_boundary_file)
+        LSOA_adjacency = neighbour_adjacency(LSOAs, boundary_file=LSOA_boundary_file)
+        DZ_adjacency = neighbour_adjacency(DZs, boundary_file=DZ_boundary_file)
+    
+    HDD_columns = [f'{year} gas HDDs' for year in gas_years]
+    threshold_columns = {(threshold, year): f'{year} gas HDDs {threshold:g}C'
+                         for threshold in parameters['threshold_grid'] for year in gas_years}
+    if parameters['tile_size'] is None:
+        # stream the daily temperature files once, adding each day to every gas year it falls in
+        # HDDs at a range of thresholds are also kept for uncertainty analysis of time constants
+        with step('windowed HDDs'):
+            threshold_HDDs = windowed_HDDs(time_blocks(mean_temperature), gas_year_ranges, threshold = thresholds)
+            gas_year_HDDs = threshold_HDDs.sel(threshold = parameters['threshold'])
         
+        with step('assign HDDs to regions'):
+            for year in gas_years:
+                fuel_HDDs = gas_year_HDDs.sel(year = f'{year}')
+                LSOAs = assign_gridded_values_to_regions(fuel_HDDs, f'{year} gas HDDs', LSOAs,
+                                                         grid_index=LSOA_grid_index, method=sampling_method,
+                                                         adjacency=LSOA_adjacency)
+                DZs = assign_gridded_values_to_regions(fuel_HDDs, f'{year} gas HDDs', DZs,
+                                                       grid_index=DZ_grid_index, method=sampling_method,
+                                                       adjacency=DZ_adjacency)
+        
+        #%% HDDs at each threshold in the grid
+        
+        with step('HDDs at threshold grid'), dask_report('HDDs at threshold grid'):
+            threshold_fields = {label: threshold_HDDs.sel(threshold = threshold, year = f'{year}')
+                                for (threshold, year), label in threshold_columns.items()}
+            LSOA_thresholds = assign_gridded_fields_to_regions(threshold_fields, LSOAs[['geometry']].copy(),
+                                                               grid_index=LSOA_grid_index, method=sampling_method,
+                                                               adjacency=LSOA_adjacency)
+            DZ_thresholds = assign_gridded_fields_to_regions(threshold_fields, DZs[['geometry']].copy(),
+                                                             grid_index=DZ_grid_index, method=sampling_method,
+                                                             adjacency=DZ_adjacency)
+    else:
+        # HDDs of LSOAs and DZs at every threshold from one pass over each spatial tile,
+        # for grids too large to hold HDDs for every cell in memory
+        with step('tiled HDDs'):
+            regional_HDDs = run_tiled(tiled_HDDs, stack_region_indices([LSOA_grid_index, DZ_grid_index]),
+                                      tile_size=parameters['tile_size'],
+                                      windows=gas_year_ranges, thresholds=thresholds)['HDDs']
+            LSOA_thresholds, DZ_thresholds = LSOAs[['geometry']].copy(), DZs[['geometry']].copy()
+            for regions, region_HDDs, adjacency in ((LSOAs, regional_HDDs[..., :len(LSOAs)], LSOA_adjacency),
+                                                    (DZs, regional_HDDs[..., len(LSOAs):], DZ_adjacency)):
+                for year in gas_years:
+                    regions[f'{year} gas HDDs'] = region_HDDs.sel(threshold = parameters['threshold'], year = f'{year}').values
+                fill_na_with_neighboring_mean(regions, HDD_columns, adjacency)
+            for thresholds_gdf, region_HDDs, adjacency in ((LSOA_thresholds, regional_HDDs[..., :len(LSOAs)], LSOA_adjacency),
+                                                           (DZ_thresholds, regional_HDDs[..., len(LSOAs):], DZ_adjacency)):
+                for (threshold, year), label in threshold_columns.items():
+                    thresholds_gdf[label] = region_HDDs.sel(threshold = threshold, year = f'{year}').values
+                fill_na_with_neighboring_mean(thresholds_gdf, list(threshold_columns.values()), adjacency)
+    
+    #%% plot sum of HDDs in each LSOA
+    
+    HDD_maps = []
+    for year in gas_years:
         vmin = min(LSOAs[f'{year} gas HDDs'].quantile(0.005),DZs[f'{year} gas HDDs'].quantile(0.005))
         vmax=max(LSOAs[f'{year} gas HDDs'].quantile(0.995),DZs[f'{year} gas HDDs'].quantile(0.995))
         
-        fig, ax = plt.subplots()
-        LSOAs.plot(column = f'{year} gas HDDs', 
-                   ax=ax,
-                   cmap='coolwarm_r',
-                    vmin=vmin,
-                    vmax=vmax,
-                   categorical=False)
-        DZs.plot(column = f'{year} gas HDDs', 
-                 legend=True,
-                 legend_kwds = {'label':'HDDs'},
-                   ax=ax,
-                   cmap='coolwarm_r',
-                   vmin=vmin,
-                   vmax=vmax
-                   )
-        plt.title(f'gas HDDs {year}')
-        plt.axis("off")
-        plt.savefig(f'Plots/gas HDDs {year}.jpg', dpi=300)
-            
-        #%% save LSOAs and DZs with HDDs
-        
-    LSOAs.to_file('Resources/LSOA_HDDs_2010-2022.geojson',driver='GeoJSON')
-    DZs.to_file('Resources/DZ_HDDs_2010-2022.geojson',driver='GeoJSON')
+        HDD_maps.append({'column': f'{year} gas HDDs',
+                         'filename': f'Plots/gas HDDs {year}.jpg',
+                         'cmap': 'coolwarm_r',
+                         'vmin': vmin,
+                         'vmax': vmax,
+                         'label': 'HDDs',
+                         'title': f'gas HDDs {year}',
+                         'dpi': 300})
+    
+    if plots:
+        with step('render maps'):
+            from maps import render_maps
+            # maps for all years are rendered together
+            render_maps(pd.concat([LSOAs[HDD_columns], DZs[HDD_columns]]), HDD_maps)
+    
+    #%% save LSOAs and DZs with HDDs, and HDDs at each threshold in the grid
+    
+    with step('write HDD tables'):
+        write_table(LSOAs[HDD_columns], 'Resources/LSOA_HDDs_2010-2022.parquet', parameters['geojson'])
+        write_table(DZs[HDD_columns], 'Resources/DZ_HDDs_2010-2022.parquet', parameters['geojson'])
+        write_table(LSOA_thresholds.drop(columns='geometry'), 'Resources/LSOA_HDD_thresholds.parquet',
+                    parameters['geojson'])
+        write_table(DZ_thresholds.drop(columns='geometry'), 'Resources/DZ_HDD_thresholds.parquet',
+                    parameters['geojson'])
+
+
+if __name__ == "__main__":
+
+    with instrumented_run('regional_HDDs'):
+        main(plots=plots_enabled())
@@ -10,196 +10,198 @@ of rooms in dwellings in each region, and total thermal energy storage capacity
 is calculated from thermal capacity for a given temperature window.
 
 """
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
-
-#%% estimate thermal capacity based on number of rooms
-
-LSOA_rooms = pd.read_csv('Data/England_and_Wales_census_2011_number_of_rooms.csv',
-                         index_col='geography code')
-
-# clean up column names
-LSOA_rooms.columns = LSOA_rooms.columns.str.removeprefix('Rooms: ').str.removesuffix('; measures: Value')
-
-DZ_rooms = pd.read_excel('Data/Scotland_census_2011_number_of_rooms.xlsx',
-                         header = 11,
-                         index_col = 'Unnamed: 1')
-DZ_rooms.drop('Datazone 2011', inplace= True)
-
-#%% calculate mean number of rooms per household in each region
-
-LSOA_rooms['Mean rooms'] = (LSOA_rooms['1 room']\
-                            +LSOA_rooms['2 rooms']*2\
-                                +LSOA_rooms['3 rooms']*3\
-                                    +LSOA_rooms['4 rooms']*4\
-                                        +LSOA_rooms['5 rooms']*5\
-                                            +LSOA_rooms['6 rooms']*6\
-                                                       +LSOA_rooms['7 rooms']*7\
-                                                           +LSOA_rooms['8 rooms']*8\
-                                                               +LSOA_rooms['9 or more rooms']*9)/\
-    LSOA_rooms['All categories: Number of rooms']
-    
-DZ_rooms['Mean rooms'] = (DZ_rooms['One room']\
-                            +DZ_rooms['Two rooms']*2\
-                                +DZ_rooms['Three rooms']*3\
-                                    +DZ_rooms['Four rooms']*4\
-                                        +DZ_rooms['Five rooms']*5\
-                                            +DZ_rooms['Six rooms']*6\
-                                                       +DZ_rooms['Seven rooms']*7\
-                                                           +DZ_rooms['Eight rooms']*8\
-                                                               +DZ_rooms['Nine or more rooms']*9)/\
-    DZ_rooms['All occupied household spaces']
-
-#%% load and join heating loss data
-
-LSOAs = gpd.read_file('Resources/LSOA_gas_heat_loss_2017-2021.geojson',driver='GeoJSON')
-DZs = gpd.read_file('Resources/DZ_gas_heat_loss_2017-2021.geojson',driver='GeoJSON')
-DZs.set_index('index', inplace=True)
-LSOAs.set_index('index', inplace=True)
-
-LSOAs = LSOAs.join(LSOA_rooms['Mean rooms'], how = 'inner')
-DZs = DZs.join(DZ_rooms['Mean rooms'], how = 'inner')
-
-#%% plot of mean rooms
-vmin = min(LSOAs['Mean rooms'].min(),
-           DZs['Mean rooms'].min())
-vmax=max(LSOAs['Mean rooms'].max(),
-         DZs['Mean rooms'].max())
-fig, ax = plt.subplots()
-DZs.plot(column = 'Mean rooms',
-         ax = ax,
-         cmap = 'viridis',
-         vmin=vmin,
-         vmax=vmax,
-         missing_kwds={'color': 'lightgrey'})
-LSOAs.plot(column ='Mean rooms',
-           ax = ax,
-           legend = True,
-           legend_kwds = {'label':'Rooms'},
-           cmap = 'viridis',
-           vmin=vmin,
-           vmax=vmax,
-           missing_kwds={'color': 'lightgrey'})
-plt.title('Mean rooms per dwelling')
-plt.axis("off")
-plt.savefig('Rooms per household.jpg', dpi=1000)
-
-#%% make an assumption about average floor area per room
-
-floor_area_per_room = 17.6
-
-LSOAs['Estimated floor area [m2]'] = floor_area_per_room*LSOAs['Mean rooms']
-DZs['Estimated floor area [m2]'] = floor_area_per_room*DZs['Mean rooms']
-
-# SAP 2012 medium
-specific_thermal_capacity = 250/3600 # kWh/m2/C
-
-LSOAs['Thermal capacity [kWh/C]']= specific_thermal_capacity * LSOAs['Estimated floor area [m2]']
-DZs['Thermal capacity [kWh/C]']= specific_thermal_capacity * DZs['Estimated floor area [m2]']
-
-#%% plot thermal capacity distribution
-
-fig, ax = plt.subplots()
-
-(pd.concat([LSOAs['Thermal capacity [kWh/C]'],DZs['Thermal capacity [kWh/C]']])*3.6).plot.hist(bins= 50, ax = ax, xlim = [10,35])
-
-ax.set_xlabel('Thermal capacity [MJ/C]')
-ax.set_ylabel('Count of regions')
-
-#%% map thermal capacity
-degree_sign = u'\N{DEGREE SIGN}'
-
-vmin = min(LSOAs['Thermal capacity [kWh/C]'].quantile(0.01),
-           DZs['Thermal capacity [kWh/C]'].quantile(0.01))
-vmax=max(LSOAs['Thermal capacity [kWh/C]'].quantile(0.99),
-         DZs['Thermal capacity [kWh/C]'].quantile(0.99))
-fig, ax = plt.subplots()
-DZs.plot(column = 'Thermal capacity [kWh/C]',
-         ax = ax,
-         cmap = 'viridis',
-         vmin=vmin,
-         vmax=vmax,
-         missing_kwds={'color': 'grey'})
-LSOAs.plot(column ='Thermal capacity [kWh/C]',
-           ax = ax,
-           legend = True,
-           legend_kwds = {'label':'kWh/'+degree_sign+'C'},
-           cmap = 'viridis',
-           vmin=vmin,
-           vmax=vmax,
-           missing_kwds={'color': 'grey'})
-# plt.title('Mean thermal time constant')
-plt.axis("off")
-plt.savefig('Plots/thermal capacity.jpg', dpi=1000)
-
-
-#%% calculate thermal time constants
-
-LSOAs['Thermal time constant [h]']=LSOAs['Thermal capacity [kWh/C]']/\
-    LSOAs['Mean gas heating losses 2017-2021 (kW/C)']
-DZs['Thermal time constant [h]']=DZs['Thermal capacity [kWh/C]']/\
-    DZs['Mean gas heating losses 2017-2021 (kW/C)']
-    
-#%% plot of thermal time constants
-vmin = min(LSOAs['Thermal time constant [h]'].quantile(0.01),
-           DZs['Thermal time constant [h]'].quantile(0.01))
-vmax=max(LSOAs['Thermal time constant [h]'].quantile(0.99),
-         DZs['Thermal time constant [h]'].quantile(0.99))
-fig, ax = plt.subplots()
-DZs.plot(column = 'Thermal time constant [h]',
-         ax = ax,
-         cmap = 'PuOr_r',
-         vmin=vmin,
-         vmax=vmax,
-         missing_kwds={'color': 'grey'})
-LSOAs.plot(column ='Thermal time constant [h]',
-           ax = ax,
-           legend = True,
-           legend_kwds = {'label':'Thermal time constant [h]'},
-           cmap = 'PuOr_r',
-           vmin=vmin,
-           vmax=vmax,
-           missing_kwds={'color': 'grey'})
-# plt.title('Mean thermal time constant')
-plt.axis("off")
-plt.savefig('Plots/Thermal time constant.jpg', dpi=1000)
-
-#%% save results
-
-LSOAs.to_file('Resources/LSOA_gas_time_constants.geojson',driver='GeoJSON')
-DZs.to_file('Resources/DZ_gas_time_constants.geojson',driver='GeoJSON')
-
-#%% create a simple, merged version for use as power system planning input
-# need to include time constant and total number of households
-
-# join number of occupied households from 2011 census
-LSOAs = LSOAs.join(LSOA_rooms['All categories: Number of rooms'], how = 'inner')
-DZs = DZs.join(DZ_rooms['All occupied household spaces'], how = 'inner')
-# rename columns to occupied households
-LSOAs = LSOAs.rename(columns={'All categories: Number of rooms':'Households'})
-DZs = DZs.rename(columns={'All occupied household spaces':'Households'})
-
-time_constants = pd.concat([LSOAs[['Thermal time constant [h]','Thermal capacity [kWh/C]','Households','geometry']], 
-                            DZs[['Thermal time constant [h]','Thermal capacity [kWh/C]','Households','geometry']]])
-
-time_constants.to_file('Results/regional_thermal_time_constants.geojson',driver='GeoJSON')
-
-# also save as a CSV to have a human-readable version
-
-time_constants_pd = pd.DataFrame(time_constants)
-time_constants_pd.drop('geometry', axis='columns',inplace=True)
-
-time_constants_pd.to_csv('Results/regional_thermal_time_constants.csv')
-
-#%% calculate the total thermal energy that can be stored for a given temperature window
-
-delta_T = 3 # celsius
-
-LSOAs['Total thermal energy storage [kWh]'] = delta_T*LSOAs['Thermal capacity [kWh/C]']*LSOAs['Households']
-DZs['Total thermal energy storage [kWh]'] = delta_T*DZs['Thermal capacity [kWh/C]']*DZs['Households']
-
-national_TES_capacity = (LSOAs['Total thermal energy storage [kWh]'].sum() +\
-    DZs['Total thermal energy storage [kWh]'].sum())/1e6 #kWh to GWh
-    
-print('Total thermal energy storage capacity: '+str(national_TES_capacity)+' GWh(th)')
\ No newline at end of file
+from instrumentation import instrumented_run, step
+from pipeline import plots_enabled, stage_parameters
+from census import mean_rooms, read_room_counts
+from pipeline_io import attach_geometry, read_table, write_table
+from time_constant_uncertainty import monte_carlo_time_constants
+
+def main(parameters=None, plots=True):
+    '''
+    calculate thermal capacity, thermal time constants and thermal energy
+    storage capacity of every LSOA and DZ, with their Monte Carlo uncertainty,
+    save them and map them
+
+    Parameters
+    ----------
+    parameters : dict, optional
+        time_constants stage parameters. The default is None, which uses
+        stage_parameters('time_constants').
+    plots : bool, optional
+        plot and map rooms, thermal capacity and time constants. The default is True.
+
+    Returns
+    -------
+    None.
+
+    '''
+
+    # parameters are set in pipeline.py so changing them reruns this and later stages
+    if parameters is None:
+        parameters = stage_parameters('time_constants')
+
+    #%% estimate thermal capacity based on number of rooms
+
+    # (region, room bin) household counts from each census, keyed by LSOA/DZ code
+    with step('read census'):
+        LSOA_rooms, LSOA_households = read_room_counts('England and Wales 2011')
+        DZ_rooms, DZ_households = read_room_counts('Scotland 2011')
+
+    #%% calculate mean number of rooms per household in each region
+
+    LSOA_mean_rooms = mean_rooms(LSOA_rooms, LSOA_households)
+    DZ_mean_rooms = mean_rooms(DZ_rooms, DZ_households)
+
+    #%% load and join heating loss data
+
+    with step('read heat losses'):
+        LSOAs = read_table('Resources/LSOA_gas_heat_loss_2017-2021.parquet')
+        DZs = read_table('Resources/DZ_gas_heat_loss_2017-2021.parquet')
+
+    LSOAs = LSOAs.join(LSOA_mean_rooms, how = 'inner')
+    DZs = DZs.join(DZ_mean_rooms, how = 'inner')
+
+    #%% make an assumption about average floor area per room
+
+    floor_area_per_room = parameters['floor_area_per_room']
+
+    LSOAs['Estimated floor area [m2]'] = floor_area_per_room*LSOAs['Mean rooms']
+    DZs['Estimated floor area [m2]'] = floor_area_per_room*DZs['Mean rooms']
+
+    # SAP 2012 medium
+    specific_thermal_capacity = parameters['specific_thermal_capacity'] # kWh/m2/C
+
+    LSOAs['Thermal capacity [kWh/C]']= specific_thermal_capacity * LSOAs['Estimated floor area [m2]']
+    DZs['Thermal capacity [kWh/C]']= specific_thermal_capacity * DZs['Estimated floor area [m2]']
+
+    #%% calculate thermal time constants
+
+    LSOAs['Thermal time constant [h]']=LSOAs['Thermal capacity [kWh/C]']/\
+        LSOAs['Mean gas heating losses 2017-2021 (kW/C)']
+    DZs['Thermal time constant [h]']=DZs['Thermal capacity [kWh/C]']/\
+        DZs['Mean gas heating losses 2017-2021 (kW/C)']
+
+    if plots:
+        with step('plots and maps'):
+            import matplotlib.pyplot as plt
+            from maps import render_maps
+
+            #%% plot thermal capacity distribution
+
+            fig, ax = plt.subplots()
+
+            (pd.concat([LSOAs['Thermal capacity [kWh/C]'],DZs['Thermal capacity [kWh/C]']])*3.6).plot.hist(bins= 50, ax = ax, xlim = [10,35])
+
+            ax.set_xlabel('Thermal capacity [MJ/C]')
+            ax.set_ylabel('Count of regions')
+
+            #%% map mean rooms, thermal capacity and thermal time constants
+            degree_sign = u'\N{DEGREE SIGN}'
+            regions = pd.concat([LSOAs, DZs])
+
+            render_maps(regions, [
+                {'column': 'Mean rooms',
+                 'filename': 'Rooms per household.jpg',
+                 'cmap': 'viridis',
+                 'vmin': regions['Mean rooms'].min(),
+                 'vmax': regions['Mean rooms'].max(),
+                 'label': 'Rooms',
+                 'title': 'Mean rooms per dwelling',
+                 'dpi': 1000,
+                 'missing_color': 'lightgrey'},
+                {'column': 'Thermal capacity [kWh/C]',
+                 'filename': 'Plots/thermal capacity.jpg',
+                 'cmap': 'viridis',
+                 'vmin': min(LSOAs['Thermal capacity [kWh/C]'].quantile(0.01),
+                             DZs['Thermal capacity [kWh/C]'].quantile(0.01)),
+                 'vmax': max(LSOAs['Thermal capacity [kWh/C]'].quantile(0.99),
+                             DZs['Thermal capacity [kWh/C]'].quantile(0.99)),
+                 'label': 'kWh/'+degree_sign+'C',
+                 'dpi': 1000,
+                 'missing_color': 'grey'},
+                {'column': 'Thermal time constant [h]',
+                 'filename': 'Plots/Thermal time constant.jpg',
+                 'cmap': 'PuOr_r',
+                 'vmin': min(LSOAs['Thermal time constant [h]'].quantile(0.01),
+                             DZs['Thermal time constant [h]'].quantile(0.01)),
+                 'vmax': max(LSOAs['Thermal time constant [h]'].quantile(0.99),
+                             DZs['Thermal time constant [h]'].quantile(0.99)),
+                 'label': 'Thermal time constant [h]',
+                 'dpi': 1000,
+                 'missing_color': 'grey'},
+                ])
+
+    #%% save results
+
+    with step('write tables'):
+        write_table(LSOAs, 'Resources/LSOA_gas_time_constants.parquet', parameters['geojson'])
+        write_table(DZs, 'Resources/DZ_gas_time_constants.parquet', parameters['geojson'])
+
+    #%% create a simple, merged version for use as power system planning input
+    # need to include time constant and total number of households
+
+    # join number of occupied households from 2011 census
+    LSOAs = LSOAs.join(LSOA_households, how = 'inner')
+    DZs = DZs.join(DZ_households, how = 'inner')
+
+    time_constants = pd.concat([LSOAs[['Thermal time constant [h]','Thermal capacity [kWh/C]','Households']], 
+                                DZs[['Thermal time constant [h]','Thermal capacity [kWh/C]','Households']]])
+
+    write_table(time_constants, 'Resources/regional_thermal_time_constants.parquet')
+    with step('export time constants'):
+        # GeoJSON copy with boundaries for use as power system planning input
+        attach_geometry(time_constants).to_file('Results/regional_thermal_time_constants.geojson',driver='GeoJSON')
+
+        # also save as a CSV to have a human-readable version
+
+        time_constants.to_csv('Results/regional_thermal_time_constants.csv')
+
+    #%% calculate the total thermal energy that can be stored for a given temperature window
+
+    delta_T = parameters['delta_T'] # celsius
+
+    LSOAs['Total thermal energy storage [kWh]'] = delta_T*LSOAs['Thermal capacity [kWh/C]']*LSOAs['Households']
+    DZs['Total thermal energy storage [kWh]'] = delta_T*DZs['Thermal capacity [kWh/C]']*DZs['Households']
+
+    national_TES_capacity = (LSOAs['Total thermal energy storage [kWh]'].sum() +\
+        DZs['Total thermal energy storage [kWh]'].sum())/1e6 #kWh to GWh
+
+    print('Total thermal energy storage capacity: '+str(national_TES_capacity)+' GWh(th)')
+    #%% Monte Carlo uncertainty in time constants and thermal energy storage capacity
+
+    monte_carlo = parameters['monte_carlo']
+    if monte_carlo['draws'] > 0:
+        with step('Monte Carlo uncertainty'):
+            heat_loss_parameters = stage_parameters('heating_losses')
+            gas_years = [2017,2018,2019,2020,2021]
+            demand_columns = [f'{year} Mean space heating gas demand (kWh per meter)' for year in gas_years]
+            room_counts = pd.concat([LSOA_rooms.loc[LSOAs.index], DZ_rooms.loc[DZs.index]])
+            demand = pd.concat([LSOAs[demand_columns], DZs[demand_columns]]).to_numpy()
+
+            # HDDs at each threshold in the grid, with columns named e.g. '2017 gas HDDs 15.5C'
+            threshold_table = pd.concat([read_table('Resources/LSOA_HDD_thresholds.parquet').reindex(LSOAs.index),
+                                         read_table('Resources/DZ_HDD_thresholds.parquet').reindex(DZs.index)])
+            thresholds = sorted({float(column.split()[-1][:-1]) for column in threshold_table.columns})
+            threshold_HDDs = np.stack([threshold_table[[f'{year} gas HDDs {threshold:g}C' for year in gas_years]].to_numpy()
+                                       for threshold in thresholds], axis=1)
+
+            distributions = {'delta_T': {'distribution': 'fixed', 'value': delta_T}, **monte_carlo['distributions']}
+            region_percentiles, TES_capacity_draws = monte_carlo_time_constants(
+                room_counts, pd.concat([LSOAs['Households'], DZs['Households']]), demand, threshold_HDDs, thresholds, distributions,
+                n_draws=monte_carlo['draws'], percentiles=monte_carlo['percentiles'], seed=monte_carlo['seed'],
+                heat_loss_method=heat_loss_parameters['heat_loss_method'], min_years=heat_loss_parameters['min_years'])
+
+            region_percentiles.to_csv('Results/thermal time constant percentiles.csv')
+            pd.Series(TES_capacity_draws, name='National thermal energy storage capacity [GWh]').to_csv(
+                'Results/national TES capacity draws.csv', index_label='Draw')
+            low, median, high = np.percentile(TES_capacity_draws, [5, 50, 95])
+            print(f'Total thermal energy storage capacity: median {median:.1f} GWh(th), '
+                  f'90% interval {low:.1f} to {high:.1f} GWh(th)')
+
+
+if __name__ == "__main__":
+
+    with instrumented_run('time_constants'):
+        main(plots=plots_enabled())
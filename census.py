@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Reads census tables of the number of rooms in each household into a common
+(region, room bin) matrix of household counts, so room statistics for every
+region are computed with one matrix-vector product. Each census source only
+needs an entry in CENSUS_SOURCES mapping its columns to the room bins.
+
+"""
+
+import numpy as np
+import pandas as pd
+from pipeline_io import cached_table
+
+# number of rooms counted for each bin; the last bin is '9 or more rooms'
+ROOMS = np.arange(1, 10)
+
+CENSUS_SOURCES = {
+    'England and Wales 2011': {
+        'file': 'Data/England_and_Wales_census_2011_number_of_rooms.csv',
+        'read_options': {'index_col': 'geography code'},
+        'drop_rows': [],
+        'households': 'Rooms: All categories: Number of rooms; measures: Value',
+        'room_bins': ['Rooms: 1 room; measures: Value',
+                      'Rooms: 2 rooms; measures: Value',
+                      'Rooms: 3 rooms; measures: Value',
+                      'Rooms: 4 rooms; measures: Value',
+                      'Rooms: 5 rooms; measures: Value',
+                      'Rooms: 6 rooms; measures: Value',
+                      'Rooms: 7 rooms; measures: Value',
+                      'Rooms: 8 rooms; measures: Value',
+                      'Rooms: 9 or more rooms; measures: Value'],
+        },
+    'Scotland 2011': {
+        'file': 'Data/Scotland_census_2011_number_of_rooms.xlsx',
+        'read_options': {'header': 11, 'index_col': 'Unnamed: 1'},
+        'drop_rows': ['Datazone 2011'],
+        'households': 'All occupied household spaces',
+        'room_bins': ['One room', 'Two rooms', 'Three rooms', 'Four rooms', 'Five rooms',
+                      'Six rooms', 'Seven rooms', 'Eight rooms', 'Nine or more rooms'],
+        },
+    }
+
+def _read_source(source):
+    if source['file'].endswith('.csv'):
+        table = pd.read_csv(source['file'], **source['read_options'])
+    else:
+        table = pd.read_excel(source['file'], **source['read_options'])
+    columns = source['room_bins'] + [source['households']]
+    # notes and blank rows have no counts
+    return table.drop(source['drop_rows'])[columns].dropna().astype(np.int64)
+
+def read_room_counts(name, cache_dir='Resources/Excel cache'):
+    '''
+    household counts in each room bin and total households in each region from
+    one census source. Excel sources are cached as Parquet.
+
+    Parameters
+    ----------
+    name : str
+        name of source in CENSUS_SOURCES.
+    cache_dir : str, optional
+        folder for cached tables. The default is 'Resources/Excel cache'.
+
+    Returns
+    -------
+    counts : pandas DataFrame
+        (region, room bin) integer household counts, with columns ROOMS.
+    households : pandas Series
+        total households in each region.
+
+    '''
+    source = CENSUS_SOURCES[name]
+    if source['file'].endswith('.csv'):
+        table = _read_source(source)
+    else:
+        table = cached_table(lambda: _read_source(source), [source['file']],
+                             f'{cache_dir}/{name} rooms.parquet', key=repr(source))
+    counts = pd.DataFrame(table[source['room_bins']].to_numpy(), index=table.index, columns=ROOMS)
+    households = table[source['households']].rename('Households')
+    return counts, households
+
+def room_moment(counts, households=None, order=1, room_values=ROOMS):
+    '''
+    moment of the number of rooms per household in each region
+
+    Parameters
+    ----------
+    counts : pandas DataFrame
+        (region, room bin) household counts.
+    households : pandas Series, optional
+        total households in each region. The default is None, which sums counts.
+    order : int, optional
+        order of moment about zero; 1 gives mean rooms. The default is 1.
+    room_values : numpy array, optional
+        number of rooms counted for each bin. The default is ROOMS.
+
+    Returns
+    -------
+    moment : pandas Series
+        moment in each region.
+
+    '''
+    matrix = counts.to_numpy(dtype=float)
+    totals = matrix.sum(axis=1) if households is None else households.to_numpy(dtype=float)
+    return pd.Series(matrix @ np.asarray(room_values, dtype=float)**order/totals, index=counts.index)
+
+def mean_rooms(counts, households=None, room_values=ROOMS):
+    '''
+    mean number of rooms per household in each region
+
+    Parameters
+    ----------
+    counts : pandas DataFrame
+        (region, room bin) household counts.
+    households : pandas Series, optional
+        total households in each region. The default is None, which sums counts.
+    room_values : numpy array, optional
+        number of rooms counted for each bin. The default is ROOMS.
+
+    Returns
+    -------
+    mean : pandas Series
+        mean rooms per household in each region.
+
+    '''
+    return room_moment(counts, households, 1, room_values).rename('Mean rooms')
+
+def room_shares(counts):
+    '''
+    share of households in each room bin in each region
+
+    Parameters
+    ----------
+    counts : pandas DataFrame
+        (region, room bin) household counts.
+
+    Returns
+    -------
+    shares : pandas DataFrame
+        (region, room bin) shares of households.
+
+    '''
+    matrix = counts.to_numpy(dtype=float)
+    return pd.DataFrame(matrix/matrix.sum(axis=1, keepdims=True), index=counts.index, columns=counts.columns)
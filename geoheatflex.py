@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Command-line entry point for GeoHeatFlex. Each pipeline stage is a subcommand
+that brings the stage and the stages it depends on up to date, with parameters
+read from a YAML configuration file. Stages run as separate processes, so this
+only imports what is needed to parse the configuration.
+
+Usage: python geoheatflex.py <stage | all | config> [--config FILE] [--set STAGE.PARAMETER=VALUE]
+                             [--no-plots] [--force] [--workers N] [--directory DIR]
+                             [--profile [DIR]] [--profiler {cprofile,py-spy}]
+
+"""
+
+import argparse
+import os
+import sys
+import time
+from instrumentation import PROFILERS, read_reports, summary_table
+from pipeline import STAGES, resolve_parameters, run_pipeline
+
+DEFAULT_CONFIG = 'config.yaml'
+DEFAULT_PROFILE_DIR = 'Results/profiles'
+# folders the stages read from and write to, relative to the project directory
+PROJECT_FOLDERS = ['Resources', 'Results', 'Plots']
+
+def read_config(path):
+    '''
+    read a configuration file
+
+    Parameters
+    ----------
+    path : str
+        path of YAML file with optional 'plots', 'workers' and 'parameters'
+        entries, where 'parameters' overrides stage parameters in pipeline.py,
+        e.g. {'heating_losses': {'min_years': 3}}.
+
+    Returns
+    -------
+    config : dict
+        configuration.
+
+    '''
+    import yaml
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    unknown = set(config) - {'plots', 'workers', 'parameters'}
+    if unknown:
+        raise ValueError(f'unknown configuration entries in {path}: {", ".join(sorted(unknown))}')
+    return config
+
+def parse_setting(setting):
+    '''
+    parameter override from the command line
+
+    Parameters
+    ----------
+    setting : str
+        override such as 'regional_HDDs.threshold=15' or
+        'time_constants.monte_carlo.draws=100'. Values are read as YAML.
+
+    Returns
+    -------
+    override : dict
+        nested parameter override.
+
+    '''
+    import yaml
+    name, separator, value = setting.partition('=')
+    keys = name.split('.')
+    if not separator or len(keys) < 2:
+        raise ValueError(f'settings must look like STAGE.PARAMETER=VALUE, not {setting}')
+    override = yaml.safe_load(value)
+    for key in reversed(keys):
+        override = {key: override}
+    return override
+
+def _update(config, override):
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            _update(config[key], value)
+        else:
+            config[key] = value
+    return config
+
+def main(arguments=None):
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--config', default=None,
+                         help=f'YAML configuration file. Default is {DEFAULT_CONFIG} if it exists.')
+    options.add_argument('--set', action='append', default=[], metavar='STAGE.PARAMETER=VALUE',
+                         help='override a parameter; can be given more than once')
+    options.add_argument('--no-plots', action='store_true', help='do not draw plots or maps')
+    options.add_argument('--force', action='store_true', help='rerun stages even if up to date')
+    options.add_argument('--workers', type=int, default=None, help='maximum number of stages run at once')
+    options.add_argument('--directory', default='.',
+                         help='project directory with Data, Resources, Results and Plots folders. Default is the current directory.')
+    options.add_argument('--profile', nargs='?', const=DEFAULT_PROFILE_DIR, default=None, metavar='DIR',
+                         help=f'write a timing and memory report for each stage run to DIR. Default DIR is {DEFAULT_PROFILE_DIR}.')
+    options.add_argument('--profiler', choices=PROFILERS, default=None,
+                         help='also profile each stage run with cProfile or py-spy; requires --profile')
+
+    parser = argparse.ArgumentParser(prog='geoheatflex', description='Quantify geospatial heating flexibility.')
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+    for name, stage in STAGES.items():
+        commands.add_parser(name, parents=[options],
+                            help=f'run {stage["script"]} and the stages it depends on if out of date')
+    commands.add_parser('all', parents=[options], help='run every stage that is out of date')
+    commands.add_parser('config', parents=[options], help='print the configuration with every parameter')
+    arguments = parser.parse_args(arguments)
+    if arguments.profiler is not None and arguments.profile is None:
+        parser.error('--profiler requires --profile')
+
+    # a configuration file given on the command line is relative to where it was run
+    config_file = os.path.abspath(arguments.config) if arguments.config is not None else None
+    os.chdir(arguments.directory)
+    try:
+        config = {}
+        if config_file is not None or os.path.exists(DEFAULT_CONFIG):
+            config = read_config(config_file or DEFAULT_CONFIG)
+        parameters = config.get('parameters') or {}
+        for setting in arguments.set:
+            _update(parameters, parse_setting(setting))
+        resolved = resolve_parameters(parameters)
+    except (KeyError, ValueError) as error:
+        parser.error(str(error).strip("'"))
+    plots = config.get('plots', True) and not arguments.no_plots
+    workers = arguments.workers or config.get('workers')
+
+    if arguments.command == 'config':
+        import yaml
+        yaml.safe_dump({'plots': plots, 'workers': workers, 'parameters': resolved}, sys.stdout, sort_keys=False)
+        return
+
+    for folder in PROJECT_FOLDERS:
+        os.makedirs(folder, exist_ok=True)
+    start = time.time()
+    run_pipeline(None if arguments.command == 'all' else [arguments.command], force=arguments.force,
+                 max_workers=workers, parameters=parameters, plots=plots,
+                 profile=arguments.profile, profiler=arguments.profiler)
+    if arguments.profile is not None:
+        # one table for every stage run, in the order they finished
+        reports = read_reports(arguments.profile, since=start)
+        if reports:
+            print(summary_table([record for report in reports for record in report['steps']]))
+
+
+if __name__ == "__main__":
+
+    main()
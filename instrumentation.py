@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Times the logical steps of each pipeline stage and records their memory use.
+Scripts wrap steps in step(), which records wall and CPU time and resident
+memory, and dask computations in dask_report(). Recording is always on and
+cheap. If GEOHEATFLEX_PROFILE names a folder, which geoheatflex.py --profile
+sets, resident memory is also sampled in the background where the kernel does
+not record its peak. At the end of the stage a JSON report and a summary
+table are written to that folder, optionally with a cProfile or py-spy profile.
+Memory of worker processes started by a step is not included.
+
+"""
+
+import contextlib
+import datetime
+import glob
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import warnings
+
+PROFILE_VARIABLE = 'GEOHEATFLEX_PROFILE'
+PROFILER_VARIABLE = 'GEOHEATFLEX_PROFILER'
+PROFILERS = ['cprofile', 'py-spy']
+
+# finished steps, and steps that are still running from outermost to innermost
+_steps = []
+_open = []
+_started = itertools.count()
+_dask = {}
+
+def current_rss():
+    '''
+    resident memory of this process in MB, or None where it cannot be measured
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss/2**20
+
+def _peak_rss():
+    # highest resident memory since the peak was last reset, on Linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/2**10
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _update_peaks():
+    # the peak since the last reset counts towards every running step
+    rss = max([value for value in (current_rss(), _peak_rss()) if value is not None], default=None)
+    if rss is not None:
+        for record in list(_open):
+            record['peak RSS [MB]'] = max(record['peak RSS [MB]'], rss)
+    return rss
+
+class _MemorySampler(threading.Thread):
+    '''
+    updates the peak resident memory of every running step at a fixed interval,
+    where the kernel does not keep the peak since a step started
+    '''
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if _update_peaks() is None:
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+@contextlib.contextmanager
+def step(name):
+    '''
+    record the wall time, CPU time and resident memory of a step. Steps may be
+    nested, and are named by their path, e.g. 'time_constants/write tables'.
+    On Linux the peak comes from the kernel's high-water mark, which is reset
+    at the start of each step, so it is exact.
+
+    Parameters
+    ----------
+    name : str
+        name of step.
+
+    Yields
+    ------
+    record : dict
+        record of the step, filled in when it finishes.
+
+    '''
+    # the peak so far belongs to the steps already running
+    _update_peaks()
+    _reset_peak()
+    rss = current_rss()
+    record = {'step': '/'.join([parent['name'] for parent in _open] + [name]), 'name': name,
+              'depth': len(_open), 'started': next(_started), 'start RSS [MB]': rss,
+              'peak RSS [MB]': rss if rss is not None else float('nan')}
+    _open.append(record)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall time [s]'] = time.perf_counter() - wall
+        record['CPU time [s]'] = time.process_time() - cpu
+        _update_peaks()
+        record['end RSS [MB]'] = current_rss()
+        _open.remove(record)
+        _steps.append(record)
+
+@contextlib.contextmanager
+def dask_report(name):
+    '''
+    profile dask computations while profiling is on. With a dask.distributed
+    client, its HTML performance report is saved to the profile folder;
+    otherwise task time on the local scheduler is summed by task name for the
+    JSON report. Does nothing if profiling is off or dask is not installed.
+
+    Parameters
+    ----------
+    name : str
+        name of the computation in the report.
+
+    Yields
+    ------
+    None.
+
+    '''
+    folder = os.environ.get(PROFILE_VARIABLE)
+    if folder is None:
+        yield
+        return
+    try:
+        from distributed import get_client, performance_report
+        get_client()
+    except (ImportError, ValueError):
+        pass
+    else:
+        with performance_report(filename=os.path.join(folder, f'{_run_name()} {name}.html')):
+            yield
+        return
+    try:
+        from dask.diagnostics import Profiler
+        from dask.utils import key_split
+    except ImportError:
+        yield
+        return
+    with Profiler() as profiler:
+        yield
+    task_time = {}
+    for task in profiler.results:
+        prefix = key_split(task.key)
+        task_time[prefix] = task_time.get(prefix, 0.) + task.end_time - task.start_time
+    _dask[name] = {'tasks': len(profiler.results),
+                   'task time [s]': dict(sorted(task_time.items(), key=lambda item: -item[1]))}
+
+_run = {}
+
+def _run_name():
+    return f'{_run["stage"]} {_run["start"]}' if _run else 'run'
+
+def _start_profiler(profiler, filename):
+    if profiler == 'cprofile':
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+    if profiler == 'py-spy':
+        # py-spy samples this process from outside, so native and numpy frames are included
+        try:
+            return subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses',
+                                     '--format', 'speedscope', '--output', filename + '.speedscope.json'])
+        except OSError:
+            warnings.warn('py-spy is not installed, so no profile is recorded')
+            return None
+    raise ValueError(f'profiler must be one of {", ".join(PROFILERS)}, not {profiler}')
+
+def _stop_profiler(profile, filename):
+    if profile is None:
+        return
+    if isinstance(profile, subprocess.Popen):
+        # py-spy writes its output when interrupted
+        profile.send_signal(signal.SIGINT)
+        profile.wait()
+    else:
+        profile.disable()
+        profile.dump_stats(filename + '.prof')
+
+@contextlib.contextmanager
+def instrumented_run(stage):
+    '''
+    record a pipeline stage as one outer step. If GEOHEATFLEX_PROFILE is set,
+    memory is sampled while it runs, the profiler named by
+    GEOHEATFLEX_PROFILER is run, and a report is written at the end.
+
+    Parameters
+    ----------
+    stage : str
+        name of stage.
+
+    Yields
+    ------
+    None.
+
+    '''
+    folder = os.environ.get(PROFILE_VARIABLE)
+    if folder is None:
+        with step(stage):
+            yield
+        return
+    os.makedirs(folder, exist_ok=True)
+    _run.update(stage=stage, start=datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    filename = os.path.join(folder, _run_name())
+    sampler = _MemorySampler()
+    sampler.start()
+    profile = _start_profiler(os.environ[PROFILER_VARIABLE], filename) if os.environ.get(PROFILER_VARIABLE) else None
+    try:
+        with step(stage):
+            yield
+    finally:
+        _stop_profiler(profile, filename)
+        sampler.stop()
+        table = summary_table(write_report(filename + '.json', stage)['steps'])
+        with open(filename + '.txt', 'w') as f:
+            f.write(table + '\n')
+        print(table)
+
+def write_report(filename, stage):
+    '''
+    write the steps recorded in this process to a JSON report
+
+    Parameters
+    ----------
+    filename : str
+        path of JSON file.
+    stage : str
+        name of stage.
+
+    Returns
+    -------
+    report : dict
+        stage, start time, Python version, steps in the order they started and
+        dask profiles.
+
+    '''
+    steps = sorted(_steps, key=lambda record: record['started'])
+    report = {'stage': stage, 'start': _run.get('start'), 'python': sys.version.split()[0],
+              'steps': steps, 'dask': dict(_dask)}
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+def summary_table(steps):
+    '''
+    table of the time and memory of each step, with nested steps indented
+
+    Parameters
+    ----------
+    steps : list of dict
+        step records from a report.
+
+    Returns
+    -------
+    table : str
+        summary table.
+
+    '''
+    totals = {record['step']: record['wall time [s]'] for record in steps if record['depth'] == 0}
+    rows = [f'{"Step":<48} {"Wall [s]":>9} {"CPU [s]":>9} {"Share":>6} {"Peak RSS [MB]":>14} {"Change [MB]":>12}']
+    for record in steps:
+        total = totals.get(record['step'].split('/')[0]) or float('nan')
+        change = (record['end RSS [MB]'] - record['start RSS [MB]']
+                  if record['end RSS [MB]'] is not None and record['start RSS [MB]'] is not None else float('nan'))
+        name = '  '*record['depth'] + record['name']
+        rows.append(f'{name[:48]:<48} {record["wall time [s]"]:>9.2f} {record["CPU time [s]"]:>9.2f} '
+                    f'{record["wall time [s]"]/total:>6.0%} {record["peak RSS [MB]"]:>14.0f} {change:>12.0f}')
+    return '\n'.join(rows)
+
+def read_reports(folder, since=None):
+    '''
+    read reports from a profile folder
+
+    Parameters
+    ----------
+    folder : str
+        profile folder.
+    since : float, optional
+        only read reports written after this time in seconds since the epoch.
+        The default is None, which reads every report.
+
+    Returns
+    -------
+    reports : list of dict
+        reports in the order they were written.
+
+    '''
+    files = sorted(glob.glob(os.path.join(folder, '*.json')), key=os.path.getmtime)
+    reports = []
+    for file in files:
+        if since is not None and os.path.getmtime(file) < since:
+            continue
+        with open(file) as f:
+            report = json.load(f)
+        if 'steps' in report:
+            reports.append(report)
+    return reports
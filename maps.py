@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Renders choropleth maps of regional results. Region boundaries from the
+registry are simplified once for each zoom level, with a tolerance below half
+a pixel at the output resolution so maps look the same as with full-resolution
+boundaries, and cached. Each worker process builds the patches for the regions
+once and only changes their colours for each map, and maps are rendered in
+parallel.
+
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+import geopandas as gpd
+import matplotlib
+from matplotlib.collections import PatchCollection
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
+from caching import combined_hash, file_hash
+from pipeline_io import REGISTRY_FILE, region_geometry
+
+MAP_CACHE_DIR = 'Resources/map cache'
+
+def zoom_level(bounds, dpi, figsize=None):
+    '''
+    zoom level for maps of an area at a resolution. Boundaries simplified for
+    zoom level z are simplified with a tolerance of 2**-z map units, which is at
+    most half a pixel.
+
+    Parameters
+    ----------
+    bounds : tuple
+        minx, miny, maxx, maxy of the mapped area.
+    dpi : float
+        output resolution in dots per inch.
+    figsize : tuple, optional
+        figure width and height in inches. The default is None, which uses the
+        matplotlib default.
+
+    Returns
+    -------
+    level : int
+        zoom level.
+
+    '''
+    width, height = figsize or matplotlib.rcParams['figure.figsize']
+    minx, miny, maxx, maxy = bounds
+    # the map fills at most the whole figure in its limiting direction
+    pixel = max((maxx - minx)/(width*dpi), (maxy - miny)/(height*dpi))
+    return int(np.ceil(-np.log2(pixel/2)))
+
+def simplified_boundaries(level, path=REGISTRY_FILE, cache_dir=MAP_CACHE_DIR):
+    '''
+    region boundaries from the registry simplified for a zoom level. Shared
+    edges between neighbouring regions are simplified together so no gaps or
+    overlaps appear between them.
+
+    Parameters
+    ----------
+    level : int
+        zoom level from zoom_level.
+    path : str, optional
+        path of registry GeoParquet file. The default is REGISTRY_FILE.
+    cache_dir : str, optional
+        folder for cached boundaries. The default is MAP_CACHE_DIR.
+
+    Returns
+    -------
+    geometry : geoseries
+        simplified boundaries indexed by region code.
+
+    '''
+    filename = os.path.join(cache_dir, f'boundaries_z{level}_{combined_hash(file_hash(path), level)}.parquet')
+    if os.path.exists(filename):
+        return gpd.read_parquet(filename).geometry
+    geometry = region_geometry(path=path)
+    tolerance = 2.**-level
+    try:
+        simplified = shapely.coverage_simplify(geometry.to_numpy(), tolerance)
+    except (AttributeError, shapely.errors.GEOSException):
+        # older shapely, or boundaries that are not a valid coverage
+        simplified = shapely.simplify(geometry.to_numpy(), tolerance, preserve_topology=True)
+    simplified = gpd.GeoSeries(simplified, index=geometry.index, crs=geometry.crs, name='geometry')
+    os.makedirs(cache_dir, exist_ok=True)
+    simplified.to_frame().to_parquet(filename)
+    return simplified
+
+def _region_patch(polygon):
+    '''
+    patch for a (multi)polygon, built in the same way as GeoDataFrame.plot
+    '''
+    paths = []
+    for part in getattr(polygon, 'geoms', [polygon]):
+        part = shapely.geometry.polygon.orient(part)
+        paths.append(Path(np.asarray(part.exterior.coords)[:, :2], closed=True))
+        paths.extend(Path(np.asarray(ring.coords)[:, :2], closed=True) for ring in part.interiors)
+    return PathPatch(Path.make_compound_path(*paths))
+
+# figures built in this process, keyed by zoom level
+_canvases = {}
+_worker_regions = {}
+
+def _init_worker(codes, path, cache_dir, figsize):
+    _canvases.clear()
+    _worker_regions.update(codes=codes, path=path, cache_dir=cache_dir, figsize=figsize)
+
+def _canvas(level):
+    '''
+    figure, axes and patches for the regions at a zoom level, built on first
+    use and reused for every map after that
+    '''
+    if level not in _canvases:
+        geometry = simplified_boundaries(level, _worker_regions['path'], _worker_regions['cache_dir'])
+        geometry = geometry.reindex(_worker_regions['codes'])
+        drawn = (~geometry.isna()).to_numpy()
+        fig = Figure(figsize=_worker_regions['figsize'])
+        ax = fig.add_subplot()
+        patches = [_region_patch(polygon) for polygon in geometry[drawn]]
+        collection = PatchCollection(patches)
+        collection.set_array(np.zeros(drawn.sum()))
+        ax.add_collection(collection, autolim=True)
+        ax.autoscale_view()
+        ax.set_aspect('equal')
+        ax.set_axis_off()
+        fig.canvas.draw()
+        # colour bar of the last map, replaced for each map
+        _canvases[level] = [fig, ax, collection, drawn, patches, None]
+    return _canvases[level]
+
+def _render(level, values, filename, cmap='viridis', vmin=None, vmax=None, label=None,
+            title=None, dpi=300, missing_color=None):
+    canvas = _canvas(level)
+    fig, ax, collection, drawn, patches, colorbar = canvas
+    colormap = matplotlib.colormaps[cmap] if isinstance(cmap, str) else cmap
+    # regions without values are left blank unless a colour is given for them
+    colormap = colormap.with_extremes(bad=missing_color if missing_color is not None else (0, 0, 0, 0))
+    values = np.asarray(values, dtype=float)[drawn]
+    # regions without values go on top, as GeoDataFrame.plot draws them last
+    order = np.argsort(np.isnan(values), kind='stable')
+    values = np.ma.masked_invalid(values[order])
+    norm = Normalize(vmin, vmax)
+    norm.autoscale_None(values)
+    collection.set_paths([patches[i] for i in order])
+    collection.set_array(values)
+    collection.set_cmap(colormap)
+    collection.set_norm(norm)
+    ax.set_title(title or '')
+
+    # colour bar as drawn by GeoDataFrame.plot, with arrows for values out of range
+    if colorbar is not None:
+        colorbar.remove()
+    below, above = values.min() < norm.vmin, values.max() > norm.vmax
+    extend = {(True, True): 'both', (True, False): 'min', (False, True): 'max'}.get((below, above), 'neither')
+    ratio = ax.get_position().height/ax.get_position(original=True).height
+    canvas[5] = fig.colorbar(ScalarMappable(norm=norm, cmap=colormap), ax=ax, extend=extend,
+                             shrink=ratio, aspect=20*ratio, label=label or '')
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    fig.savefig(filename, dpi=dpi)
+    return filename
+
+def render_maps(regions, maps, n_workers=None, figsize=None, path=REGISTRY_FILE,
+                cache_dir=MAP_CACHE_DIR):
+    '''
+    render choropleth maps of columns of a table of regional results
+
+    Parameters
+    ----------
+    regions : pandas DataFrame
+        results indexed by region code.
+    maps : list of dict
+        one dict for each map with the 'column' to map and the output
+        'filename', and optionally 'cmap', 'vmin', 'vmax', 'label' for the
+        colour bar, 'title', 'dpi' (default 300) and 'missing_color' for regions
+        without a value.
+    n_workers : int, optional
+        number of worker processes. The default is None, which uses all CPUs;
+        1 renders in the current process.
+    figsize : tuple, optional
+        figure width and height in inches. The default is None, which uses the
+        matplotlib default.
+    path : str, optional
+        path of registry GeoParquet file. The default is REGISTRY_FILE.
+    cache_dir : str, optional
+        folder for cached boundaries. The default is MAP_CACHE_DIR.
+
+    Returns
+    -------
+    filenames : list of str
+        files written.
+
+    '''
+    codes = regions.index.to_numpy()
+    figsize = tuple(figsize or matplotlib.rcParams['figure.figsize'])
+    bounds = region_geometry(codes, path).total_bounds
+    tasks = []
+    for spec in maps:
+        spec = dict(spec)
+        level = zoom_level(bounds, spec.setdefault('dpi', 300), figsize)
+        # simplified once here so workers only read the cache
+        simplified_boundaries(level, path, cache_dir)
+        tasks.append((level, regions[spec.pop('column')].to_numpy(), spec))
+
+    initargs = (codes, path, cache_dir, figsize)
+    if n_workers == 1 or len(tasks) == 1:
+        _init_worker(*initargs)
+        return [_render(level, values, **spec) for level, values, spec in tasks]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=initargs) as executor:
+        futures = [executor.submit(_render, level, values, **spec) for level, values, spec in tasks]
+        return [future.result() for future in futures]
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the GeoHeatFlex scripts as a pipeline of stages. Each stage is keyed on a
+hash of its script and the local modules it imports, its parameters, its input
+data and the keys of the stages it depends on. A stage is only rerun if its key
+has changed since it last succeeded or one of its outputs is missing, and
+stages that do not depend on each other are run in parallel.
+
+Usage: python pipeline.py [stage ...] [--force] [--workers N] [--no-plots] [--profile DIR]
+
+"""
+
+import argparse
+import ast
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from caching import combined_hash, file_hash, file_signature_hash
+from instrumentation import PROFILE_VARIABLE, PROFILER_VARIABLE
+
+STATE_FILE = 'Resources/pipeline_state.json'
+PARAMETERS_VARIABLE = 'GEOHEATFLEX_PARAMETERS'
+PLOTS_VARIABLE = 'GEOHEATFLEX_PLOTS'
+# scripts are found here, while data and results are relative to the working directory
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# inputs are hashed by content; signature_inputs are large raw datasets that are
+# not edited in place, so only their names, sizes and modification times are hashed
+STAGES = {
+    'temperature_store': {
+        'script': 'temperature_store.py',
+        'depends': [],
+        'inputs': [],
+        'signature_inputs': ['Data/tasmin/*.nc', 'Data/tasmax/*.nc'],
+        'outputs': ['Resources/mean_temperature.zarr'],
+        'parameters': {},
+        },
+    'regional_HDDs': {
+        'script': 'calculate_regional_HDDs.py',
+        'depends': ['temperature_store'],
+        'inputs': ['Data/SG_DataZoneBdry_2011/SG_DataZone_Bdry_2011.shp',
+                   'Data/Lower_Layer_Super_Output_Areas_Dec_2011_Boundaries_Full_Extent_BFE_EW_V3_2022_-4926191891001926707.geojson'],
+        'signature_inputs': [],
+        'outputs': ['Resources/region_boundaries.parquet',
+                    'Resources/LSOA_HDDs_2010-2022.parquet',
+                    'Resources/DZ_HDDs_2010-2022.parquet',
+                    'Resources/LSOA_HDD_thresholds.parquet',
+                    'Resources/DZ_HDD_thresholds.parquet'],
+        'parameters': {'threshold': 15.5,
+                       # HDDs are also saved at these thresholds for uncertainty analysis
+                       'threshold_grid': [14., 14.5, 15., 15.5, 16., 16.5, 17.],
+                       'sampling_method': 'representative_point',
+                       # cells along each side of a spatial tile, or None to reduce the whole grid at once
+                       'tile_size': None,
+                       # also export the HDD tables as GeoJSON with boundaries
+                       'geojson': False},
+        },
+    'heating_losses': {
+        'script': 'calculate_heating_losses.py',
+        'depends': ['regional_HDDs'],
+        'inputs': ['Data/LSOA_domestic_gas_2010-21.xlsx',
+                   'Data/ECUK_2022_End_Use_tables_27102022.xlsx'],
+        'signature_inputs': [],
+        'outputs': ['Resources/LSOA_gas_heat_loss_2017-2021.parquet',
+                    'Resources/DZ_gas_heat_loss_2017-2021.parquet'],
+        # 'pooled', 'per_year_mean' or 'least_squares'; regions with fewer years of data are left out
+        'parameters': {'heat_loss_method': 'pooled',
+                       'min_years': 5,
+                       # also export the heat loss tables as GeoJSON with boundaries
+                       'geojson': False},
+        },
+    'time_constants': {
+        'script': 'calculate_time_constants.py',
+        'depends': ['heating_losses'],
+        'inputs': ['Data/England_and_Wales_census_2011_number_of_rooms.csv',
+                   'Data/Scotland_census_2011_number_of_rooms.xlsx'],
+        'signature_inputs': [],
+        'outputs': ['Resources/LSOA_gas_time_constants.parquet',
+                    'Resources/DZ_gas_time_constants.parquet',
+                    'Resources/regional_thermal_time_constants.parquet',
+                    'Results/regional_thermal_time_constants.geojson',
+                    'Results/regional_thermal_time_constants.csv',
+                    'Results/thermal time constant percentiles.csv',
+                    'Results/national TES capacity draws.csv'],
+        'parameters': {'floor_area_per_room': 17.6, # m2
+                       'specific_thermal_capacity': 250/3600, # kWh/m2/C, SAP 2012 medium
+                       'delta_T': 3, # C
+                       # also export the LSOA and DZ time constant tables as GeoJSON with boundaries
+                       'geojson': False,
+                       # uncertainty analysis, skipped if draws is 0; sampled thresholds
+                       # must lie within the regional_HDDs threshold_grid
+                       'monte_carlo': {
+                           'draws': 1000,
+                           'seed': 0,
+                           'percentiles': [5, 50, 95],
+                           'distributions': {
+                               'floor_area_per_room': {'distribution': 'normal', 'loc': 17.6, 'scale': 1.76},
+                               # SAP 2012 low, medium and high
+                               'specific_thermal_capacity': {'distribution': 'triangular', 'left': 100/3600,
+                                                             'mode': 250/3600, 'right': 450/3600},
+                               'nine_or_more_rooms': {'distribution': 'uniform', 'low': 9., 'high': 11.},
+                               'threshold': {'distribution': 'uniform', 'low': 14.5, 'high': 16.5},
+                               },
+                           },
+                       },
+        },
+    'flexibility_duration': {
+        'script': 'calculate_flexibility_duration.py',
+        'depends': ['temperature_store', 'time_constants'],
+        'inputs': [],
+        'signature_inputs': [],
+        'outputs': ['Results/heat-free hours at winter temperatures.csv'],
+        'parameters': {'initial_temp': 21., # C
+                       'final_temp': 18., # C
+                       # for comfortable heat-free hours at a uniform outdoor temperature
+                       'outdoor_temp': 5., # C
+                       # 'exact' or 'histogram' for bounded memory on long records
+                       'quantile_method': 'exact',
+                       # cells along each side of a spatial tile, or None to reduce the whole grid at once
+                       'tile_size': None},
+        },
+    'heat_free_hours_simulation': {
+        'script': 'simulate_heat_free_hours.py',
+        'depends': ['temperature_store', 'time_constants'],
+        'inputs': [],
+        'signature_inputs': [],
+        'outputs': ['Results/heat_free_hours.zarr',
+                    'Results/heat-free hours quantiles.csv'],
+        'parameters': {'initial_temp': 21., # C
+                       'final_temp': 18., # C
+                       'days_per_block': 90,
+                       # 'representative_point' or 'area_weighted'
+                       'sampling_method': 'representative_point',
+                       'quantiles': [0.01, 0.05, 0.5, 0.95]},
+        },
+    'EoH_time_constants': {
+        'script': 'EoH_time_constants.py',
+        'depends': [],
+        'inputs': [],
+        'signature_inputs': ['Data/Electrification of Heat/Dataset 1/*.csv',
+                             'Data/Electrification of Heat/Dataset 2/*.csv'],
+        'outputs': ['Resources/EoH time constants.csv'],
+        # cooling period lengths in minutes; fit_method is 'log-linear' or 'nonlinear'
+        'parameters': {'durations': [30, 60, 90, 120, 180, 240],
+                       'fit_method': 'log-linear'},
+        },
+    'validation': {
+        'script': 'validate_time_constants.py',
+        'depends': ['time_constants', 'EoH_time_constants'],
+        'inputs': ['Data/UKERC/01 - Thermal_Characteristics/Thermal_characteristics_beforeEE.csv',
+                   'Data/UKERC/01 - Thermal_Characteristics/Thermal_characteristics_afterEE.csv'],
+        'signature_inputs': [],
+        'outputs': ['Results/time constant comparison.csv'],
+        'parameters': {},
+        },
+    }
+
+def stage_parameters(stage):
+    '''
+    parameters of a stage. Scripts call this to pick up the values the runner
+    hashed, so they match the stage key; run on their own they get the defaults.
+    A script may read the parameters of its own stage and of stages upstream of
+    it, which are part of its key through theirs.
+
+    Parameters
+    ----------
+    stage : str
+        name of stage in STAGES.
+
+    Returns
+    -------
+    parameters : dict
+        parameter values.
+
+    '''
+    if PARAMETERS_VARIABLE in os.environ:
+        return json.loads(os.environ[PARAMETERS_VARIABLE])[stage]
+    return dict(STAGES[stage]['parameters'])
+
+def plots_enabled():
+    '''
+    whether scripts should draw plots and maps. Plots are drawn unless the
+    runner was asked not to, and plotting libraries are only imported if so.
+
+    Returns
+    -------
+    plots : bool
+        True if plots should be drawn.
+
+    '''
+    return os.environ.get(PLOTS_VARIABLE, '1') != '0'
+
+def _merge(defaults, overrides, name):
+    '''
+    defaults updated with overrides, merging nested dicts so e.g. only the
+    number of Monte Carlo draws can be changed. A distribution is replaced as a
+    whole, since arguments of one distribution do not apply to another.
+    '''
+    merged = dict(defaults)
+    for key, value in overrides.items():
+        if key not in defaults:
+            raise KeyError(f'unknown parameter {name}.{key}; parameters are {", ".join(defaults)}')
+        if (isinstance(value, dict) and isinstance(defaults[key], dict)
+                and 'distribution' not in value):
+            merged[key] = _merge(defaults[key], value, f'{name}.{key}')
+        else:
+            merged[key] = value
+    return merged
+
+def resolve_parameters(parameters=None):
+    '''
+    parameters of every stage, with defaults updated by overrides
+
+    Parameters
+    ----------
+    parameters : dict, optional
+        parameter overrides for each stage, e.g. {'regional_HDDs': {'threshold': 15.}}.
+        Nested dicts are merged. The default is None.
+
+    Returns
+    -------
+    parameters : dict
+        parameter values of each stage.
+
+    '''
+    parameters = parameters or {}
+    for name in parameters:
+        if name not in STAGES:
+            raise KeyError(f'unknown stage {name}; stages are {", ".join(STAGES)}')
+    return {name: _merge(stage['parameters'], parameters.get(name, {}), name)
+            for name, stage in STAGES.items()}
+
+def _local_sources(script):
+    '''
+    the script and every module in CODE_DIR that it imports, directly or
+    through other local modules
+    '''
+    sources = []
+    pending = [script]
+    while pending:
+        source = pending.pop()
+        if source in sources:
+            continue
+        sources.append(source)
+        with open(os.path.join(CODE_DIR, source)) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module is not None and node.level == 0:
+                names = [node.module]
+            else:
+                continue
+            # this file is left out, since parameters are hashed per stage
+            pending.extend(name + '.py' for name in names
+                           if os.path.isfile(os.path.join(CODE_DIR, name + '.py')) and name != 'pipeline')
+    return sorted(sources)
+
+def _expand(patterns):
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f'no input files match {pattern}')
+        paths.extend(matches)
+    return paths
+
+def stage_keys(stages, parameters=None):
+    '''
+    hash keys of stages, in dependency order
+
+    Parameters
+    ----------
+    stages : list of str
+        names of stages, with every dependency listed before the stages that use it.
+    parameters : dict, optional
+        parameter overrides for each stage. The default is None.
+
+    Returns
+    -------
+    keys : dict
+        key of each stage.
+
+    '''
+    parameters = resolve_parameters(parameters or {})
+    keys = {}
+    for name in stages:
+        stage = STAGES[name]
+        keys[name] = combined_hash(
+            *(f'{source}:{file_hash(os.path.join(CODE_DIR, source))}' for source in _local_sources(stage['script'])),
+            json.dumps(parameters[name], sort_keys=True),
+            *(f'{path}:{file_hash(path)}' for path in _expand(stage['inputs'])),
+            file_signature_hash(_expand(stage['signature_inputs'])),
+            *(keys[dependency] for dependency in stage['depends']))
+    return keys
+
+def _ordered_stages(targets):
+    '''
+    targets and all stages they depend on, with dependencies first
+    '''
+    ordered = []
+    def visit(name):
+        if name not in STAGES:
+            raise KeyError(f'unknown stage {name}; stages are {", ".join(STAGES)}')
+        if name in ordered:
+            return
+        for dependency in STAGES[name]['depends']:
+            visit(dependency)
+        ordered.append(name)
+    for name in targets:
+        visit(name)
+    return ordered
+
+def _load_state(state_file):
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+def _save_state(state, state_file):
+    os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_file + '.tmp', state_file)
+
+def _run_stage(name, parameters, plots=True, profile=None, profiler=None):
+    environment = dict(os.environ)
+    environment[PARAMETERS_VARIABLE] = json.dumps(parameters)
+    environment[PLOTS_VARIABLE] = '1' if plots else '0'
+    for variable, value in ((PROFILE_VARIABLE, profile), (PROFILER_VARIABLE, profiler)):
+        if value is None:
+            environment.pop(variable, None)
+        else:
+            environment[variable] = value
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(CODE_DIR, STAGES[name]['script'])], env=environment, check=True)
+    return time.perf_counter() - start
+
+def run_pipeline(targets=None, force=False, max_workers=None, parameters=None,
+                 state_file=STATE_FILE, plots=True, profile=None, profiler=None):
+    '''
+    run stages whose key has changed or whose outputs are missing, running
+    independent stages in parallel
+
+    Parameters
+    ----------
+    targets : list of str, optional
+        stages to bring up to date, along with the stages they depend on. The
+        default is None, which runs every stage.
+    force : bool, optional
+        rerun stages even if they are up to date. The default is False.
+    max_workers : int, optional
+        maximum number of stages run at once. The default is None, which runs
+        every stage that is ready.
+    parameters : dict, optional
+        parameter overrides for each stage, e.g. {'regional_HDDs': {'threshold': 15.}}.
+        The default is None.
+    state_file : str, optional
+        file recording the key each stage last succeeded with. The default is STATE_FILE.
+    plots : bool, optional
+        draw plots and maps. Plots are not part of the stage keys, so use force
+        to draw them for stages that are up to date. The default is True.
+    profile : str, optional
+        folder for a timing and memory report of each stage that is run, see
+        instrumentation.py. The default is None, which writes no reports.
+    profiler : str, optional
+        'cprofile' or 'py-spy' to also profile each stage that is run when
+        profile is set. The default is None.
+
+    Returns
+    -------
+    run : list of str
+        stages that were run.
+
+    '''
+    parameters = parameters or {}
+    stages = _ordered_stages(targets or list(STAGES))
+    keys = stage_keys(stages, parameters)
+    resolved = resolve_parameters(parameters)
+    state = _load_state(state_file)
+
+    def up_to_date(name):
+        return (not force and state.get(name) == keys[name]
+                and all(os.path.exists(output) for output in STAGES[name]['outputs']))
+
+    pending = [name for name in stages if not up_to_date(name)]
+    for name in stages:
+        if name not in pending:
+            print(f'{name} is up to date')
+
+    run = []
+    running = {}
+    failed = None
+    with ThreadPoolExecutor(max_workers=max_workers or len(STAGES)) as executor:
+        while pending or running:
+            if failed is None:
+                for name in list(pending):
+                    if not any(dependency in pending or dependency in running.values()
+                               for dependency in STAGES[name]['depends']):
+                        print(f'running {name}')
+                        running[executor.submit(_run_stage, name, resolved, plots, profile, profiler)] = name
+                        pending.remove(name)
+            elif not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    elapsed = future.result()
+                except subprocess.CalledProcessError as error:
+                    print(f'{name} failed with exit code {error.returncode}')
+                    failed = failed or error
+                    state.pop(name, None)
+                else:
+                    print(f'{name} finished in {elapsed:.1f} s')
+                    state[name] = keys[name]
+                    run.append(name)
+                _save_state(state, state_file)
+    if failed is not None:
+        raise failed
+    return run
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run GeoHeatFlex stages that are out of date.')
+    parser.add_argument('stages', nargs='*', help=f'stages to run: {", ".join(STAGES)}. Default is all.')
+    parser.add_argument('--force', action='store_true', help='rerun stages even if up to date')
+    parser.add_argument('--workers', type=int, default=None, help='maximum number of stages run at once')
+    parser.add_argument('--no-plots', action='store_true', help='do not draw plots or maps')
+    parser.add_argument('--profile', default=None, metavar='DIR', help='write timing and memory reports to DIR')
+    arguments = parser.parse_args()
+
+    run_pipeline(arguments.stages or None, force=arguments.force, max_workers=arguments.workers,
+                 plots=not arguments.no_plots, profile=arguments.profile)
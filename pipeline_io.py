@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Reads and writes the files handed between pipeline stages. Region boundaries
+are held once in a GeoParquet registry keyed by LSOA11CD/DataZone code, and the
+numeric results of each stage are plain Parquet tables keyed by the same code.
+Geometry is only attached to a table when it is needed for a map or an export.
+Tables parsed from slow sources such as Excel workbooks are cached as Parquet.
+
+"""
+
+import functools
+import json
+import os
+import pandas as pd
+from caching import combined_hash, file_hash, file_signature_hash
+
+REGISTRY_FILE = 'Resources/region_boundaries.parquet'
+
+def write_region_registry(regions, path=REGISTRY_FILE):
+    '''
+    write the boundaries of all regions to the registry
+
+    Parameters
+    ----------
+    regions : list of geodataframe
+        regions indexed by LSOA11CD or DataZone code.
+    path : str, optional
+        path of registry GeoParquet file. The default is REGISTRY_FILE.
+
+    Returns
+    -------
+    None.
+
+    '''
+    registry = pd.concat([gdf[['geometry']] for gdf in regions])
+    registry.index.name = 'code'
+    if registry.index.has_duplicates:
+        raise ValueError('region codes in the registry must be unique')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    registry.to_parquet(path)
+
+@functools.lru_cache(maxsize=4)
+def _read_registry(path, modified):
+    # geopandas is only imported by stages that use boundaries
+    import geopandas as gpd
+    return gpd.read_parquet(path).geometry
+
+def region_geometry(codes=None, path=REGISTRY_FILE):
+    '''
+    boundaries of regions from the registry. The registry is read once and
+    reused until the file changes.
+
+    Parameters
+    ----------
+    codes : array-like, optional
+        region codes to return. The default is None, which returns all regions.
+    path : str, optional
+        path of registry GeoParquet file. The default is REGISTRY_FILE.
+
+    Returns
+    -------
+    geometry : geoseries
+        region boundaries indexed by code, NaN for codes not in the registry.
+
+    '''
+    geometry = _read_registry(path, os.stat(path).st_mtime_ns)
+    if codes is None:
+        return geometry.copy()
+    return geometry.reindex(codes)
+
+def attach_geometry(table, path=REGISTRY_FILE):
+    '''
+    attach region boundaries from the registry to a table of results
+
+    Parameters
+    ----------
+    table : pandas DataFrame
+        results indexed by region code.
+    path : str, optional
+        path of registry GeoParquet file. The default is REGISTRY_FILE.
+
+    Returns
+    -------
+    regions : geodataframe
+        table with geometry column.
+
+    '''
+    import geopandas as gpd
+    geometry = region_geometry(table.index, path)
+    return gpd.GeoDataFrame(table, geometry=geometry.to_numpy(), crs=geometry.crs)
+
+def write_table(table, path, geojson=False):
+    '''
+    write a table of regional results to Parquet, keeping the index, and
+    optionally export a copy with boundaries from the registry as GeoJSON
+
+    Parameters
+    ----------
+    table : pandas DataFrame
+        results indexed by region code.
+    path : str
+        path of Parquet file.
+    geojson : bool, optional
+        also export a GeoJSON copy with the same name. The default is False.
+
+    Returns
+    -------
+    None.
+
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    pd.DataFrame(table).to_parquet(path)
+    if geojson:
+        attach_geometry(pd.DataFrame(table)).to_file(os.path.splitext(path)[0] + '.geojson',
+                                                     driver='GeoJSON', index=True)
+
+def read_table(path, columns=None):
+    '''
+    read a table of regional results from Parquet
+
+    Parameters
+    ----------
+    path : str
+        path of Parquet file.
+    columns : list of str, optional
+        columns to read. The default is None, which reads all columns.
+
+    Returns
+    -------
+    table : pandas DataFrame
+        results indexed by region code.
+
+    '''
+    return pd.read_parquet(path, columns=None if columns is None else list(columns))
+
+def cached_table(build, sources, cache_file, key=''):
+    '''
+    load a table from a Parquet cache, or build it from its source files and
+    cache it. The cache is reused while the sources keep the same modification
+    times and sizes, or if they have changed but their contents have not.
+
+    Parameters
+    ----------
+    build : function
+        function with no arguments returning the table as a pandas DataFrame.
+    sources : list of str
+        paths of files the table is built from.
+    cache_file : str
+        path of Parquet cache file.
+    key : str, optional
+        extra key for options used by build, such as header rows. The default is ''.
+
+    Returns
+    -------
+    table : pandas DataFrame
+        cached or newly built table.
+
+    '''
+    metadata_file = cache_file + '.json'
+    signature = combined_hash(file_signature_hash(sources), key)
+    metadata = {}
+    if os.path.exists(cache_file) and os.path.exists(metadata_file):
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+        if metadata.get('signature') == signature:
+            return pd.read_parquet(cache_file)
+    # files may have been touched or copied without being changed
+    content = combined_hash(*(file_hash(source) for source in sorted(sources)), key)
+    if metadata.get('content') == content:
+        table = pd.read_parquet(cache_file)
+    else:
+        table = build()
+        os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+        table.to_parquet(cache_file)
+    with open(metadata_file, 'w') as f:
+        json.dump({'signature': signature, 'content': content}, f)
+    return table
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Simulates comfortable heat-free hours in every region on every day of the
+historical winter temperature record using the thermal time constant for each
+region. Blocks of days are simulated in parallel worker processes and appended
+to a Zarr store as they finish, so the full (day, region) result never has to
+fit in memory.
+
+"""
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy as sp
+import xarray as xr
+from calculate_flexibility_duration import heat_free_hours
+from calculate_regional_HDDs import (area_weighted_values, build_region_index, fill_na_from_neighbours,
+                                     neighbour_adjacency)
+from instrumentation import dask_report, instrumented_run, step
+from pipeline import stage_parameters
+from pipeline_io import REGISTRY_FILE, attach_geometry, read_table
+from temperature_store import load_mean_temperature, open_mean_temperature
+
+def regional_temperature(temperature_store, days, grid_index):
+    '''
+    daily mean temperature in each region on the given days, reading only the
+    grid cells the regions take values from rather than the whole grid
+
+    Parameters
+    ----------
+    temperature_store : str
+        path of daily mean temperature Zarr store.
+    days : numpy array
+        integer positions along time in the temperature store.
+    grid_index : tuple or scipy sparse matrix
+        output of build_region_index in calculate_regional_HDDs.py.
+
+    Returns
+    -------
+    regional_temperature : numpy array
+        (region, day) temperature, NaN for regions without grid cells.
+
+    '''
+    temperature = open_mean_temperature(temperature_store).isel(time=days)
+    n_cols = temperature.sizes['projection_x_coordinate']
+    if isinstance(grid_index, tuple):
+        rows, cols, inside = grid_index
+        cells = rows[inside]*n_cols + cols[inside]
+    else:
+        cells = np.unique(sp.sparse.csr_matrix(grid_index).indices)
+    # vectorised point indexing along a shared dimension reads only these cells
+    points = temperature.isel(projection_y_coordinate=xr.DataArray(cells//n_cols, dims='cell'),
+                              projection_x_coordinate=xr.DataArray(cells%n_cols, dims='cell'))
+    points = points.transpose('time', 'cell')
+    if isinstance(grid_index, tuple):
+        values = np.full((len(rows), len(days)), np.nan)
+        values[inside] = points.values.T
+        return values
+    weights = sp.sparse.csr_matrix(grid_index)[:, cells]
+    return area_weighted_values([points.expand_dims('row', axis=1)], weights, x_dim='cell', y_dim='row')[0].T
+
+def _simulate_days(temperature_store, days, grid_index, adjacency, time_constants,
+                   initial_temp, final_temp):
+    '''
+    heat-free hours for one block of days, run in a worker process
+    '''
+    # regions outside the grid take the mean of their neighbours, as for static quantiles
+    temperature, _ = fill_na_from_neighbours(regional_temperature(temperature_store, days, grid_index), adjacency)
+    return heat_free_hours(time_constants, temperature, initial_temp, final_temp).T.astype(np.float32)
+
+def simulate_heat_free_hours(regions_gdf, days, grid_index, adjacency,
+                             temperature_store='Resources/mean_temperature.zarr',
+                             output_store='Results/heat_free_hours.zarr',
+                             days_per_block=90, n_workers=None, initial_temp=21., final_temp=18.):
+    '''
+    simulate heat-free hours for every region on each of the given days and
+    write the results incrementally to a Zarr store
+
+    Parameters
+    ----------
+    regions_gdf : geodataframe
+        geodataframe including 'Thermal time constant [h]' column.
+    days : numpy array
+        integer positions along time in the temperature store of the days to simulate.
+    grid_index : tuple or scipy sparse matrix
+        output of build_region_index in calculate_regional_HDDs.py, so regions
+        take the temperature at their representative point or the area-weighted
+        mean of the cells they overlap.
+    adjacency : scipy sparse matrix
+        region adjacency from neighbour_adjacency.
+    temperature_store : str, optional
+        path of daily mean temperature Zarr store. The default is 'Resources/mean_temperature.zarr'.
+    output_store : str, optional
+        path of Zarr store for results. The default is 'Results/heat_free_hours.zarr'.
+    days_per_block : int, optional
+        number of days simulated by each task. Each worker holds the
+        temperature of its regions on these days, not the whole grid. The
+        default is 90.
+    n_workers : int, optional
+        number of worker processes. The default is None, which uses all CPUs;
+        1 runs in the current process.
+    initial_temp : float, optional
+        initial indoor temperature. The default is 21..
+    final_temp : float, optional
+        final indoor temperature. The default is 18..
+
+    Returns
+    -------
+    None.
+
+    '''
+    time_constants = regions_gdf['Thermal time constant [h]'].to_numpy()
+    times = open_mean_temperature(temperature_store).time.values
+    blocks = [days[start:start + days_per_block] for start in range(0, len(days), days_per_block)]
+    arguments = [(temperature_store, block, grid_index, adjacency, time_constants, initial_temp, final_temp)
+                 for block in blocks]
+
+    shutil.rmtree(output_store, ignore_errors=True)
+    os.makedirs(os.path.dirname(output_store) or '.', exist_ok=True)
+
+    def write(block, hours, first):
+        block_hours = xr.Dataset({'heat_free_hours': (('time', 'region'), hours)},
+                                 coords={'time': times[block], 'region': regions_gdf.index.to_numpy().astype(str)})
+        if first:
+            block_hours['heat_free_hours'].attrs['units'] = 'h'
+            block_hours.to_zarr(output_store, mode='w',
+                                encoding={'heat_free_hours': {'chunks': (days_per_block, 4096)}})
+        else:
+            block_hours.drop_vars('region').to_zarr(output_store, append_dim='time')
+        print(f'Simulated {len(block)} days to {times[block[-1]]}')
+
+    if n_workers == 1:
+        for i, (block, argument) in enumerate(zip(blocks, arguments)):
+            write(block, _simulate_days(*argument), i == 0)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # map returns blocks in order, so each is appended as soon as those before it are written
+            for i, (block, hours) in enumerate(zip(blocks, executor.map(_simulate_days, *zip(*arguments)))):
+                write(block, hours, i == 0)
+
+def heat_free_hour_quantiles(output_store='Results/heat_free_hours.zarr', quantiles=(0.01, 0.05, 0.5, 0.95)):
+    '''
+    quantiles of simulated heat-free hours over time for each region, computed
+    out of core from the results store
+
+    Parameters
+    ----------
+    output_store : str, optional
+        path of Zarr store of simulation results. The default is 'Results/heat_free_hours.zarr'.
+    quantiles : list of float, optional
+        quantiles to calculate. The default is (0.01, 0.05, 0.5, 0.95).
+
+    Returns
+    -------
+    quantiles : pandas DataFrame
+        heat-free hour quantiles for each region.
+
+    '''
+    hours = xr.open_zarr(output_store)['heat_free_hours']
+    hours = hours.chunk({'time': -1, 'region': 4096})
+    hour_quantiles = hours.quantile(list(quantiles), dim='time').compute()
+    return hour_quantiles.to_pandas().T.add_prefix('Heat-free hours quantile ')
+
+
+def main(parameters=None):
+    '''
+    simulate heat-free hours in every region on every winter day and save
+    their quantiles over time
+
+    Parameters
+    ----------
+    parameters : dict, optional
+        heat_free_hours_simulation stage parameters. The default is None, which
+        uses stage_parameters('heat_free_hours_simulation').
+
+    Returns
+    -------
+    None.
+
+    '''
+    if parameters is None:
+        parameters = stage_parameters('heat_free_hours_simulation')
+
+    # import regions with thermal time constants
+    with step('read time constants'):
+        regions = attach_geometry(read_table('Resources/regional_thermal_time_constants.parquet'))
+
+    with step('load temperature'):
+        mean_temperature = load_mean_temperature()
+
+    # only include winter months (December to February)
+    winter_days = np.flatnonzero(((mean_temperature.time.dt.month>=12) | (mean_temperature.time.dt.month<=2)).values)
+
+    with step('grid index and adjacency'):
+        # 'representative_point' or 'area_weighted'
+        grid_index = build_region_index(regions, mean_temperature, parameters['sampling_method'],
+                                        boundary_file=REGISTRY_FILE)
+        adjacency = neighbour_adjacency(regions, boundary_file=REGISTRY_FILE)
+
+    # worker processes are not included in the memory recorded for this step
+    with step('simulate heat-free hours'):
+        simulate_heat_free_hours(regions, winter_days, grid_index, adjacency,
+                                 days_per_block=parameters['days_per_block'],
+                                 initial_temp=parameters['initial_temp'], final_temp=parameters['final_temp'])
+
+    with step('heat-free hour quantiles'), dask_report('heat-free hour quantiles'):
+        heat_free_hour_quantiles(quantiles=parameters['quantiles']).to_csv('Results/heat-free hours quantiles.csv')
+
+
+if __name__ == "__main__":
+
+    with instrumented_run('heat_free_hours_simulation'):
+        main()
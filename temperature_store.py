@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Ingests HadUK-Grid daily minimum and maximum temperature into a single chunked,
+compressed Zarr store of daily mean temperature, so later runs open one store
+instead of concatenating hundreds of monthly NetCDF files.
+
+"""
+
+import glob
+import os
+import shutil
+import xarray as xr
+import zarr
+from caching import file_signature_hash
+from instrumentation import instrumented_run
+
+# about one season of days by 125 x 125 km suits both reductions over time
+# and reading all days for a spatial tile
+DEFAULT_CHUNKS = {'time': 92, 'projection_y_coordinate': 125, 'projection_x_coordinate': 125}
+
+def netcdf_mean_temperature_blocks(tasmin_files, tasmax_files):
+    '''
+    read HadUK-Grid daily minimum and maximum temperature one file at a time
+    and yield the daily mean temperature of each file
+
+    Parameters
+    ----------
+    tasmin_files : list of str
+        daily minimum temperature NetCDF files.
+    tasmax_files : list of str
+        daily maximum temperature NetCDF files covering the same periods.
+
+    Yields
+    ------
+    mean_temperature : XArray DataArray
+        daily mean temperature for the period of one file pair, in memory.
+
+    '''
+    if len(tasmin_files) != len(tasmax_files):
+        raise ValueError('Different numbers of tasmin and tasmax files')
+    for tasmin_file, tasmax_file in zip(sorted(tasmin_files), sorted(tasmax_files)):
+        with xr.open_dataset(tasmin_file) as min_temperature, xr.open_dataset(tasmax_file) as max_temperature:
+            yield ((max_temperature['tasmax'] + min_temperature['tasmin'])/2).load()
+
+def ingest_mean_temperature(tasmin_files, tasmax_files, store='Resources/mean_temperature.zarr',
+                            chunks=DEFAULT_CHUNKS):
+    '''
+    write daily mean temperature to a Zarr store one file pair at a time
+
+    Parameters
+    ----------
+    tasmin_files : list of str
+        daily minimum temperature NetCDF files.
+    tasmax_files : list of str
+        daily maximum temperature NetCDF files covering the same periods.
+    store : str, optional
+        path of Zarr store. The default is 'Resources/mean_temperature.zarr'.
+    chunks : dict, optional
+        chunk size of each dimension. The default is DEFAULT_CHUNKS.
+
+    Returns
+    -------
+    None.
+
+    '''
+    temporary_store = store + '.tmp'
+    shutil.rmtree(temporary_store, ignore_errors=True)
+    source_hash = file_signature_hash(list(tasmin_files) + list(tasmax_files))
+    for i, block in enumerate(netcdf_mean_temperature_blocks(tasmin_files, tasmax_files)):
+        mean_temperature = block.rename('mean_temperature').to_dataset()
+        if i == 0:
+            encoding = {'mean_temperature': {'chunks': tuple(chunks[dim] for dim in block.dims)}}
+            mean_temperature.to_zarr(temporary_store, mode='w', encoding=encoding)
+        else:
+            mean_temperature.to_zarr(temporary_store, append_dim='time')
+        print(f'Ingested {len(block.time)} days to {block.time.values[-1]}')
+    # record which files the store was built from once it is complete
+    zarr.open_group(temporary_store, mode='a').attrs['source_hash'] = source_hash
+    zarr.consolidate_metadata(temporary_store)
+    # only replace the existing store once the new one is complete
+    shutil.rmtree(store, ignore_errors=True)
+    os.replace(temporary_store, store)
+
+def open_mean_temperature(store='Resources/mean_temperature.zarr'):
+    '''
+    lazily open daily mean temperature from a Zarr store
+
+    Parameters
+    ----------
+    store : str, optional
+        path of Zarr store. The default is 'Resources/mean_temperature.zarr'.
+
+    Returns
+    -------
+    mean_temperature : XArray DataArray
+        dask-backed daily mean temperature.
+
+    '''
+    return xr.open_zarr(store)['mean_temperature']
+
+def load_mean_temperature(tasmin_files=None, tasmax_files=None, store='Resources/mean_temperature.zarr'):
+    '''
+    open the daily mean temperature store, ingesting the NetCDF files first if
+    the store is missing or was built from different files
+
+    Parameters
+    ----------
+    tasmin_files : list of str, optional
+        daily minimum temperature NetCDF files. The default is None, which uses
+        all files in Data/tasmin.
+    tasmax_files : list of str, optional
+        daily maximum temperature NetCDF files. The default is None, which uses
+        all files in Data/tasmax.
+    store : str, optional
+        path of Zarr store. The default is 'Resources/mean_temperature.zarr'.
+
+    Returns
+    -------
+    mean_temperature : XArray DataArray
+        dask-backed daily mean temperature.
+
+    '''
+    if tasmin_files is None:
+        tasmin_files = glob.glob('Data/tasmin/*.nc')
+    if tasmax_files is None:
+        tasmax_files = glob.glob('Data/tasmax/*.nc')
+    source_hash = file_signature_hash(list(tasmin_files) + list(tasmax_files))
+    if os.path.exists(store) and xr.open_zarr(store).attrs.get('source_hash') == source_hash:
+        return open_mean_temperature(store)
+    ingest_mean_temperature(tasmin_files, tasmax_files, store)
+    return open_mean_temperature(store)
+
+def time_blocks(mean_temperature, block_size=None):
+    '''
+    iterate over consecutive blocks of days, loading one block at a time
+
+    Parameters
+    ----------
+    mean_temperature : XArray DataArray
+        daily mean temperature with a time dimension.
+    block_size : int, optional
+        number of days per block. The default is None, which uses the store's
+        time chunk size.
+
+    Yields
+    ------
+    block : XArray DataArray
+        in-memory daily mean temperature for one block of days.
+
+    '''
+    if block_size is None:
+        block_size = mean_temperature.chunksizes['time'][0] if mean_temperature.chunks else len(mean_temperature.time)
+    for start in range(0, len(mean_temperature.time), block_size):
+        yield mean_temperature.isel(time=slice(start, start + block_size)).load()
+
+
+if __name__ == "__main__":
+    
+    with instrumented_run('temperature_store'):
+        ingest_mean_temperature(glob.glob('Data/tasmin/*.nc'), glob.glob('Data/tasmax/*.nc'))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of time constants fitted to Electrification of Heat trial properties.
+
+"""
+
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import synthetic_heat_pump_data
+import EoH_time_constants
+from EoH_time_constants import property_time_constants, segment_statistics
+
+def test_property_without_cooling_periods(tmp_path):
+    # a record from 2019 has no rows in the trial heating seasons
+    file = tmp_path/'Property_ID=TEST00001.csv'
+    synthetic_heat_pump_data(n_days=2, start='2019-01-01').to_csv(file)
+    house_taus, fits = property_time_constants(str(file), [30, 60], cache_dir=str(tmp_path/'cache'))
+    assert list(house_taus.index) == [30, 60]
+    assert house_taus.isna().all()
+    assert len(fits) == 0
+
+def test_empty_segment_statistics_dtypes():
+    segments = segment_statistics(synthetic_heat_pump_data(n_days=1).iloc[:0])
+    assert segments['Usable'].dtype == bool
+    assert all(segments[column].dtype == np.int64 for column in ['Start', 'End', 'Length'])
+
+def test_cache_keyed_on_filter_version(tmp_path, monkeypatch):
+    file = tmp_path/'Property_ID=TEST00002.csv'
+    synthetic_heat_pump_data(n_days=2, start='2021-01-01').to_csv(file)
+    cache_dir = tmp_path/'cache'
+    EoH_time_constants.load_decreasing_temperature(str(file), str(cache_dir))
+    EoH_time_constants.load_decreasing_temperature(str(file), str(cache_dir))
+    assert len(os.listdir(cache_dir)) == 1
+    monkeypatch.setattr(EoH_time_constants, 'HEAT_OFF_FILTER_VERSION', EoH_time_constants.HEAT_OFF_FILTER_VERSION + 1)
+    EoH_time_constants.load_decreasing_temperature(str(file), str(cache_dir))
+    assert len(os.listdir(cache_dir)) == 2
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Runs reductions of the daily mean temperature store one spatial tile at a
+time, so national grids at high resolution or over long climate projections
+never have to fit in memory at once. Regions are assigned to the tile under
+the centre of the bounding box of the grid cells they take values from. Each
+tile reads the window of the grid covering its regions, reduces it over time
+and samples the result at its regions, and the regional results of all tiles
+are merged. Tiles run in parallel in local worker processes, or on a
+dask.distributed cluster if a scheduler address is set in the dask
+configuration, e.g. with the DASK_SCHEDULER_ADDRESS environment variable.
+
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy as sp
+import xarray as xr
+from temperature_store import open_mean_temperature
+
+# the spatial chunk size of the temperature store, so each tile reads whole chunks
+TILE_SIZE = 125
+
+def region_cell_bounds(grid_index, n_cols):
+    '''
+    bounding box in grid cells of the cells each region takes values from
+
+    Parameters
+    ----------
+    grid_index : tuple or scipy sparse matrix
+        output of build_region_index in calculate_regional_HDDs.py.
+    n_cols : int
+        number of grid columns (x).
+
+    Returns
+    -------
+    bounds : numpy array
+        (region, 4) array of first row, last row, first column and last column.
+    has_cells : numpy array
+        boolean mask of regions that take values from at least one cell.
+
+    '''
+    if isinstance(grid_index, tuple):
+        rows, cols, inside = grid_index
+        return np.stack([rows, rows, cols, cols], axis=1), np.asarray(inside, dtype=bool)
+    weights = sp.sparse.coo_matrix(grid_index)
+    n_regions = weights.shape[0]
+    rows, cols = weights.col//n_cols, weights.col%n_cols
+    bounds = np.stack([np.full(n_regions, np.iinfo(np.int64).max), np.full(n_regions, -1),
+                       np.full(n_regions, np.iinfo(np.int64).max), np.full(n_regions, -1)], axis=1)
+    np.minimum.at(bounds[:, 0], weights.row, rows)
+    np.maximum.at(bounds[:, 1], weights.row, rows)
+    np.minimum.at(bounds[:, 2], weights.row, cols)
+    np.maximum.at(bounds[:, 3], weights.row, cols)
+    has_cells = bounds[:, 1] >= 0
+    bounds[~has_cells] = 0
+    return bounds, has_cells
+
+def assign_regions_to_tiles(bounds, has_cells, tile_size=TILE_SIZE):
+    '''
+    assign regions to square tiles of the grid by the centre of their bounding
+    box, and find the window of the grid each tile needs to read
+
+    Parameters
+    ----------
+    bounds : numpy array
+        (region, 4) cell bounding boxes from region_cell_bounds.
+    has_cells : numpy array
+        boolean mask of regions to assign.
+    tile_size : int, optional
+        number of grid cells along each side of a tile. The default is TILE_SIZE.
+
+    Returns
+    -------
+    tiles : list of tuple
+        for each tile with regions, the positions of its regions and the
+        (first row, end row, first column, end column) window it reads, which
+        extends past the tile where its regions do.
+
+    '''
+    regions = np.flatnonzero(has_cells)
+    if len(regions) == 0:
+        return []
+    tile_rows = (bounds[regions, 0] + bounds[regions, 1])//2//tile_size
+    tile_cols = (bounds[regions, 2] + bounds[regions, 3])//2//tile_size
+    order = np.lexsort((tile_cols, tile_rows))
+    regions, tile_rows, tile_cols = regions[order], tile_rows[order], tile_cols[order]
+    starts = np.flatnonzero(np.r_[True, (np.diff(tile_rows) != 0) | (np.diff(tile_cols) != 0)])
+    tiles = []
+    for tile_regions in np.split(regions, starts[1:]):
+        tile_bounds = bounds[tile_regions]
+        window = (tile_bounds[:, 0].min(), tile_bounds[:, 1].max() + 1,
+                  tile_bounds[:, 2].min(), tile_bounds[:, 3].max() + 1)
+        tiles.append((tile_regions, tuple(int(edge) for edge in window)))
+    return tiles
+
+def _window_index(grid_index, regions, window, n_cols):
+    # the grid index of a tile's regions, relative to the window it reads
+    y0, y1, x0, x1 = window
+    if isinstance(grid_index, tuple):
+        rows, cols, _ = grid_index
+        return rows[regions] - y0, cols[regions] - x0, np.ones(len(regions), dtype=bool)
+    weights = sp.sparse.coo_matrix(sp.sparse.csr_matrix(grid_index)[regions])
+    rows, cols = weights.col//n_cols - y0, weights.col%n_cols - x0
+    return sp.sparse.csr_matrix((weights.data, (weights.row, rows*(x1 - x0) + cols)),
+                                shape=(len(regions), (y1 - y0)*(x1 - x0)))
+
+def stack_region_indices(grid_indices):
+    '''
+    combine the grid indices of several sets of regions on the same grid, so
+    they can be run in one pass over the grid
+
+    Parameters
+    ----------
+    grid_indices : list
+        outputs of build_region_index with the same method.
+
+    Returns
+    -------
+    grid_index : tuple or scipy sparse matrix
+        grid index of the regions of every set in turn.
+
+    '''
+    if isinstance(grid_indices[0], tuple):
+        return tuple(np.concatenate(arrays) for arrays in zip(*grid_indices))
+    return sp.sparse.vstack(grid_indices, format='csr')
+
+def _sample_window(grid, window_index, x_dim, y_dim):
+    grid = grid.transpose(..., y_dim, x_dim)
+    if isinstance(window_index, tuple):
+        rows, cols, _ = window_index
+        return grid.values[..., rows, cols]
+    from calculate_regional_HDDs import area_weighted_values
+    return area_weighted_values([grid], window_index, x_dim, y_dim)[0]
+
+def _run_tile(reduction, store, window, window_index, kwargs, x_dim, y_dim):
+    import dask
+    y0, y1, x0, x1 = window
+    temperature = open_mean_temperature(store).isel({y_dim: slice(y0, y1), x_dim: slice(x0, x1)})
+    # tiles run in parallel, so each is reduced in a single thread to bound memory
+    with dask.config.set(scheduler='synchronous'):
+        grids = reduction(temperature, **kwargs)
+    return {label: (grid.transpose(..., y_dim, x_dim).isel({y_dim: 0, x_dim: 0}, drop=True),
+                    _sample_window(grid, window_index, x_dim, y_dim))
+            for label, grid in grids.items()}
+
+def _executor(n_workers):
+    try:
+        import dask
+        address = dask.config.get('scheduler-address', None)
+    except ImportError:
+        address = None
+    if address:
+        from distributed import Client
+        return Client(address)
+    return ProcessPoolExecutor(max_workers=n_workers)
+
+def run_tiled(reduction, grid_index, store='Resources/mean_temperature.zarr', tile_size=TILE_SIZE,
+              n_workers=None, executor=None, x_dim='projection_x_coordinate',
+              y_dim='projection_y_coordinate', **kwargs):
+    '''
+    reduce daily mean temperature over time and sample the result at regions,
+    one spatial tile at a time. Peak memory in each worker is set by the
+    reduction of one tile's window.
+
+    Parameters
+    ----------
+    reduction : function
+        module-level function taking a window of daily mean temperature and
+        kwargs and returning a dict of grids, which may have leading
+        dimensions, e.g. tiled_HDDs or tiled_quantiles.
+    grid_index : tuple or scipy sparse matrix
+        output of build_region_index in calculate_regional_HDDs.py for the
+        temperature grid, or of stack_region_indices.
+    store : str, optional
+        path of Zarr store of daily mean temperature, which workers on a
+        cluster must be able to read. The default is 'Resources/mean_temperature.zarr'.
+    tile_size : int, optional
+        number of grid cells along each side of a tile. The default is TILE_SIZE.
+    n_workers : int, optional
+        number of local worker processes. The default is None, which uses all
+        CPUs; 1 runs every tile in the current process.
+    executor : optional
+        executor to submit tiles to, such as a dask.distributed Client or a
+        concurrent.futures executor. The default is None, which uses a
+        dask.distributed scheduler if one is configured and otherwise local
+        worker processes.
+    x_dim : string, optional
+        name of the x dimension. The default is 'projection_x_coordinate'.
+    y_dim : string, optional
+        name of the y dimension. The default is 'projection_y_coordinate'.
+    **kwargs
+        passed to reduction.
+
+    Returns
+    -------
+    values : dict
+        XArray DataArray for each grid returned by reduction, with its leading
+        dimensions and a region dimension in the order of grid_index. Regions
+        without grid cells are NaN.
+
+    '''
+    store = os.path.abspath(store)
+    grid = open_mean_temperature(store)
+    n_cols = grid.sizes[x_dim]
+    bounds, has_cells = region_cell_bounds(grid_index, n_cols)
+    n_regions = len(bounds)
+    tiles = assign_regions_to_tiles(bounds, has_cells, tile_size)
+    tasks = [(reduction, store, window, _window_index(grid_index, regions, window, n_cols), kwargs, x_dim, y_dim)
+             for regions, window in tiles]
+
+    if n_workers == 1 and executor is None:
+        results = [_run_tile(*task) for task in tasks]
+    elif executor is not None:
+        results = [future.result() for future in [executor.submit(_run_tile, *task) for task in tasks]]
+    else:
+        with _executor(n_workers) as tile_executor:
+            results = [future.result() for future in [tile_executor.submit(_run_tile, *task) for task in tasks]]
+
+    values = {}
+    for (regions, _), result in zip(tiles, results):
+        for label, (template, tile_values) in result.items():
+            if label not in values:
+                values[label] = xr.DataArray(np.full(template.shape + (n_regions,), np.nan),
+                                             coords=template.coords, dims=template.dims + ('region',))
+            values[label].values[..., regions] = tile_values
+    return values
+
+def tiled_HDDs(temperature, windows, thresholds):
+    '''
+    gridded HDDs of a window of the grid for several time windows and
+    thresholds, reading one time chunk at a time
+
+    Parameters
+    ----------
+    temperature : XArray DataArray
+        dask-backed daily mean temperature for a window of the grid.
+    windows : dict
+        time slices keyed by label, as in windowed_HDDs.
+    thresholds : list of float
+        threshold temperatures for HDD calculation.
+
+    Returns
+    -------
+    grids : dict
+        'HDDs' with dimensions (threshold, year, y, x).
+
+    '''
+    from calculate_regional_HDDs import windowed_HDDs
+    from temperature_store import time_blocks
+    return {'HDDs': windowed_HDDs(time_blocks(temperature), windows, threshold=list(thresholds))}
+
+def tiled_quantiles(temperature, quantiles, months=None, method='exact'):
+    '''
+    gridded quantiles of temperature over time for a window of the grid
+
+    Parameters
+    ----------
+    temperature : XArray DataArray
+        dask-backed daily mean temperature for a window of the grid.
+    quantiles : list of float
+        quantiles to calculate, between 0 and 1.
+    months : list of int, optional
+        only include days in these months. The default is None, which includes every day.
+    method : str, optional
+        'exact' or 'histogram', as in temperature_quantiles. The default is 'exact'.
+
+    Returns
+    -------
+    grids : dict
+        'temperature quantiles' with dimensions (quantile, y, x).
+
+    '''
+    from calculate_flexibility_duration import temperature_quantiles
+    if months is not None:
+        temperature = temperature.isel(time=np.flatnonzero(temperature.time.dt.month.isin(months).values))
+    # the window is already a tile, so it is reduced as one
+    tile_size = max(size for dim, size in temperature.sizes.items() if dim != 'time')
+    return {'temperature quantiles': temperature_quantiles(temperature, quantiles, method=method,
+                                                           tile_size=tile_size)}
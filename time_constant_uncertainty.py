@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo estimates of uncertainty in thermal time constants and national
+thermal energy storage capacity. Floor area per room, specific thermal
+capacity, the number of rooms counted for '9 or more rooms', the HDD threshold
+and the temperature window are sampled from configurable distributions, and
+every draw is evaluated for all regions at once as (draw, region) arrays,
+processed in blocks of regions to bound memory.
+
+"""
+
+import numpy as np
+import pandas as pd
+from calculate_heating_losses import heat_loss_rates
+
+def sample_parameters(distributions, n_draws, seed=None):
+    '''
+    draw parameter values from their distributions
+
+    Parameters
+    ----------
+    distributions : dict
+        distribution of each parameter, given as the name of a numpy random
+        Generator method and its arguments, e.g. {'distribution': 'normal',
+        'loc': 17.6, 'scale': 1.76}, or {'distribution': 'fixed', 'value': 3}.
+    n_draws : int
+        number of draws.
+    seed : int, optional
+        random seed. The default is None.
+
+    Returns
+    -------
+    draws : dict
+        array of n_draws values for each parameter.
+
+    '''
+    rng = np.random.default_rng(seed)
+    draws = {}
+    # sorted so the same seed gives the same draws however the dict is ordered
+    for name in sorted(distributions):
+        arguments = dict(distributions[name])
+        distribution = arguments.pop('distribution')
+        if distribution == 'fixed':
+            draws[name] = np.full(n_draws, float(arguments['value']))
+        else:
+            draws[name] = getattr(rng, distribution)(size=n_draws, **arguments)
+    return draws
+
+def interpolate_HDDs(threshold_HDDs, thresholds, threshold):
+    '''
+    HDDs at sampled thresholds, interpolated linearly between thresholds the
+    HDDs were calculated for
+
+    Parameters
+    ----------
+    threshold_HDDs : numpy array
+        (region, threshold, year) HDDs at each threshold.
+    thresholds : numpy array
+        increasing thresholds HDDs were calculated for.
+    threshold : numpy array
+        sampled thresholds, one per draw.
+
+    Returns
+    -------
+    HDDs : numpy array
+        (draw, region, year) HDDs.
+
+    '''
+    thresholds = np.asarray(thresholds, dtype=float)
+    if threshold.min() < thresholds[0] or threshold.max() > thresholds[-1]:
+        raise ValueError(f'sampled HDD thresholds must be between {thresholds[0]} and {thresholds[-1]}')
+    lower = np.clip(np.searchsorted(thresholds, threshold, side='right') - 1, 0, len(thresholds) - 2)
+    weight = (threshold - thresholds[lower])/(thresholds[lower + 1] - thresholds[lower])
+    return ((1 - weight)[:, None, None]*np.moveaxis(threshold_HDDs[:, lower], 1, 0)
+            + weight[:, None, None]*np.moveaxis(threshold_HDDs[:, lower + 1], 1, 0))
+
+def time_constant_draws(room_counts, households, demand, threshold_HDDs, thresholds, draws,
+                        heat_loss_method='pooled', min_years=None):
+    '''
+    thermal capacity and time constant of a block of regions for every draw
+
+    Parameters
+    ----------
+    room_counts : numpy array
+        (region, 9) households with 1 to 8 rooms and with 9 or more rooms.
+    households : numpy array
+        total households in each region.
+    demand : numpy array
+        (region, year) annual space heating demand in kWh.
+    threshold_HDDs : numpy array
+        (region, threshold, year) HDDs at each threshold.
+    thresholds : numpy array
+        increasing thresholds HDDs were calculated for.
+    draws : dict
+        sampled 'floor_area_per_room', 'specific_thermal_capacity',
+        'nine_or_more_rooms' and 'threshold' values.
+    heat_loss_method : str, optional
+        estimator passed to heat_loss_rates. The default is 'pooled'.
+    min_years : int, optional
+        passed to heat_loss_rates. The default is None.
+
+    Returns
+    -------
+    capacity : numpy array
+        (draw, region) thermal capacity in kWh/C.
+    time_constant : numpy array
+        (draw, region) thermal time constant in hours.
+
+    '''
+    rooms = np.arange(1, room_counts.shape[1] + 1)
+    fewer_rooms = room_counts[:, :-1] @ rooms[:-1]
+    mean_rooms = (fewer_rooms[None, :] + np.outer(draws['nine_or_more_rooms'], room_counts[:, -1]))/households
+    capacity = (draws['specific_thermal_capacity']*draws['floor_area_per_room'])[:, None]*mean_rooms
+
+    HDDs = interpolate_HDDs(threshold_HDDs, thresholds, draws['threshold'])
+    n_draws, n_regions, n_years = HDDs.shape
+    # every draw of every region is estimated as a separate row
+    losses, _, _ = heat_loss_rates(np.broadcast_to(demand, HDDs.shape).reshape(-1, n_years),
+                                   HDDs.reshape(-1, n_years), heat_loss_method, min_years)
+    return capacity, capacity/losses.reshape(n_draws, n_regions)
+
+def _region_percentiles(values, percentiles):
+    '''
+    percentiles over draws of each region, ignoring NaN draws. Regions are
+    usually either NaN in every draw or in none, so the much slower nanpercentile
+    is only used for the rest.
+    '''
+    result = np.percentile(values, percentiles, axis=0)
+    missing = np.isnan(values)
+    partial = missing.any(axis=0) & ~missing.all(axis=0)
+    if partial.any():
+        result[:, partial] = np.nanpercentile(values[:, partial], percentiles, axis=0)
+    return result
+
+def monte_carlo_time_constants(room_counts, households, demand, threshold_HDDs, thresholds, distributions,
+                               n_draws=1000, percentiles=(5, 50, 95), seed=None,
+                               heat_loss_method='pooled', min_years=None, memory_limit=2**28):
+    '''
+    Monte Carlo percentiles of thermal time constants in each region and the
+    distribution of national thermal energy storage capacity
+
+    Parameters
+    ----------
+    room_counts : pandas DataFrame
+        households with 1 to 8 rooms and with 9 or more rooms, indexed by region.
+    households : pandas Series
+        total households in each region.
+    demand : numpy array
+        (region, year) annual space heating demand in kWh.
+    threshold_HDDs : numpy array
+        (region, threshold, year) HDDs at each threshold.
+    thresholds : numpy array
+        increasing thresholds HDDs were calculated for.
+    distributions : dict
+        distributions of 'floor_area_per_room', 'specific_thermal_capacity',
+        'nine_or_more_rooms', 'threshold' and 'delta_T', as for sample_parameters.
+    n_draws : int, optional
+        number of draws. The default is 1000.
+    percentiles : list of float, optional
+        percentiles to calculate. The default is (5, 50, 95).
+    seed : int, optional
+        random seed. The default is None.
+    heat_loss_method : str, optional
+        estimator passed to heat_loss_rates. The default is 'pooled'.
+    min_years : int, optional
+        passed to heat_loss_rates. The default is None.
+    memory_limit : int, optional
+        approximate size in bytes of the largest array in each block of
+        regions. The default is 2**28.
+
+    Returns
+    -------
+    region_percentiles : pandas DataFrame
+        percentiles of thermal capacity and time constant in each region.
+    national_TES_capacity : numpy array
+        national thermal energy storage capacity in GWh for each draw.
+
+    '''
+    draws = sample_parameters(distributions, n_draws, seed)
+    counts = room_counts.to_numpy(dtype=float)
+    households = households.to_numpy(dtype=float)
+    n_regions, n_years = demand.shape
+    block_size = max(1, memory_limit//(8*n_draws*n_years))
+
+    capacity_percentiles = np.empty((len(percentiles), n_regions))
+    time_constant_percentiles = np.empty((len(percentiles), n_regions))
+    national_TES_capacity = np.zeros(n_draws)
+    for start in range(0, n_regions, block_size):
+        block = slice(start, start + block_size)
+        capacity, time_constant = time_constant_draws(counts[block], households[block], demand[block], threshold_HDDs[block],
+                                                      thresholds, draws, heat_loss_method, min_years)
+        capacity_percentiles[:, block] = _region_percentiles(capacity, percentiles)
+        time_constant_percentiles[:, block] = _region_percentiles(time_constant, percentiles)
+        # kWh to GWh
+        national_TES_capacity += draws['delta_T']*np.nansum(capacity*households[block], axis=1)/1e6
+
+    region_percentiles = pd.DataFrame(index=room_counts.index)
+    for i, percentile in enumerate(percentiles):
+        region_percentiles[f'Thermal capacity [kWh/C] P{percentile:g}'] = capacity_percentiles[i]
+    for i, percentile in enumerate(percentiles):
+        region_percentiles[f'Thermal time constant [h] P{percentile:g}'] = time_constant_percentiles[i]
+    return region_percentiles, national_TES_capacity
@@ -8,76 +8,115 @@ Validates gas-based thermal time constants of LSOAs and DZs based on
 Electrification of Heat trial data and Canet and Quadrdan 2023 results.
 
 """
-import geopandas as gpd
 import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-
-#%% read files
-EOH_time_constants = pd.read_csv('Resources/EoH time constants.csv', index_col='Unnamed: 0')
-
-LSOAs = gpd.read_file('Resources/LSOA_gas_time_constants.geojson')
-DZs= gpd.read_file('Resources/DZ_gas_time_constants.geojson')
-DZs.set_index('index', inplace=True)
-LSOAs.set_index('index', inplace=True)
-
-canet = pd.read_csv('Data/UKERC/01 - Thermal_Characteristics/Thermal_characteristics_beforeEE.csv')
-canet_retrofit = pd.read_csv('Data/UKERC/01 - Thermal_Characteristics/Thermal_characteristics_afterEE.csv')
-
-#%% comparison with Canet and Qadrdan 2023 results based on bottom-up EPC method
-
-# pull out only comparable data-- gas heated homes with medium thermal capacity
-canet_gas = canet[(canet['Heating systems']=='gas boiler')& (canet['Thermal capacity level']=='medium')]
-
-LSOAs['Canet average thermal capacity'] = pd.Series(np.nan, LSOAs.index)
-LSOAs['Canet average thermal losses'] = pd.Series(np.nan, LSOAs.index)
-LSOAs['Canet average floor area'] = pd.Series(np.nan, LSOAs.index)
-
-for LSOA in LSOAs.index:
-    canet_gas_LSOA = canet_gas[canet_gas['LSOA_code']==LSOA]
-    total_households = canet_gas_LSOA['Number of dwellings'].sum()
-    canet_thermal_capacity = (canet_gas_LSOA['Number of dwellings']*canet_gas_LSOA['Average thermal capacity kJ/K']).sum()/total_households
-    canet_thermal_losses = (canet_gas_LSOA['Number of dwellings']*canet_gas_LSOA['Average thermal losses kW/K']).sum()/total_households
-    canet_floor_area = (canet_gas_LSOA['Number of dwellings']*canet_gas_LSOA['Average floor area m2']).sum()/total_households
-    
-    LSOAs.at[LSOA,'Canet average thermal capacity'] = canet_thermal_capacity
-    LSOAs.at[LSOA,'Canet average thermal losses'] = canet_thermal_losses
-    LSOAs.at[LSOA,'Canet average floor area'] = canet_floor_area
-
-#%% compare thermal losses with retrofit
-canet_retrofit_gas = canet_retrofit[(canet_retrofit['Heating systems']=='gas boiler')& (canet_retrofit['Thermal capacity level']=='medium')]
-
-LSOAs['Canet retrofit average thermal losses'] = pd.Series(np.nan, LSOAs.index)
-
-for LSOA in LSOAs.index:
-    canet_gas_LSOA = canet_retrofit_gas[canet_retrofit_gas['LSOA_code']==LSOA]
-    total_households = canet_gas_LSOA['Number of dwellings'].sum()
-    canet_thermal_losses = (canet_gas_LSOA['Number of dwellings']*canet_gas_LSOA['Average thermal losses kW/K']).sum()/total_households
-    
-    LSOAs.at[LSOA,'Canet retrofit average thermal losses'] = canet_thermal_losses
-
-#%% compare all time constants KDE
-
-canet_medium = canet[canet['Thermal capacity level']=='medium']
-canet_retrofit_medium = canet_retrofit[canet_retrofit['Thermal capacity level']=='medium']
-
-fig, ax = plt.subplots()
-
-pd.concat([LSOAs['Thermal time constant [h]'],DZs['Thermal time constant [h]']]).plot.kde(
-    ax = ax, label = 'Heating consumption-based (this paper)', grid = False)
-(canet_medium['Average thermal capacity kJ/K']/3.6e3/\
- canet_medium['Average thermal losses kW/K']).plot.kde(
-    ax = ax, label = 'EPC-based (current)', grid = False)
-(canet_retrofit_medium['Average thermal capacity kJ/K']/3.6e3/\
- canet_retrofit_medium['Average thermal losses kW/K']).plot.kde(
-    ax = ax, label = 'EPC-based (retrofit)', grid = False)
-EOH_time_constants['90'].plot.kde(
-    ax = ax, color='C4', label = 'Indoor temperature-based', grid = False)
-
-ax.set_xlabel('Time constant [h]')
-ax.set_ylabel('Sample density')
-ax.legend()
-
-ax.set_xlim(0,150)
-ax.grid()
-plt.savefig('Plots/KDE time constant comparison.jpg', dpi = 300)
+from instrumentation import instrumented_run
+from pipeline import plots_enabled
+from pipeline_io import read_table
+
+def dwelling_weighted_means(table, columns, by=('LSOA_code','Heating systems','Thermal capacity level'),
+                            weight='Number of dwellings'):
+    '''
+    calculate dwelling-weighted means of columns for every group in one
+    grouped aggregation
+
+    Parameters
+    ----------
+    table : pandas DataFrame
+        Canet and Qadrdan thermal characteristics table.
+    columns : list of str
+        columns to average.
+    by : tuple of str, optional
+        columns to group by. The default is ('LSOA_code','Heating systems','Thermal capacity level').
+    weight : str, optional
+        column of weights. The default is 'Number of dwellings'.
+
+    Returns
+    -------
+    means : pandas DataFrame
+        weighted mean of each column indexed by group.
+
+    '''
+    weighted = table[columns].multiply(table[weight], axis=0)
+    weighted[weight] = table[weight]
+    sums = weighted.groupby([table[column] for column in by]).sum()
+    return sums[columns].div(sums[weight], axis=0)
+
+def main(plots=True):
+    '''
+    compare thermal time constants with EPC-based and indoor temperature-based
+    time constants
+
+    Parameters
+    ----------
+    plots : bool, optional
+        plot the distributions of time constants. The default is True.
+
+    Returns
+    -------
+    None.
+
+    '''
+    #%% read files
+    EOH_time_constants = pd.read_csv('Resources/EoH time constants.csv', index_col='Unnamed: 0')
+
+    LSOAs = read_table('Resources/LSOA_gas_time_constants.parquet', ['Thermal time constant [h]'])
+    DZs = read_table('Resources/DZ_gas_time_constants.parquet', ['Thermal time constant [h]'])
+
+    canet = pd.read_csv('Data/UKERC/01 - Thermal_Characteristics/Thermal_characteristics_beforeEE.csv')
+    canet_retrofit = pd.read_csv('Data/UKERC/01 - Thermal_Characteristics/Thermal_characteristics_afterEE.csv')
+
+    #%% comparison with Canet and Qadrdan 2023 results based on bottom-up EPC method
+
+    canet_columns = {'Average thermal capacity kJ/K':'Canet average thermal capacity',
+                     'Average thermal losses kW/K':'Canet average thermal losses',
+                     'Average floor area m2':'Canet average floor area'}
+
+    # dwelling-weighted means for every LSOA, heating system and thermal capacity level at once
+    canet_means = dwelling_weighted_means(canet, list(canet_columns)).rename(columns=canet_columns)
+    canet_retrofit_means = dwelling_weighted_means(canet_retrofit, ['Average thermal losses kW/K']).rename(
+        columns={'Average thermal losses kW/K':'Canet retrofit average thermal losses'})
+
+    # pull out only comparable data-- gas heated homes with medium thermal capacity
+    LSOAs = LSOAs.join(canet_means.xs(('gas boiler','medium'), level=['Heating systems','Thermal capacity level']))
+
+    #%% compare thermal losses with retrofit
+    LSOAs = LSOAs.join(canet_retrofit_means.xs(('gas boiler','medium'), level=['Heating systems','Thermal capacity level']))
+
+    # time constants of each LSOA next to the EPC-based results
+    LSOAs.to_csv('Results/time constant comparison.csv')
+
+    if not plots:
+        return
+
+    #%% compare all time constants KDE
+    import matplotlib.pyplot as plt
+
+    canet_medium = canet[canet['Thermal capacity level']=='medium']
+    canet_retrofit_medium = canet_retrofit[canet_retrofit['Thermal capacity level']=='medium']
+
+    fig, ax = plt.subplots()
+
+    pd.concat([LSOAs['Thermal time constant [h]'],DZs['Thermal time constant [h]']]).plot.kde(
+        ax = ax, label = 'Heating consumption-based (this paper)', grid = False)
+    (canet_medium['Average thermal capacity kJ/K']/3.6e3/\
+     canet_medium['Average thermal losses kW/K']).plot.kde(
+        ax = ax, label = 'EPC-based (current)', grid = False)
+    (canet_retrofit_medium['Average thermal capacity kJ/K']/3.6e3/\
+     canet_retrofit_medium['Average thermal losses kW/K']).plot.kde(
+        ax = ax, label = 'EPC-based (retrofit)', grid = False)
+    EOH_time_constants['90'].plot.kde(
+        ax = ax, color='C4', label = 'Indoor temperature-based', grid = False)
+
+    ax.set_xlabel('Time constant [h]')
+    ax.set_ylabel('Sample density')
+    ax.legend()
+
+    ax.set_xlim(0,150)
+    ax.grid()
+    plt.savefig('Plots/KDE time constant comparison.jpg', dpi = 300)
+
+
+if __name__ == "__main__":
+
+    with instrumented_run('validation'):
+        main(plots=plots_enabled())